@@ -36,7 +36,7 @@ import matplotlib.pyplot as plt
 # Personal files #
 import parameters
 from preprocessing import PreprocessLayer
-from data_generator import DataGenerator
+from data_generator import DataGenerator, GeneratorWorkers
 
 #################################################################################################
 # LossHistory #
@@ -159,7 +159,7 @@ def NeuralNetModel(x_train,y_train,x_val,y_val,params):
     with open(os.path.join(parameters.main_path,'scaler_'+parameters.suffix+'.pkl'), 'rb') as handle: # Import scaler that was created before
         scaler = pickle.load(handle)
     IN = Input(shape=(x_train.shape[1],),name='IN')
-    L0 = PreprocessLayer(batch_size=params['batch_size'],mean=scaler.mean_,std=scaler.scale_,name='Preprocess')(IN)
+    L0 = PreprocessLayer(mean=scaler.mean_,std=scaler.scale_,name='Preprocess')(IN)
     L1 = Dense(params['first_neuron'],
                activation=params['activation'],
                kernel_regularizer=l2(params['l2']))(L0)
@@ -222,6 +222,7 @@ def NeuralNetModel(x_train,y_train,x_val,y_val,params):
                         y               = {'OUT':y_train},
                         sample_weight   = w_train,
                         epochs          = params['epochs'],
+                        initial_epoch   = initial_epoch,        # In case of resumed training will be different from 0
                         batch_size      = params['batch_size'],
                         verbose         = 2,
                         validation_data = ({'IN':x_val},{'OUT':y_val},w_val),
@@ -247,7 +248,7 @@ def NeuralNetGeneratorModel(x_train,y_train,x_val,y_val,params):
     with open(os.path.join(parameters.main_path,'scaler_'+parameters.suffix+'.pkl'), 'rb') as handle: # Import scaler that was created before
         scaler = pickle.load(handle)
     IN = Input(shape=(x_train.shape[1],),name='IN')
-    L0 = PreprocessLayer(batch_size=params['batch_size'],mean=scaler.mean_,std=scaler.scale_,name='Preprocess')(IN)
+    L0 = PreprocessLayer(mean=scaler.mean_,std=scaler.scale_,name='Preprocess')(IN)
     L1 = Dense(params['first_neuron'],
                activation=params['activation'],
                kernel_regularizer=l2(params['l2']))(L0)
@@ -302,15 +303,23 @@ def NeuralNetGeneratorModel(x_train,y_train,x_val,y_val,params):
                                        outputs = parameters.outputs,
                                        batch_size = params['batch_size'],
                                        state_set = 'training',
-                                       weights_generator = weights_generator)
+                                       weights_generator = weights_generator,
+                                       chunk_batches = parameters.generator_chunk_batches,
+                                       prefetch = parameters.generator_prefetch,
+                                       shuffle = parameters.generator_shuffle,
+                                       seed = parameters.generator_seed,
+                                       epoch = initial_epoch)
     validation_generator = DataGenerator(path = parameters.path_gen_validation,
                                        inputs = parameters.inputs,
                                        outputs = parameters.outputs,
                                        batch_size = params['batch_size'],
-                                       state_set = 'validation')
+                                       state_set = 'validation',
+                                       chunk_batches = parameters.generator_chunk_batches,
+                                       prefetch = parameters.generator_prefetch)
 
     # Some verbose logging #
-    logging.info("Will use %d workers"%parameters.workers)
+    workers = GeneratorWorkers(parameters.workers)
+    logging.info("Will use %d workers"%workers)
     logging.warning("Keras location " + keras.__file__)
     logging.warning("Tensorflow location "+ tf.__file__)
     logging.warning("GPU ")
@@ -320,12 +329,12 @@ def NeuralNetGeneratorModel(x_train,y_train,x_val,y_val,params):
                                   validation_data       = validation_generator, # Validation data from generator instance
                                   epochs                = params['epochs'],     # Number of epochs
                                   verbose               = 1,
-                                  max_queue_size        = parameters.workers*2, # Length of batch queue
+                                  max_queue_size        = 2*parameters.generator_chunk_batches, # Length of batch queue
                                   callbacks             = Callback_list,        # Callbacks
                                   initial_epoch         = initial_epoch,        # In case of resumed training will be different from 0
-                                  workers               = parameters.workers,   # Number of threads for batch generation (0 : all in same)
-                                  shuffle               = True,                 # Shuffle order at each epoch
-                                  use_multiprocessing   = True)                 # Needs to be turned on for queuing batches
+                                  workers               = workers,              # Single thread reading the chunks in order (0 : all in same)
+                                  shuffle               = False,                # Batches are read in chunks, the generator shuffles them itself
+                                  use_multiprocessing   = False)                # The chunks are kept in this process
                                 
     # Plot history #
     PlotHistory(loss_history)
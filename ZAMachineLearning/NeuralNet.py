@@ -9,9 +9,12 @@ import logging
 import random
 import csv
 import time
+import functools
+import contextlib
 
 import array
 import numpy as np
+import pandas as pd
 import itertools
 import plotille # For plots in terminal
 
@@ -44,10 +47,50 @@ import parameters
 from split_training import DictSplit
 from plot_scans import PlotScans
 from preprocessing import PreprocessLayer
-from data_generator import DataGenerator
+from data_generator import DataGenerator, GeneratorWorkers
+from shared_data import SplitIndices, AttachArrays
+from evaluate_models import EvaluateModels
 from generate_mask import GenerateSliceIndices, GenerateSliceMask
 import Model
 
+# Custom objects of the models : custom layers #
+CUSTOM_OBJECTS = {'PreprocessLayer': PreprocessLayer}
+
+#################################################################################################
+# RestoreModel #
+#################################################################################################
+def RestoreModel(path):
+    """
+    Restores the talos zip archive in path (see HyperRestore)
+    The restored archives are kept in a LRU cache of parameters.restore_cache_size models, keyed by path and modification time :
+    a model used several times in the run (cross validation, several files) is only unpacked once, and again if the zip changes
+    A failed restoration (eg, zip being copied) is tried again restore_retries times, every restore_wait seconds
+    """
+    for attempt in range(parameters.restore_retries+1):
+        try:
+            hits = _RestoreCached.cache_info().hits
+            a = _RestoreCached(os.path.abspath(path),os.path.getmtime(path))
+            if _RestoreCached.cache_info().hits > hits:
+                logging.debug('Model %s taken from the cache'%path)
+            return a
+        except Exception as e:
+            if attempt == parameters.restore_retries:
+                logging.error('Could not load model %s after %d attempts'%(path,attempt+1))
+                raise
+            logging.warning('Could not load model due to "%s", will try again in %ds (%d/%d)'%(e,parameters.restore_wait,attempt+1,parameters.restore_retries))
+            time.sleep(parameters.restore_wait)
+
+@functools.lru_cache(maxsize=parameters.restore_cache_size)
+def _RestoreCached(path,mtime):
+    start_time = time.time()
+    a = Restore(path,custom_objects=CUSTOM_OBJECTS)
+    a.graph = None
+    if tf.__version__.startswith('1.'): # So that the model can be used from other threads
+        a.model._make_predict_function()
+        a.graph = tf.get_default_graph()
+    logging.info('Model %s restored in %0.2f s'%(path,time.time()-start_time))
+    return a
+
 #################################################################################################
 # HyperModel #
 #################################################################################################
@@ -57,17 +100,18 @@ class HyperModel:
     #############################################################################################
     def __init__(self,name):
         self.name = name
-        self.custom_objects =  {'PreprocessLayer': PreprocessLayer} # Needs to be specified when saving and restoring
+        self.custom_objects = CUSTOM_OBJECTS # Needs to be specified when saving and restoring
 
     #############################################################################################
     # HyperScan #
     #############################################################################################
-    def HyperScan(self,data,list_inputs,list_outputs,task,model_idx=None,generator=False,resume=False):
+    def HyperScan(self,data,list_inputs,list_outputs,task,model_idx=None,generator=False,resume=False,shared=None):
         """
         Performs the scan for hyperparameters
         If task is specified, will load a pickle dict splitted from the whole set of parameters
         Data is a pandas dataframe containing all the event informations (inputs, outputs and unused variables)
         The column to be selected are given in list_inputs, list_outputs as lists of strings
+        If shared is the path of arrays published by PublishArrays (shared_data.py), they are used instead of data
         Reference : /home/ucl/cp3/fbury/.local/lib/python3.6/site-packages/talos/scan/Scan.py
         """
         logging.info(' Starting scan '.center(80,'-'))
@@ -81,22 +125,24 @@ class HyperModel:
             logging.info('..... %s'%name)
             
         # Records #
-        if not generator:
+        if shared is not None: # Arrays published by another process (see shared_data.py), memory-mapped without copy
+            arrays = AttachArrays(shared)
+            self.x_train = arrays['x_train']
+            self.y_train = arrays['y_train']
+            self.x_val   = arrays['x_val']
+            self.y_val   = arrays['y_val']
+            logging.info("Training set   : %d (shared from %s)"%(self.x_train.shape[0],shared))
+            logging.info("Evaluation set : %d (shared from %s)"%(self.x_val.shape[0],shared))
+        elif not generator:
             self.x = data[list_inputs].values
             self.y = data[list_outputs+['learning_weights']].values
             # Data splitting #
-            if model_idx is None:
-                size = parameters.training_ratio/(parameters.training_ratio+parameters.evaluation_ratio)
-                self.x_train, self.x_val, self.y_train, self.y_val = train_test_split(self.x,self.y,train_size=size)
-            else: # Cross validation : take the training and evaluation set based on the mask
-                # model_idx == index of mask on which model will be applied (aka, not trained nor evaluated)
-                _, eval_idx, train_idx = GenerateSliceIndices(model_idx) #, GenerateSliceMask
-                eval_mask = GenerateSliceMask(eval_idx,data['mask'])
-                train_mask = GenerateSliceMask(train_idx,data['mask'])
-                self.x_val   = self.x[eval_mask]
-                self.y_val   = self.y[eval_mask]
-                self.x_train = self.x[train_mask]
-                self.y_train = self.y[train_mask]
+            # Classic : random split, cross validation : take the training and evaluation set based on the mask
+            train_idx, val_idx = SplitIndices(data,model_idx)
+            self.x_val   = self.x[val_idx]
+            self.y_val   = self.y[val_idx]
+            self.x_train = self.x[train_idx]
+            self.y_train = self.y[train_idx]
             logging.info("Training set   : %d"%self.x_train.shape[0])
             logging.info("Evaluation set : %d"%self.x_val.shape[0])
         else:
@@ -150,72 +196,160 @@ class HyperModel:
                 name += '_crossval%d'%model_idx
             self.name_model = name+'_'+self.task.replace('.pkl','')
 
-        # Define scan object #
-        self.h = Scan(x=self.x_train,                       # Training inputs 
-                      y=self.y_train,                       # Training targets
-                      params=self.p,                        # Parameters dict
-                      dataset_name=self.name,               # Name of experiment
-                      experiment_no=str(no),                # Number of experiment
-                      model=getattr(Model,parameters.model),# Get the model in Model.py specified by parameters.py
-                      val_split=0.1,                        # How much data is to be used for val_loss
-                      reduction_metric='val_loss',          # How to select best model
-                      #grid_downsample=0.1,                 # When used in serial mode
-                      #random_method='lhs',                     ---
-                      #reduction_method='spear',                ---
-                      #reduction_window=1000,                   ---
-                      #reduction_interval=100,                  ---
-                      #last_epoch_value=True,                   ---
-                      print_params=True,                    # To print param at each job
-                      repetition=parameters.repetition,     # Wether a set of parameters is to be trained several times
-                      path_model = parameters.path_model,   # Where to save the model
-                      custom_objects=self.custom_objects,   # Custom object : custom layer
-                )
-        if not generator:
-            # Use the save information in DF #
-            self.h_with_eval = Autom8(scan_object = self.h,     # the scan object
-                                      x_val = self.x_val,       # Evaluation inputs
-                                      y_val = self.y_val[:,:-1],# Evaluatio targets (last column is weight)
-                                      n = -1,                   # How many model to evaluate (n=-1 means all)
-                                      folds = 5,                # Cross-validation splits for nominal and errors
-                                      metric = 'val_loss',      # On what metric to sort
-                                      asc = True,               # Ascending because loss function
-                                      shuffle = True,           # Shuffle bfore evaluation
-                                      average = 'micro')        # Not useful here
-            self.h_with_eval.data.to_csv(self.name_model+'.csv') # save to csv including error
-            self.autom8 = True
+        # Scan and evaluation #
+        if parameters.halving and 'resume' not in self.p:
+            self.h, data = self.HalvingScan(no,generator=generator)
         else:
-            # Needs to use the generator evaluation #
-            error_arr = np.zeros(self.h.data.shape[0])
-            for i in range(self.h.data.shape[0]):
-                logging.info("Evaluating model %d"%i)
-                # Load model #
-                model_eval = model_from_json(self.h.saved_models[i],custom_objects=self.custom_objects)   
-                model_eval.set_weights(self.h.saved_weights[i])
-                model_eval.compile(optimizer=Adam(),loss={'OUT':parameters.p['loss_function']},metrics=['accuracy'])
-                # Evaluate model #
-                evaluation_generator = DataGenerator(path = parameters.path_gen_evaluation,
-                                                     inputs = parameters.inputs,
-                                                     outputs = parameters.outputs,
-                                                     batch_size = parameters.p['batch_size'][0],
-                                                     state_set = 'evaluation')
-
-                eval_metric = model_eval.evaluate_generator(generator             = evaluation_generator,
-                                                            workers               = parameters.workers,
-                                                            use_multiprocessing   = True)
-                # Save errors #
-                error_arr[i] = eval_metric[0]
-                logging.info('Error is %f'%error_arr[i])
-
-            # Save evaluation error to csv #
-            self.h.data['eval_mean'] = error_arr
-            self.h.data.to_csv(self.name_model+'.csv') # save to csv including error
-            self.autom8 = True
-            
+            if parameters.halving:
+                logging.warning('Successive halving is not used when resuming a training')
+            self.h = self.MakeScan(self.p,experiment_no=str(no))
+            data = self.HyperEvaluate(self.h,generator=generator,path_csv=self.name_model+'.csv.partial')
+        data.to_csv(self.name_model+'.csv') # save to csv including error, only once all the models are evaluated
+        if os.path.exists(self.name_model+'.csv.partial'):
+            os.remove(self.name_model+'.csv.partial')
+        self.autom8 = True
+
         # returns the experiment configuration details
         logging.info('='*80)
         logging.debug('Details')
         logging.debug(self.h.details)
 
+    #############################################################################################
+    # MakeScan #
+    #############################################################################################
+    def MakeScan(self,params,experiment_no,repetition=None):
+        """ Runs the talos scan of the params dict on the training set, returns the scan object """
+        return Scan(x=self.x_train,                       # Training inputs 
+                    y=self.y_train,                       # Training targets
+                    params=params,                        # Parameters dict
+                    dataset_name=self.name,               # Name of experiment
+                    experiment_no=experiment_no,          # Number of experiment
+                    model=getattr(Model,parameters.model),# Get the model in Model.py specified by parameters.py
+                    val_split=0.1,                        # How much data is to be used for val_loss
+                    reduction_metric='val_loss',          # How to select best model
+                    #grid_downsample=0.1,                 # When used in serial mode
+                    #random_method='lhs',                     ---
+                    #reduction_method='spear',                ---
+                    #reduction_window=1000,                   ---
+                    #reduction_interval=100,                  ---
+                    #last_epoch_value=True,                   ---
+                    print_params=True,                    # To print param at each job
+                    repetition=parameters.repetition if repetition is None else repetition, # Wether a set of parameters is to be trained several times
+                    path_model = parameters.path_model,   # Where to save the model
+                    custom_objects=self.custom_objects,   # Custom object : custom layer
+              )
+
+    #############################################################################################
+    # HyperEvaluate #
+    #############################################################################################
+    def HyperEvaluate(self,scan,generator=False,path_csv=None):
+        """
+        Computes the evaluation error (eval_mean, eval_std) of the models of the scan object with parameters.eval_workers processes
+        If path_csv is given, the evaluated models are written to it as soon as they are done (partial results are kept if the job stops),
+        it must not end with .csv so that the partial results are not taken as a finished job (ConcatenateCSV, --resubmit)
+        Returns the data of the scan object including the error
+        """
+        data = scan.data
+        data['eval_mean'] = np.nan
+        data['eval_std'] = np.nan
+        def callback(i,mean,std):
+            data.loc[data.index[i],['eval_mean','eval_std']] = [mean,std]
+            if path_csv is not None: # In a temporary file first, never left incomplete
+                data[data['eval_mean'].notnull()].to_csv(path_csv+'.tmp')
+                os.replace(path_csv+'.tmp',path_csv)
+        EvaluateModels(models    = [(scan.saved_models[i],scan.saved_weights[i]) for i in range(data.shape[0])],
+                       x_val     = self.x_val,
+                       y_val     = self.y_val,
+                       generator = generator,
+                       workers   = parameters.eval_workers,
+                       callback  = callback)
+        return data
+
+    #############################################################################################
+    # HalvingScan #
+    #############################################################################################
+    def HalvingScan(self,no,generator=False):
+        """
+        Successive halving of the parameter sets (see parameters.py)
+            - all the sets are first trained for halving_min_epochs
+            - at the end of each round, the 1/halving_eta sets with lowest val_loss are kept, the others are stopped
+            - the kept sets are resumed from their checkpoint (zip) and trained halving_eta times longer, up to the epochs of the dict
+        Each set is evaluated after its last round, the data contains one line per set (same columns as the classic scan, 
+        plus halving_round and total_epochs)
+        Returns the scan object of the best set in the last round (for HyperDeploy) and the data
+        """
+        keys = [key for key in self.p.keys() if key != 'epochs']
+        sets = [dict(zip(keys,values)) for values in itertools.product(*[self.p[key] for key in keys])]
+        max_epochs = max(self.p['epochs'])
+        epochs = min(parameters.halving_min_epochs,max_epochs)
+        if self.task == '':     # On frontend
+            path_checkpoint = os.path.join(parameters.path_model,self.name_model+'_halving')
+        else:                   # On cluster
+            path_checkpoint = self.name_model+'_halving'
+        if not os.path.isdir(path_checkpoint):
+            os.makedirs(path_checkpoint)
+        logging.info('Successive halving of %d parameter sets, from %d to %d epochs'%(len(sets),epochs,max_epochs))
+
+        survivors = list(range(len(sets)))
+        trained_epochs = {}
+        list_data = []
+        halving_round = 0
+        while True:
+            if len(survivors) == 1: # No more selection, the last set goes directly to the end
+                epochs = max_epochs
+            last_round = epochs >= max_epochs
+            logging.info('Halving round %d : %d sets trained up to %d epochs'%(halving_round,len(survivors),epochs))
+            scans = {}
+            for i in survivors:
+                params = {key:[val] for key,val in sets[i].items()}
+                params['epochs'] = [epochs]
+                if i in trained_epochs: # Resumes from the checkpoint of the previous round
+                    params['resume'] = [os.path.join(path_checkpoint,'set%d.zip'%i)]
+                    params['initial_epoch'] = [trained_epochs[i]]
+                scans[i] = self.MakeScan(params,experiment_no='%s_halving%d_set%d'%(no,halving_round,i),repetition=1)
+                trained_epochs[i] = trained_epochs.get(i,0)+self.RoundEpochs(scans[i]) # Can be less than asked with early stopping
+
+            # Selection of the sets to continue #
+            ranking = sorted(survivors,key=lambda i : scans[i].data['val_loss'].values[0])
+            n_keep = 0 if last_round else max(1,len(survivors)//parameters.halving_eta)
+            for i in ranking[:n_keep]:
+                Deploy(scans[i],model_name='set%d'%i,metric='val_loss',asc=True,path_model=path_checkpoint)
+            stopped = ranking[n_keep:] # Stopped sets are evaluated together
+            means,stds = EvaluateModels(models    = [(scans[i].saved_models[0],scans[i].saved_weights[0]) for i in stopped],
+                                        x_val     = self.x_val,
+                                        y_val     = self.y_val,
+                                        generator = generator,
+                                        workers   = parameters.eval_workers)
+            for i,mean,std in zip(stopped,means,stds):
+                scans[i].data['eval_mean'] = mean
+                scans[i].data['eval_std'] = std
+                data = scans[i].data.copy()
+                data['halving_round'] = halving_round
+                data['total_epochs'] = trained_epochs[i]
+                list_data.append(data)
+            if last_round:
+                break
+            survivors = ranking[:n_keep]
+            epochs = min(epochs*parameters.halving_eta,max_epochs)
+            halving_round += 1
+
+        # Best set of the last round #
+        best = max(ranking,key=lambda i : scans[i].data['eval_mean'].values[0]) # Same order as in HyperDeploy
+        shutil.rmtree(path_checkpoint)
+        data = pd.concat(list_data,ignore_index=True)
+        logging.info('Successive halving : %d epochs trained in total instead of %d for the full grid'%(data['total_epochs'].sum(),len(sets)*max_epochs))
+        return scans[best],data
+
+    #############################################################################################
+    # RoundEpochs #
+    #############################################################################################
+    @staticmethod
+    def RoundEpochs(scan):
+        """ Number of epochs actually trained in the (single) round of the scan (from the history, lower if early stopping) """
+        if len(getattr(scan,'round_history',[])) != 0 and 'val_loss' in scan.round_history[0]:
+            return len(scan.round_history[0]['val_loss'])
+        return int(scan.data['round_epochs'].values[0])
+
     #############################################################################################
     # HyperDeploy #
     #############################################################################################
@@ -333,6 +467,13 @@ class HyperModel:
         # Make plots #
         PlotScans(data=r.data,path=path_plot,tag='')
 
+    #############################################################################################
+    # HyperLoad #
+    #############################################################################################
+    def HyperLoad(self):
+        """ Restores the zip of the model (model/name.zip), see RestoreModel """
+        return RestoreModel(os.path.join(parameters.main_path,'model',self.name+'.zip'))
+
     #############################################################################################
     # HyperRestore #
     #############################################################################################
@@ -344,20 +485,13 @@ class HyperModel:
             /home/ucl/cp3/fbury/.local/lib/python3.6/site-packages/talos/commands/restore.py
         """
         logging.info(('Using model %s.zip '%(self.name).center(80,'-')))
-        # Load the preprocessing layer #
-        # Restore model #
-        loaded = False
-        while not loaded:
-            try:
-                a = Restore(os.path.join(parameters.main_path,'model',self.name+'.zip'),custom_objects=self.custom_objects)
-                loaded = True
-            except Exception as e:
-                logging.warning('Could not load model due to "%s", will try again in 3s'%e)
-                time.sleep(3)
+        # Restore model (only unpacked the first time in the run) #
+        a = self.HyperLoad()
 
         # Output of the model #
         if not generator:
-            outputs = a.model.predict(inputs,batch_size=parameters.output_batch_size,verbose=verbose)
+            with a.graph.as_default() if a.graph is not None else contextlib.ExitStack(): # Graph needed in other threads (TensorFlow 1)
+                outputs = a.model.predict(inputs,batch_size=parameters.output_batch_size,verbose=verbose)
         else:
             if generator_filepath is None:
                 logging.error("Generator output must be provided with a filepath")
@@ -366,10 +500,14 @@ class HyperModel:
                                              inputs = parameters.inputs,
                                              outputs = parameters.outputs,
                                              batch_size = parameters.output_batch_size,
-                                             state_set = 'output')
+                                             state_set = 'output',
+                                             chunk_batches = parameters.generator_chunk_batches,
+                                             prefetch = parameters.generator_prefetch,
+                                             remainder = True) # Every event gets an output
             outputs = a.model.predict_generator(output_generator,
-                                              workers=parameters.workers,
-                                              use_multiprocessing=True,
+                                              workers=GeneratorWorkers(parameters.workers),
+                                              use_multiprocessing=False,
                                               verbose=1)
+            assert outputs.shape[0] == output_generator.n_tot
 
         return outputs
@@ -228,69 +228,129 @@ def ListBranches(rootfile,treeName ='tree',verbose=False):
 ##################################################################################################
 def find_rows(a, b):
     """
-    Find the matching rows between a and b
+    Find the matching rows between a and b, on integer keys (one column per key, see event_matching.py)
     Returns numpy arrays of the matches as [idx in a,idx in b]
     """
     import numpy as np
-    dt = np.dtype((np.void, a.dtype.itemsize * a.shape[1]))
-
-    a_view = np.ascontiguousarray(a).view(dt).ravel()
-    b_view = np.ascontiguousarray(b).view(dt).ravel()
-
-    sort_b = np.argsort(b_view)
-    where_in_b = np.searchsorted(b_view, a_view,
-                                 sorter=sort_b)
-    where_in_b = np.take(sort_b, where_in_b)
-    which_in_a = np.take(b_view, where_in_b) == a_view
-    where_in_b = where_in_b[which_in_a]
-    which_in_a = np.nonzero(which_in_a)[0]
-    return np.column_stack((which_in_a, where_in_b))
-
-def AppendTree(rootfile1,rootfile2,branches,event_filter=None,rename=None,treeName='tree'):
+    from event_matching import EventKeys, MatchEvents
+    a = np.asarray(a)
+    b = np.asarray(b)
+    index = ['key%d'%j for j in range(a.shape[1])]
+    keys_a = EventKeys({key:a[:,j] for j,key in enumerate(index)},index)
+    keys_b = EventKeys({key:b[:,j] for j,key in enumerate(index)},index)
+    idx_a,idx_b,_ = MatchEvents(keys_a,keys_b,index)
+    return np.column_stack((idx_a, idx_b))
+
+def AppendTree(rootfile1,rootfile2,branches,event_filter=None,rename=None,treeName='tree',chunksize=100000):
     """
-    Append the branches of rootfile2 to rootfile1
-    If event_filter=None : All the common branches must be identical (make sure events are the same)
-    if not None : only append events in rootfile2 that are in rootfile1 
-        -> event_filt = list of variable to compare events
-        /!\ len(rootfile1)<len(rootfile2) in this case
+    Append the branches of rootfile2 to rootfile1 (saved in a new file with suffix _new)
+    If event_filter=None : the two files must have the same events, in the same order
+    if not None : the events of rootfile2 are matched to the ones of rootfile1 (see event_matching.py)
+        -> event_filter = list of integer variables identifying the events (eg, run, luminosityBlock and event)
+        the events of rootfile1 without match in rootfile2 get NaN (0 for integer branches),
+        the unmatched and duplicate events are reported
+    The files are read and written by chunks of chunksize events : only the event keys of rootfile1 are kept in memory,
+    the matched branches of rootfile2 are stored in a temporary file next to the new file
     """
-    # Get the arrays #
+    import tempfile
+    import numpy as np
     import root_numpy
-    import pandas as pd
-    data1 = pd.DataFrame(root_numpy.root2array(rootfile1,treeName,branches=ListBranches(rootfile1,treeName)))
+    from event_matching import EventKeys, EventMatcher
+
+    branches1 = ListBranches(rootfile1,treeName)
     # Check that the requested branches are in rootfile2 #
     list_branches2 = ListBranches(rootfile2,treeName)
     for b in branches:
         if not b in list_branches2:
             print ('Branch %s not present in file %s'%(b,rootfile2))
-    if event_filter is None:
-        data2 = pd.DataFrame(root_numpy.root2array(rootfile2,treeName,branches=branches))
-    else:
-        data2 = pd.DataFrame(root_numpy.root2array(rootfile2,treeName,branches=branches+event_filter))
-
-    if data1.shape[0] != data2.shape[0] and event_filter is None:
+    N1 = GetEntries(rootfile1,treeName=treeName)
+    N2 = GetEntries(rootfile2,treeName=treeName)
+    if N1 != N2 and event_filter is None:
         sys.exit('The two files do not have the same number of events')
-    print ('Number of branches in first file : %d'%data1.shape[1])
-    print ('Number of branches in second file to append : %d'%data2.shape[1])
-
-    # Event filtering #
-    if event_filter is not None:
-        indexes = find_rows(data1[event_filter].values,data2[event_filter].values)[:,1]
-            # [:,0] indexes in first array, [:,1] indexes in second array
-        data2 = data2[branches].iloc[indexes].reset_index(drop=True)
-
-    # Renaming columns #
-    if rename is not None:
-        data2.columns = rename
-
-    # Concatenate them #
-    all_df = pd.concat((data1,data2),axis=1)
-    all_data  = all_df.to_records(index=False,column_dtypes='float64')
-    all_data.dtype.names = [s.replace('(','').replace(')','').replace('.','_') for s in all_data.dtype.names] #root_numpy issues
-    
-    # Save them #
-    root_numpy.array2root(all_data,rootfile1.replace('.root','_new.root'),mode='recreate',treename=treeName)
-    print ('New file saved as %s'%rootfile1.replace('.root','_new.root'))
+    print ('Number of branches in first file : %d'%len(branches1))
+    print ('Number of branches in second file to append : %d'%len(branches))
+
+    # Names of the branches in the new file #
+    names = branches1 + (rename if rename is not None else branches)
+    names = [s.replace('(','').replace(')','').replace('.','_') for s in names] #root_numpy issues
+    path_output = rootfile1.replace('.root','_new.root')
+
+    path_tmp = None
+    try:
+        # Event filtering #
+        if event_filter is not None:
+            # Hash index of the events of rootfile1 #
+            keys1 = root_numpy.root2array(rootfile1,treeName,branches=event_filter)
+            matcher = EventMatcher(EventKeys(keys1,event_filter),event_filter)
+            del keys1
+            # Branches of the matched events of rootfile2, at the position of their event in rootfile1 #
+            path_tmp = tempfile.mkdtemp(prefix='AppendTree_',dir=os.path.dirname(os.path.abspath(path_output)))
+            store = None
+            for start in range(0,max(N2,1),chunksize):
+                data2 = root_numpy.root2array(rootfile2,treeName,branches=branches+[e for e in event_filter if e not in branches],
+                                              start=start,stop=start+chunksize)
+                if store is None:
+                    store = np.lib.format.open_memmap(os.path.join(path_tmp,'branches.npy'),mode='w+',
+                                                      dtype=[(b,data2.dtype[b]) for b in branches],shape=(max(len(matcher.unique),1),))
+                pos = matcher.match(EventKeys(data2,event_filter))
+                selection = pos >= 0
+                for b in branches:
+                    store[b][pos[selection]] = data2[b][selection]
+            print (matcher.report())
+
+        # Concatenate them and save, chunk by chunk #
+        for start in range(0,N1,chunksize):
+            data1 = root_numpy.root2array(rootfile1,treeName,branches=branches1,start=start,stop=start+chunksize)
+            if event_filter is None:
+                data2 = root_numpy.root2array(rootfile2,treeName,branches=branches,start=start,stop=start+chunksize)
+            else:
+                pos = matcher.inverse[start:start+data1.shape[0]]
+                data2 = store[pos]
+                unmatched = ~matcher.seen[pos]
+                for b in branches:
+                    if data2.dtype[b].kind == 'f':
+                        data2[b][unmatched] = np.nan
+            columns = [(data1,col) for col in data1.dtype.names]+[(data2,b) for b in branches]
+            all_data = np.empty(data1.shape[0],dtype=[(name,arr.dtype[col]) for name,(arr,col) in zip(names,columns)])
+            for name,(arr,col) in zip(names,columns):
+                all_data[name] = arr[col]
+            root_numpy.array2root(all_data,path_output,mode='recreate' if start==0 else 'update',treename=treeName)
+    finally:
+        if path_tmp is not None:
+            shutil.rmtree(path_tmp)
+    print ('New file saved as %s'%path_output)
+
+##################################################################################################
+##########################                 AttachFriend                 ##########################
+##################################################################################################
+def AttachFriend(tree,friendfile,alias='DNN',index=['run','event'],treeName='tree',check=False,chunksize=100000):
+    """
+    Attach the tree of friendfile (produced with --output --friend) as friend of tree, the original tree is not modified
+    The events are matched with an index built on the index branches (major and minor, must be in both trees) :
+        the friend tree can contain a subset of the events (cut) in another order
+        (if index=None, the events are matched by entry number, both trees must then have the same events)
+    The branches are then used as alias.branch (eg, tree.Draw('DNN.output_ZA'))
+    If check, the events of tree are first matched to the ones of the friend tree on the index (see event_matching.py),
+    and the unmatched and duplicate events are reported (BuildIndex silently uses one of the duplicate events)
+    Returns the friend file and tree, that must be kept open as long as tree is used
+    The default index is the one written with --friend (friend_index in parameters.py)
+    """
+    if index is not None and not 1 <= len(index) <= 2:
+        raise ValueError('The index of the friend tree must have one or two branches (major and minor), got %s'%index)
+    from ROOT import TFile
+    friend_file = TFile.Open(friendfile)
+    friend = friend_file.Get(treeName)
+    if check and index is not None:
+        from root_numpy import tree2array
+        from event_matching import EventKeys, EventMatcher
+        matcher = EventMatcher(EventKeys(tree2array(friend,branches=index),index),index)
+        for start in range(0,tree.GetEntries(),chunksize):
+            matcher.match(EventKeys(tree2array(tree,branches=index,start=start,stop=start+chunksize),index))
+        print (matcher.report())
+    if index is not None:
+        friend.BuildIndex(*index)
+    tree.AddFriend(friend,alias)
+    return friend_file,friend
 
 ##################################################################################################
 ##################           ExtractXsecAndEventWeightSumFromYaml              ###################
@@ -426,6 +486,8 @@ if __name__=='__main__':
         help='List of branches that must be used in the filter to append files')
     appendArgs.add_argument('--append_rename', action='append', nargs='+', required=False, 
         help='List of names that should replace the appended column names (must have the same number of entries)')
+    appendArgs.add_argument('--append_chunksize', action='store', type=int, required=False, default=100000,
+        help='Number of events read and written at once (default=100000)')
 
     yamlExtract = parser.add_argument_group('Parse a YAML file produced by bamboo to extract Xsec and event weight sum')
     yamlExtract.add_argument("--yaml", action='store', type=str, required=False,                                                                                                                            
@@ -489,7 +551,7 @@ if __name__=='__main__':
             else:
                 list_names = None
             treeName = args.tree if args.tree is not None else 'tree'
-            AppendTree(file1,file2,branches,event_filter=filter_events,rename=list_names,treeName=treeName)
+            AppendTree(file1,file2,branches,event_filter=filter_events,rename=list_names,treeName=treeName,chunksize=args.append_chunksize)
 
     if args.yaml is not None:
         ExtractXsecAndEventWeightSumFromYaml(args.yaml,args.suffix)
@@ -11,8 +11,6 @@ import logging
 import copy
 import pickle
 #import psutil
-from functools import reduce
-import operator
 import itertools
 import matplotlib.pyplot as plt
 if plt.rcParams['backend'] == 'TkAgg':
@@ -56,6 +54,10 @@ def get_options():
         help='Wether to resubmit failed jobs given a specific path containing the jobs that succeded')
     b.add_argument('-debug','--debug', action='store_true', required=False, default=False,
         help='Debug mode of the slurm submission, does everything except submit the jobs')
+    b.add_argument('-local','--local', action='store', required=False, type=int, default=0,
+        help='Number of local processes to run the scan in parallel instead of submitting on slurm (with --scan)')
+    b.add_argument('-threads','--threads', action='store', required=False, type=int, default=1,
+        help='Number of threads of each local process (with --local)')
 
     # Analyzing or producing outputs for given model (csv or zip file) #
     c = parser.add_argument_group('Analyzing or producing outputs for given model (csv or zip file)')
@@ -67,6 +69,8 @@ def get_options():
         help='Applies the provided model (do not forget -o) on the test set and output the tree') 
     c.add_argument('-o','--output', action='store', required=False, nargs='+', type=str, default=[], 
         help='Applies the provided model (do not forget -o) on the list of keys from sampleList.py (separated by spaces)') 
+    c.add_argument('--friend', action='store_true', required=False, default=False,
+        help='With --output, only writes the outputs and the event index (friend trees of the input files, see Utils.AttachFriend)') 
 
     # Concatenating csv files arguments #
     d = parser.add_argument_group('Concatenating csv files arguments')
@@ -110,6 +114,9 @@ def get_options():
     if (opt.test or len(opt.output)!=0) and opt.output == '': 
         logging.critical('You must specify the model with --output')
         sys.exit(1)
+    if opt.local!=0 and (opt.scan=='' or opt.task!='' or opt.resume):
+        logging.critical('--local requires --scan and cannot be used with --task or --resume')
+        sys.exit(1)
     if opt.generator:
         logging.info("Will use the generator")
     if opt.resume:
@@ -131,13 +138,18 @@ def main():
 
     # Private modules containing Pyroot #
     from NeuralNet import HyperModel
-    from import_tree import LoopOverTrees
+    from import_tree import LoopOverTrees, MemoryReport
     from produce_output import ProduceOutput
     from make_scaler import MakeScaler
     from submit_on_slurm import submit_on_slurm
     from generate_mask import GenerateMask
     from split_training import DictSplit
     from concatenate_csv import ConcatenateCSV
+    from local_scan import LocalScan
+    from shared_data import PublishArrays, DetachArrays
+    from parallel_output import ParallelOutput
+    from data_cache import CacheKey, LoadCache, SaveCache, IncrementalCache, ConcatFrames
+    from mass_points import AssignMassPoints
     from sampleList import samples_dict_2016, samples_dict_2017, samples_dict_2018, samples_path
     from threadGPU import utilizationGPU
     import parameters
@@ -175,6 +187,7 @@ def main():
         if opt.resume:              args += ' --resume '
         if opt.model!='':           args += ' --model '+opt.model+' '
         if len(opt.output)!=0:      args += ' --output '+ ' '.join(opt.output)+' '
+        if opt.friend:              args += ' --friend '
 
         if opt.submit!='':
             logging.info('Submitting jobs with args "%s"'%args)
@@ -211,18 +224,29 @@ def main():
         if not os.path.exists(path_output):
             os.mkdir(path_output)
 
-        # Instantiate #
-        inst_out = ProduceOutput(model=os.path.join(parameters.path_model,opt.model),generator=opt.generator)
-        # Loop over output keys #
+        # One job per output key and era #
+        list_jobs = []
         for key in opt.output:
-            # Create subdir #
-            path_output_sub = os.path.join(path_output,key+'_output')
-            if not os.path.exists(path_output_sub):
-                os.mkdir(path_output_sub)
-            try:
-                inst_out.OutputNewData(input_dir=samples_path,list_sample=samples_dict[key],path_output=path_output_sub)
-            except Exception as e:
-                logging.critical('Could not process key "%s" due to "%s"'%(key,e))
+            found = False
+            for era,samples_dict in zip(['2016','2017','2018'],[samples_dict_2016,samples_dict_2017,samples_dict_2018]):
+                if key not in samples_dict.keys():
+                    continue
+                found = True
+                # Create subdir #
+                path_output_sub = os.path.join(path_output,era,key+'_output')
+                if not os.path.exists(path_output_sub):
+                    os.makedirs(path_output_sub)
+                list_jobs.append((samples_path,samples_dict[key],path_output_sub))
+            if not found:
+                logging.critical('Could not process key "%s" : not in sampleList.py'%key)
+        # All the files of all the keys in parallel (the files already done are skipped) #
+        ParallelOutput(model      = [os.path.join(parameters.path_model,opt.model)],
+                       list_jobs  = list_jobs,
+                       workers    = parameters.output_workers,
+                       threads    = parameters.output_threads,
+                       generator  = opt.generator,
+                       chunksize  = parameters.output_chunksize,
+                       friend     = opt.friend)
         sys.exit()
     #############################################################################################
     # Data Input and preprocessing #
@@ -241,121 +265,144 @@ def main():
 
     lumidict = {'2016':35922,'2017':41529.152060112,'2018':59740.565201546}
 
+    # Samples to import #
+    nodes = ['TT','DY','ZA']
+    channels = ['ElEl','MuMu']
+    import_dict = {} # For each node : list of (era, list of samples)
+    for node in nodes:
+        strSelect = []
+        if opt.resolved:
+            strSelect.extend(['resolved_{}_{}'.format(channel,node) for channel in channels])
+        if opt.boosted:
+            strSelect.extend(['boosted_{}_{}'.format(channel,node) for channel in channels])
+        import_dict[node] = []
+        for era,samples_dict in zip(['2016','2017','2018'],[samples_dict_2016,samples_dict_2017,samples_dict_2018]):
+            if len(samples_dict.keys())==0:
+                logging.info('Sample dict for era {} is empty'.format(era))
+                continue
+            list_sample = [sample for key in strSelect for sample in samples_dict[key]]
+            import_dict[node].append((era,list_sample))
+
+    # Cache key : hash of the configuration and of the files used to produce the data #
+    cache_config = {'inputs'            : parameters.inputs,
+                    'outputs'           : parameters.outputs,
+                    'other_variables'   : parameters.other_variables,
+                    'weights'           : parameters.weights,
+                    'cut'               : parameters.cut,
+                    'suffix'            : parameters.suffix,
+                    'crossvalidation'   : parameters.crossvalidation,
+                    'training_ratio'    : parameters.training_ratio,    # Split of the training and test sets (masks)
+                    'evaluation_ratio'  : parameters.evaluation_ratio,
+                    'output_ratio'      : parameters.output_ratio,
+                    'N_slices'          : parameters.N_slices,
+                    'splitbranch'       : parameters.splitbranch,
+                    'samples'           : import_dict}
+    cache_files = [os.path.join(samples_path,sample) for node in nodes for era,list_sample in import_dict[node] for sample in list_sample]
+    cache_files += [json_file.format(era=era) for json_file in [parameters.xsec_json,parameters.event_weight_sum_json] for era in lumidict.keys()]
+    cache_key = CacheKey(cache_config,cache_files,checksum=parameters.cache_checksum)
+
+    # For a scan, only the columns seen by the network are needed #
+    if opt.scan != '' and len(opt.model) == 0:
+        cache_columns = [var.replace('$','') for var in parameters.inputs+parameters.outputs]+['learning_weights']
+        if parameters.crossvalidation:
+            cache_columns.append('mask')
+    else:
+        cache_columns = None
+
+    train_all = None
+    test_all = None
     if opt.nocache:
         logging.warning('No cache will be used not saved')
-    if os.path.exists(parameters.train_cache) and not opt.nocache:
-        logging.info('Will load training data from cache')
-        logging.info('... Training set : %s'%parameters.train_cache)
-        train_all = pd.read_pickle(parameters.train_cache)
-        if os.path.exists(parameters.test_cache) and not opt.nocache and not parameters.crossvalidation:
-            logging.info('Will load testing data from cache')
-            logging.info('... Testing  set : %s'%parameters.test_cache)
-            test_all = pd.read_pickle(parameters.test_cache)
     else:
+        train_all = LoadCache(parameters.train_cache,key=cache_key,columns=cache_columns)
+        if train_all is not None and not parameters.crossvalidation:
+            test_all = LoadCache(parameters.test_cache,key=cache_key,columns=cache_columns)
+            if test_all is None: # Need both sets
+                train_all = None
+        if train_all is not None:
+            logging.info('Will load training data from cache')
+            logging.info('... Training set : %s'%parameters.train_cache)
+            if not parameters.crossvalidation:
+                logging.info('Will load testing data from cache')
+                logging.info('... Testing  set : %s'%parameters.test_cache)
+    if train_all is None:
         # Import arrays #
-        nodes = ['TT','DY','ZA']
-        channels = ['ElEl','MuMu']
         data_dict = {}
         for node in nodes:
-            strSelect = []
-            list_sample = []
-            if opt.resolved:
-                strSelect.extend(['resolved_{}_{}'.format(channel,node) for channel in channels])
-            if opt.boosted:
-                strSelect.extend(['boosted_{}_{}'.format(channel,node) for channel in channels])
-
             data_node = None
-
-            for era,samples_dict in zip(['2016','2017','2018'],[samples_dict_2016,samples_dict_2017,samples_dict_2018]):
-                if len(samples_dict.keys())==0:
-                    logging.info('Sample dict for era {} is empty'.format(era))
-                    continue
+            for era,list_sample in import_dict[node]:
                 if node != 'ZA':
                     xsec_json = parameters.xsec_json.format(era=era)
                     event_weight_sum_json = parameters.event_weight_sum_json.format(era=era)
                 else:
                     xsec_json = None
                     event_weight_sum_json = None
-                list_sample = [sample for key in strSelect for sample in samples_dict[key]]
-                data_node_era = LoopOverTrees(input_dir                 = samples_path,
-                                              variables                 = variables,
-                                              weight                    = parameters.weights,
-                                              list_sample               = list_sample,
-                                              cut                       = parameters.cut,
-                                              xsec_json                 = xsec_json,
-                                              event_weight_sum_json     = event_weight_sum_json,
-                                              luminosity                = lumidict[era],
-                                              additional_columns        = {'tag':node,'era':era})
+                import_function = lambda samples : LoopOverTrees(input_dir                 = samples_path,
+                                                                 variables                 = variables,
+                                                                 weight                    = parameters.weights,
+                                                                 list_sample               = samples,
+                                                                 cut                       = parameters.cut,
+                                                                 xsec_json                 = xsec_json,
+                                                                 event_weight_sum_json     = event_weight_sum_json,
+                                                                 luminosity                = lumidict[era],
+                                                                 additional_columns        = {'tag':node,'era':era},
+                                                                 workers                   = parameters.import_workers,
+                                                                 downcast                  = parameters.import_downcast,
+                                                                 memory_budget             = parameters.import_memory_budget,
+                                                                 spill_path                = os.path.join(parameters.import_spill,'{}_{}'.format(node,era)),
+                                                                 chunksize                 = parameters.import_chunksize)
+                if opt.nocache:
+                    data_node_era = import_function(list_sample)
+                else: # Only the files modified since the last importation are read again
+                    import_config = {'variables'    : variables,
+                                     'weight'       : parameters.weights,
+                                     'cut'          : parameters.cut,
+                                     'luminosity'   : lumidict[era],
+                                     'node'         : node,
+                                     'era'          : era,
+                                     'normalization': 'per_file'} # Xsec and event weight sum found for each file (older caches are imported again)
+                    data_node_era = IncrementalCache(path            = os.path.join(parameters.import_cache,'{}_{}'.format(node,era)),
+                                                     config          = import_config,
+                                                     list_files      = [os.path.join(samples_path,sample) for sample in list_sample],
+                                                     import_function = import_function,
+                                                     config_files    = [f for f in [xsec_json,event_weight_sum_json] if f is not None],
+                                                     checksum        = parameters.cache_checksum)
                 if data_node is None:
                     data_node = data_node_era
                 else:
-                    data_node = pd.concat([data_node,data_node_era],axis=0)
+                    data_node = ConcatFrames([data_node,data_node_era])
                 logging.info('\t{} class in era {} : sample size = {}, weight sum = {:.3e} (with normalization = {:.3e})'.format(node,era,data_node_era.shape[0],data_node_era[parameters.weights].sum(),data_node_era['event_weight'].sum()))
             data_dict[node] = data_node
             logging.info('{} class for all eras : sample size = {}, weight sum = {:.3e} (with normalization = {:.3e})'.format(node,data_node.shape[0],data_node[parameters.weights].sum(),data_node['event_weight'].sum()))
 
         #logging.info('Current memory usage : %0.3f GB'%(pid.memory_info().rss/(1024**3)))
 
-        # Modify MA and MH for background #
-        mass_prop_ZA = [(x, len(list(y))) for x, y in itertools.groupby(sorted(data_dict['ZA'][["mH","mA"]].values.tolist()))]
-        mass_prop_DY = [(x,math.ceil(y/data_dict['ZA'].shape[0]*data_dict['DY'].shape[0])) for x,y in mass_prop_ZA]
-        mass_prop_TT = [(x,math.ceil(y/data_dict['ZA'].shape[0]*data_dict['TT'].shape[0])) for x,y in mass_prop_ZA]
-            # array of [(mH,mA), proportions]
-        mass_DY = np.array(reduce(operator.concat, [[m]*n for (m,n) in mass_prop_DY]))
-        mass_TT = np.array(reduce(operator.concat, [[m]*n for (m,n) in mass_prop_TT]))
-        np.random.shuffle(mass_DY) # Shuffle so that each background event has random masses
-        np.random.shuffle(mass_TT) # Shuffle so that each background event has random masses
-        df_masses_DY = pd.DataFrame(mass_DY,columns=["mH","mA"]) 
-        df_masses_TT = pd.DataFrame(mass_TT,columns=["mH","mA"]) 
-        df_masses_DY = df_masses_DY[:data_dict['DY'].shape[0] ]# Might have slightly more entries due to numerical instabilities in props
-        df_masses_TT = df_masses_TT[:data_dict['TT'].shape[0] ]# Might have slightly more entries due to numerical instabilities in props
-        data_dict['DY'][["mH","mA"]] = df_masses_DY
-        data_dict['TT'][["mH","mA"]] = df_masses_TT
-
+        # Modify MA and MH for background and weight equalization #
+        background_masses, learning_weights, mass_points = AssignMassPoints(signal_masses       = data_dict['ZA'][["mH","mA"]].values,
+                                                                            background_weights  = {node:data_dict[node]["event_weight"].values for node in ['DY','TT']},
+                                                                            equalize            = parameters.weights is not None)
+        for node in ['DY','TT']:
+            data_dict[node]["mH"] = background_masses[node][:,0]
+            data_dict[node]["mA"] = background_masses[node][:,1]
+        learning_weights['ZA'] = learning_weights.pop('signal')
 
         # Check the proportions #
         logging.debug("Check on the masses proportions")
-        tot_DY = 0
-        tot_TT = 0
-        for masses, prop_in_ZA in mass_prop_ZA:
-            prop_in_DY = data_dict['DY'][(data_dict['DY']["mH"]==masses[0]) & (data_dict['DY']["mA"]==masses[1])].shape[0]
-            prop_in_TT = data_dict['TT'][(data_dict['TT']["mH"]==masses[0]) & (data_dict['TT']["mA"]==masses[1])].shape[0]
+        for masses,prop_in_ZA,prop_in_DY,prop_in_TT in zip(mass_points['masses'],mass_points['signal'],mass_points['DY'],mass_points['TT']):
             logging.debug("... Mass point (MH = %d, MA = %d)\t: N signal = %d (%0.2f%%),\tN DY = %d (%0.2f%%)\tN TT = %d (%0.2f%%)"
                          %(masses[0],masses[1],prop_in_ZA,prop_in_ZA/data_dict['ZA'].shape[0]*100,prop_in_DY,prop_in_DY/data_dict['DY'].shape[0]*100,prop_in_TT,prop_in_TT/data_dict['TT'].shape[0]*100))
-            tot_DY += prop_in_DY
-            tot_TT += prop_in_TT
-        assert tot_DY == data_dict['DY'].shape[0]
-        assert tot_TT == data_dict['TT'].shape[0]
-
-        # Weight equalization #
-        if parameters.weights is not None:
-            weight_DY = data_dict['DY']["event_weight"]
-            weight_TT = data_dict['TT']["event_weight"]
-            # Use mass prop weights so that eahc mass point has same importance #
-            weight_ZA = np.zeros(data_dict['ZA'].shape[0])
-            for m,p in mass_prop_ZA:    
-                idx = list(data_dict['ZA'][(data_dict['ZA']["mH"]==m[0]) & (data_dict['ZA']["mA"]==m[1])].index)
-                weight_ZA[idx] = 1./p
-            # We need the different types to have the same sumf of weight to equalize training
-            # Very small weights produce very low loss function, needs to add multiplicating factor
-            weight_DY = weight_DY/np.sum(weight_DY)*1e5
-            weight_TT = weight_TT/np.sum(weight_TT)*1e5
-            weight_ZA = weight_ZA/np.sum(weight_ZA)*1e5
-        else:
-            weight_DY = np.ones(data_dict['DY'].shape[0])
-            weight_TT = np.ones(data_dict['TT'].shape[0])
-            weight_ZA = np.ones(data_dict['ZA'].shape[0])
+        assert mass_points['DY'].sum() == data_dict['DY'].shape[0]
+        assert mass_points['TT'].sum() == data_dict['TT'].shape[0]
 
         # Check sum of weight #
-        if np.sum(weight_ZA) != np.sum(weight_TT) or np.sum(weight_ZA) != np.sum(weight_DY) or np.sum(weight_TT) != np.sum(weight_DY):
+        weight_sums = {node:np.sum(weights) for node,weights in learning_weights.items()}
+        if len(set(weight_sums.values())) != 1:
             logging.warning ('Sum of weights different between the samples')
-            logging.warning('\tDY : '+str(np.sum(weight_DY)))
-            logging.warning('\tTT : '+str(np.sum(weight_TT)))
-            logging.warning('\tZA : '+str(np.sum(weight_ZA)))
+            for node,weight_sum in weight_sums.items():
+                logging.warning('\t%s : %s'%(node,str(weight_sum)))
 
-        data_dict['DY']['learning_weights'] = pd.Series(weight_DY)
-        data_dict['TT']['learning_weights'] = pd.Series(weight_TT)
-        data_dict['ZA']['learning_weights'] = pd.Series(weight_ZA)
+        for node,weights in learning_weights.items():
+            data_dict[node]['learning_weights'] = weights
         #logging.info('Current memory usage : %0.3f GB'%(pid.memory_info().rss/(1024**3)))
 
         # Data splitting #
@@ -372,7 +419,7 @@ def main():
                     logging.critical("Problem with the masking")
                     raise ValueError
             else: # Classic separation
-                mask = GenerateMask(data.shape[0],parameters.suffix+'_'+node)
+                mask = GenerateMask(data.shape[0],parameters.suffix+'_'+node,provenance={'samples':import_dict[node]})
                 try:
                     train_dict[node] = data[mask==True]
                     test_dict[node]  = data[mask==False]
@@ -381,14 +428,15 @@ def main():
                     raise ValueError
 
         if parameters.crossvalidation:
-            train_all = pd.concat(data_dict.values(),copy=True).reset_index(drop=True)
+            train_all = ConcatFrames(list(data_dict.values()))
             test_all = pd.DataFrame(columns=train_all.columns) # Empty to not break rest of script
         else:
-            train_all = pd.concat(train_dict.values(),copy=True).reset_index(drop=True)
-            test_all  = pd.concat(test_dict.values(),copy=True).reset_index(drop=True)
+            train_all = ConcatFrames(list(train_dict.values()))
+            test_all  = ConcatFrames(list(test_dict.values()))
         del data_dict 
         if not parameters.crossvalidation:
             del train_dict, test_dict
+        MemoryReport(train_all,'Training set')
         #logging.info('Current memory usage : %0.3f GB'%(pid.memory_info().rss/(1024**3)))
 
         # Randomize order, we don't want only one type per batch #
@@ -421,15 +469,21 @@ def main():
         # The purpose is to create a scaler object and save it
         # The preprocessing will be implemented in the network with a custom layer
         if opt.scan!='': # If we don't scan we don't need to scale the data
-            MakeScaler(train_all,list_inputs) 
+            if opt.generator: # The network is trained on the generator files, the scaler is computed from them
+                MakeScaler(list_inputs  = [var.replace('$','') for var in list_inputs],
+                           generator    = True,
+                           weight       = parameters.scaler_weight,
+                           workers      = parameters.scaler_workers)
+            else:
+                MakeScaler(train_all,list_inputs,provenance={'data':cache_key},weight=parameters.scaler_weight) 
 
         # Caching #
         if not opt.nocache:
-            train_all.to_pickle(parameters.train_cache)
+            SaveCache(train_all,parameters.train_cache,key=cache_key,provenance=cache_config)
             logging.info('Data saved to cache')
             logging.info('... Training set : %s'%parameters.train_cache)
             if not parameters.crossvalidation:
-                test_all.to_pickle(parameters.test_cache)
+                SaveCache(test_all,parameters.test_cache,key=cache_key,provenance=cache_config)
                 logging.info('... Testing  set : %s'%parameters.test_cache)
      
     list_inputs  = [var.replace('$','') for var in parameters.inputs]
@@ -460,26 +514,52 @@ def main():
                                 time_step=0.01)
         thread.start()
 
-    if opt.scan != '':
-        instance = HyperModel(opt.scan)
-        if parameters.crossvalidation:
-            for i in range(parameters.N_models):
+    if opt.scan != '' and opt.local != 0: # Parallel scan on the local cores
+        for model_idx in (range(parameters.N_models) if parameters.crossvalidation else [None]):
+            if model_idx is not None:
                 logging.info("*"*80)
-                logging.info("Starting training of model %d"%i)
+                logging.info("Starting training of model %d"%model_idx)
+            LocalScan(name           = opt.scan,
+                      data           = train_all,
+                      list_inputs    = list_inputs,
+                      list_outputs   = list_outputs,
+                      workers        = opt.local,
+                      threads        = opt.threads,
+                      model_idx      = model_idx,
+                      generator      = opt.generator)
+    elif opt.scan != '':
+        instance = HyperModel(opt.scan)
+        # Jobs on the same node can share the training arrays, the DataFrame is then not kept in memory #
+        shared = {}
+        if opt.task != '' and parameters.shared_arrays and not opt.generator:
+            for i in (range(parameters.N_models) if parameters.crossvalidation else [None]):
+                shared[i] = PublishArrays(train_all,list_inputs,list_outputs,path=parameters.shared_path,model_idx=i,key=cache_key)
+            train_all = None
+            test_all = None
+        try:
+            if parameters.crossvalidation:
+                for i in range(parameters.N_models):
+                    logging.info("*"*80)
+                    logging.info("Starting training of model %d"%i)
+                    instance.HyperScan(data=train_all,
+                                       list_inputs=list_inputs,
+                                       list_outputs=list_outputs,
+                                       task=opt.task,
+                                       model_idx=i,
+                                       shared=shared.get(i))
+                    instance.HyperDeploy(best='eval_error')
+            else:
                 instance.HyperScan(data=train_all,
                                    list_inputs=list_inputs,
                                    list_outputs=list_outputs,
                                    task=opt.task,
-                                   model_idx=i)
+                                   generator=opt.generator,
+                                   resume=opt.resume,
+                                   shared=shared.get(None))
                 instance.HyperDeploy(best='eval_error')
-        else:
-            instance.HyperScan(data=train_all,
-                               list_inputs=list_inputs,
-                               list_outputs=list_outputs,
-                               task=opt.task,
-                               generator=opt.generator,
-                               resume=opt.resume)
-            instance.HyperDeploy(best='eval_error')
+        finally: # The last job of the node using the shared arrays removes them
+            for path_arrays in shared.values():
+                DetachArrays(path_arrays)
 
     if opt.GPU:
         # Closing monitor thread #
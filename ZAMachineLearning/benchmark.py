@@ -0,0 +1,253 @@
+import os
+import sys
+import glob
+import timeit
+import logging
+import argparse
+
+import numpy as np
+
+##################################################################################################
+##########################                 BenchmarkImport              ##########################
+##################################################################################################
+def BenchmarkImport(input_dir,list_sample=None,list_workers=[1,2,4,8]):
+    """
+    Imports the same files with LoopOverTrees for each number of workers
+    Prints the wall time and throughput (events/s) to check how the import scales
+    """
+    import parameters
+    from import_tree import LoopOverTrees
+    variables = parameters.inputs+parameters.outputs+parameters.other_variables
+    reference = None
+    print ('Import benchmark on %s'%input_dir)
+    print ('-'*80)
+    for workers in list_workers:
+        start_time = timeit.default_timer()
+        df = LoopOverTrees(input_dir    = input_dir,
+                           variables    = variables,
+                           weight       = parameters.weights,
+                           list_sample  = list_sample,
+                           cut          = parameters.cut,
+                           workers      = workers)
+        elapsed = timeit.default_timer() - start_time
+        if reference is None:
+            reference = (df,elapsed)
+        else: # Parallel import must be identical to the serial one
+            assert df.equals(reference[0])
+        print (('Workers : %d '%workers).ljust(20,'.')+' %8.2f s | %10.0f events/s | speedup x%0.2f'%(elapsed,df.shape[0]/elapsed,reference[1]/elapsed))
+    print ('-'*80)
+
+##################################################################################################
+##########################                 BenchmarkMassPoints          ##########################
+##################################################################################################
+def _LegacyMassPoints(signal_masses,background_weights):
+    """ Previous implementation (list based, one pass per mass point), kept for comparison """
+    import math
+    import operator
+    import itertools
+    from functools import reduce
+    N_signal = signal_masses.shape[0]
+    mass_prop = [(x, len(list(y))) for x, y in itertools.groupby(sorted(signal_masses.tolist()))]
+    background_masses = {}
+    learning_weights = {}
+    for name,weights in background_weights.items():
+        prop = [(x,math.ceil(y/N_signal*weights.shape[0])) for x,y in mass_prop]
+        masses = np.array(reduce(operator.concat, [[m]*n for (m,n) in prop]))
+        np.random.shuffle(masses)
+        background_masses[name] = masses[:weights.shape[0]]
+        for m,p in mass_prop: # Check of the proportions
+            _ = background_masses[name][(background_masses[name][:,0]==m[0]) & (background_masses[name][:,1]==m[1])].shape[0]
+        learning_weights[name] = weights/np.sum(weights)*1e5
+    weight_signal = np.zeros(N_signal)
+    for m,p in mass_prop:
+        idx = np.nonzero((signal_masses[:,0]==m[0]) & (signal_masses[:,1]==m[1]))[0]
+        weight_signal[idx] = 1./p
+    learning_weights['signal'] = weight_signal/np.sum(weight_signal)*1e5
+    return background_masses, learning_weights
+
+def BenchmarkMassPoints(N=10000000,n_points=23,legacy=False):
+    """
+    Times the assignment of the mass points and learning weights on N events (1/3 signal, 1/3 DY, 1/3 TT)
+    If legacy, also times the previous implementation and checks that both give the same results
+    """
+    from mass_points import AssignMassPoints
+    points = np.c_[np.random.randint(200,1000,n_points),np.random.randint(50,200,n_points)]
+    signal_masses = points[np.random.randint(0,n_points,N//3)]
+    background_weights = {'DY':np.random.exponential(size=N//3),'TT':np.random.exponential(size=N//3)}
+    print ('Mass points benchmark on %d events with %d mass points'%(N,n_points))
+    print ('-'*80)
+
+    state = np.random.get_state()
+    start_time = timeit.default_timer()
+    background_masses, learning_weights, _ = AssignMassPoints(signal_masses,background_weights)
+    elapsed = timeit.default_timer() - start_time
+    print ('Vectorized '.ljust(20,'.')+' %8.3f s'%elapsed)
+
+    if legacy:
+        np.random.set_state(state) # Same shuffling
+        start_time = timeit.default_timer()
+        legacy_masses, legacy_weights = _LegacyMassPoints(signal_masses,background_weights)
+        elapsed_legacy = timeit.default_timer() - start_time
+        print ('Legacy '.ljust(20,'.')+' %8.3f s | speedup x%0.1f'%(elapsed_legacy,elapsed_legacy/elapsed))
+        for name in background_masses.keys():
+            assert np.array_equal(background_masses[name],legacy_masses[name])
+        for name in learning_weights.keys():
+            assert np.allclose(learning_weights[name],legacy_weights[name],rtol=1e-12,atol=0)
+        print ('Results are identical')
+    print ('-'*80)
+
+##################################################################################################
+##########################                 BenchmarkWeights             ##########################
+##################################################################################################
+def BenchmarkWeights(batch_size=10000,n_batches=10,variable_bins=False):
+    """
+    Times the weights lookup of the WeightsGenerator per batch
+    Compares with the loop over FindBin/GetBinContent and checks that the weights are identical
+    """
+    import tempfile
+    import ROOT
+    from data_generator import WeightsGenerator
+    # Make a weight histogram #
+    path_hist = os.path.join(tempfile.mkdtemp(),'weights.root')
+    root_file = ROOT.TFile(path_hist,"RECREATE")
+    if variable_bins:
+        edges = np.sort(np.random.uniform(0,1,51))
+        hist = ROOT.TH1F("weights","weights",50,edges)
+    else:
+        hist = ROOT.TH1F("weights","weights",50,0,1)
+    for i in range(0,hist.GetNcells()):
+        hist.SetBinContent(i,np.random.exponential())
+    hist.Write()
+    root_file.Close()
+
+    weightsGen = WeightsGenerator(path_hist)
+    print ('Weights benchmark on %d batches of %d events'%(n_batches,batch_size))
+    print ('-'*80)
+    elapsed = 0.
+    elapsed_legacy = 0.
+    for n in range(n_batches):
+        arr = np.random.uniform(-0.1,1.1,(batch_size,1))
+        start_time = timeit.default_timer()
+        weights = weightsGen.getWeights(arr)
+        elapsed += timeit.default_timer() - start_time
+        # Loop over the events #
+        start_time = timeit.default_timer()
+        legacy = np.zeros(arr.shape[0])
+        for i in range(0,arr.shape[0]):
+            hist_bin = weightsGen.hist.FindBin(arr[i,0])
+            if hist_bin < weightsGen.hist.GetNbinsX() and hist_bin >= 0:
+                legacy[i] = weightsGen.hist.GetBinContent(hist_bin)
+            else:
+                legacy[i] = 1
+        legacy /= np.sum(legacy)
+        elapsed_legacy += timeit.default_timer() - start_time
+        assert np.array_equal(weights,legacy)
+    print ('Vectorized '.ljust(20,'.')+' %8.5f s per batch'%(elapsed/n_batches))
+    print ('Legacy '.ljust(20,'.')+' %8.5f s per batch | speedup x%0.1f'%(elapsed_legacy/n_batches,elapsed_legacy/elapsed))
+    print ('Weights are identical')
+    print ('-'*80)
+
+##################################################################################################
+##########################                 BenchmarkCoupling            ##########################
+##################################################################################################
+def _LegacyRepeater(arr,n):
+    """ Previous implementation of signal_coupling.Repeater (row by row, object array), kept for comparison """
+    new_arr = np.zeros((arr.shape[0]*n,arr.shape[1]),dtype=object)
+    for i in range(0,arr.shape[0]):
+        new_row = np.tile(arr[i,:],(n,1))
+        new_arr[i*n:(i+1)*n,:] = new_row
+    return new_arr
+
+def _LegacyTransposer(arr,n):
+    """ Previous implementation of signal_coupling.Transposer (element by element), kept for comparison """
+    new_arr = np.zeros((arr.shape[0]//n,arr.shape[1]*n))
+    for i in range(arr.shape[0]//n):
+        arr_slice = arr[i*n:(i+1)*n,:]
+        idx_col = 0
+        for col in range(arr_slice.shape[1]):
+            for row in range(arr_slice.shape[0]):
+                new_arr[i,idx_col] = arr_slice[row,col]
+                idx_col += 1
+    return new_arr
+
+def BenchmarkCoupling(N=1000000,n_points=23,n_columns=12,legacy=False,N_legacy=20000):
+    """
+    Times Repeater and Transposer on N events with n_columns, repeated for n_points mass points
+    If legacy, the previous implementations are timed on the first N_legacy events (too slow for more),
+    the time is extrapolated to N events and the results are compared
+    """
+    from signal_coupling import Repeater, Transposer
+    arr = np.random.normal(size=(N,n_columns))
+    print ('Coupling benchmark on %d events with %d columns and %d mass points'%(N,n_columns,n_points))
+    print ('-'*80)
+    start_time = timeit.default_timer()
+    repeated = Repeater(arr,n_points)
+    elapsed_repeater = timeit.default_timer() - start_time
+    start_time = timeit.default_timer()
+    transposed = Transposer(repeated,n_points)
+    elapsed_transposer = timeit.default_timer() - start_time
+    print ('Repeater '.ljust(20,'.')+' %8.3f s'%elapsed_repeater)
+    print ('Transposer '.ljust(20,'.')+' %8.3f s'%elapsed_transposer)
+
+    if legacy:
+        N_legacy = min(N,N_legacy)
+        scale = N/N_legacy
+        start_time = timeit.default_timer()
+        legacy_repeated = _LegacyRepeater(arr[:N_legacy],n_points)
+        elapsed = (timeit.default_timer() - start_time)*scale
+        print ('Legacy Repeater '.ljust(20,'.')+' %8.3f s (extrapolated from %d events) | speedup x%0.1f'%(elapsed,N_legacy,elapsed/elapsed_repeater))
+        start_time = timeit.default_timer()
+        legacy_transposed = _LegacyTransposer(repeated[:N_legacy*n_points],n_points)
+        elapsed = (timeit.default_timer() - start_time)*scale
+        print ('Legacy Transposer '.ljust(20,'.')+' %8.3f s (extrapolated from %d events) | speedup x%0.1f'%(elapsed,N_legacy,elapsed/elapsed_transposer))
+        assert np.array_equal(legacy_repeated.astype(arr.dtype),repeated[:N_legacy*n_points])
+        assert np.array_equal(legacy_transposed,transposed[:N_legacy])
+        print ('Results are identical')
+    print ('-'*80)
+
+##################################################################################################
+##########################                 Main                         ##########################
+##################################################################################################
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser('Benchmarks of the data processing steps')
+
+    importArgs = parser.add_argument_group('Scaling of the tree importation with the number of workers')
+    importArgs.add_argument('--import_dir', action='store', required=False, type=str,
+        help='Directory containing the root files to import')
+    importArgs.add_argument('--import_files', action='store', required=False, nargs='+', type=str, default=None,
+        help='List of files to import inside the directory (default = all)')
+    importArgs.add_argument('--workers', action='store', required=False, nargs='+', type=int, default=[1,2,4,8],
+        help='List of number of workers to benchmark (default = 1 2 4 8)')
+
+    massArgs = parser.add_argument_group('Assignment of the signal mass points to the background')
+    massArgs.add_argument('--masses', action='store', required=False, type=int, default=None,
+        help='Number of events for the benchmark (eg, 10000000)')
+    massArgs.add_argument('--legacy', action='store_true', required=False, default=False,
+        help='Also run the previous implementation and compare the results')
+
+    weightsArgs = parser.add_argument_group('Lookup of the weights in the histogram of the WeightsGenerator')
+    weightsArgs.add_argument('--weights', action='store', required=False, type=int, default=None,
+        help='Batch size for the benchmark (eg, 10000)')
+    weightsArgs.add_argument('--variable_bins', action='store_true', required=False, default=False,
+        help='Use a histogram with variable bin sizes')
+
+    couplingArgs = parser.add_argument_group('Repetition and transposition of the events for the signal coupling')
+    couplingArgs.add_argument('--coupling', action='store', required=False, type=int, default=None,
+        help='Number of events for the benchmark (eg, 1000000), with --legacy also runs the previous implementations')
+
+    #----- Execution -----#
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.import_dir is not None:
+        BenchmarkImport(args.import_dir,args.import_files,args.workers)
+
+    if args.masses is not None:
+        BenchmarkMassPoints(args.masses,legacy=args.legacy)
+
+    if args.weights is not None:
+        BenchmarkWeights(args.weights,variable_bins=args.variable_bins)
+
+    if args.coupling is not None:
+        BenchmarkCoupling(args.coupling,legacy=args.legacy)
@@ -0,0 +1,328 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+
+import numpy as np
+import pandas as pd
+
+
+# Columnar cache #
+# Each column of the DataFrame is saved as a separate .npy file inside a directory
+# A manifest.json contains the column names, dtypes and the key of the configuration used to produce them
+# The columns can then be memory-mapped individually, without reading the whole cache
+
+MANIFEST = 'manifest.json'
+
+###############################################################################
+# Fingerprints #
+###############################################################################
+
+def Fingerprints(files,checksum=False):
+    """
+    Returns a dict with the size and modification time of each file (and md5 checksum if requested)
+    Used to record the input files in the provenance of an artifact
+    """
+    fingerprints = {}
+    for f in files:
+        if not os.path.exists(f):
+            fingerprints[f] = None
+            continue
+        stat = os.stat(f)
+        fingerprints[f] = {'size':stat.st_size,'mtime':stat.st_mtime_ns}
+        if checksum:
+            md5 = hashlib.md5()
+            with open(f,'rb') as handle:
+                for block in iter(lambda: handle.read(1<<20),b''):
+                    md5.update(block)
+            fingerprints[f]['md5'] = md5.hexdigest()
+    return fingerprints
+
+###############################################################################
+# CacheKey #
+###############################################################################
+
+def CacheKey(config,files=[],checksum=False):
+    """
+    Hash of the configuration (any json serializable object) and of the fingerprints of the files
+    Used to check that a cache corresponds to the current configuration
+    """
+    content = {'config':config,'files':Fingerprints(files,checksum)}
+    return hashlib.sha1(json.dumps(content,sort_keys=True,default=str).encode()).hexdigest()
+
+###############################################################################
+# WriteProvenance #
+###############################################################################
+
+def WriteProvenance(path,provenance):
+    """
+    Save the provenance (json serializable dict) of an artifact (scaler, mask, ...) in the json file path
+    Returns the key of the provenance
+    """
+    key = CacheKey(provenance)
+    with open(path,'w') as handle:
+        json.dump({'key':key,'provenance':provenance},handle,indent=4,default=str)
+    return key
+
+###############################################################################
+# CheckProvenance #
+###############################################################################
+
+def CheckProvenance(path,provenance):
+    """ Returns True if the artifact recorded in the json file path has been produced with the same provenance """
+    if not os.path.exists(path):
+        return False
+    with open(path,'r') as handle:
+        manifest = json.load(handle)
+    return manifest['key'] == CacheKey(provenance)
+
+###############################################################################
+# ColumnArray #
+###############################################################################
+
+def ColumnArray(series):
+    """ Returns the numpy array saved in the cache for the column (strings cannot be memory-mapped as objects) """
+    if isinstance(series.dtype,pd.CategoricalDtype) or not pd.api.types.is_numeric_dtype(series.dtype):
+        return np.asarray(series.astype(str),dtype=str)
+    else:
+        return series.to_numpy()
+
+###############################################################################
+# SaveCache #
+###############################################################################
+
+def SaveCache(df,path,key=None,provenance=None):
+    """
+    Save the DataFrame as one .npy file per column in directory path
+    The key and provenance (configuration and file fingerprints) are saved in the manifest
+    The directory is written under a temporary name and moved at the end so readers never see a partial cache
+    """
+    tmp_path = path+'.tmp%d'%os.getpid()
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    manifest = {'key':key,'provenance':provenance,'n_rows':int(df.shape[0]),'columns':[]}
+    for i,col in enumerate(df.columns):
+        series = df[col]
+        categorical = isinstance(series.dtype,pd.CategoricalDtype)
+        arr = ColumnArray(series)
+        filename = 'col_%d.npy'%i # Column names can contain characters not suited for files
+        np.save(os.path.join(tmp_path,filename),arr)
+        manifest['columns'].append({'name':str(col),'file':filename,'dtype':arr.dtype.str,'categorical':categorical})
+    with open(os.path.join(tmp_path,MANIFEST),'w') as handle:
+        json.dump(manifest,handle,indent=4,default=str)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path,path)
+    logging.debug('Cache saved in %s (%d columns, %d rows)'%(path,df.shape[1],df.shape[0]))
+
+###############################################################################
+# ReadManifest #
+###############################################################################
+
+def ReadManifest(path):
+    """ Returns the manifest of the cache in path, None if there is no valid cache """
+    manifest_path = os.path.join(path,MANIFEST)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path,'r') as handle:
+        return json.load(handle)
+
+###############################################################################
+# LoadCache #
+###############################################################################
+
+def LoadCache(path,key=None,columns=None,mmap=True):
+    """
+    Load the columns from the cache in path as a DataFrame
+    If key is provided and differs from the one of the cache, returns None (cache is stale)
+    If columns is None, all the columns are loaded
+    If mmap, the numeric columns are memory-mapped instead of read in memory (read-only,
+    or mmap='c' for copy-on-write columns : they can be modified in memory, the cache is not changed)
+    """
+    manifest = ReadManifest(path)
+    if manifest is None:
+        return None
+    if key is not None and manifest['key'] != key:
+        logging.info('Cache %s has been produced with another configuration, will not be used'%path)
+        return None
+
+    dict_columns = {c['name']:c for c in manifest['columns']}
+    if columns is None:
+        columns = [c['name'] for c in manifest['columns']]
+    missing = [col for col in columns if col not in dict_columns.keys()]
+    if len(missing) != 0:
+        logging.warning('Columns %s not found in cache %s'%(','.join(missing),path))
+        return None
+
+    data = {}
+    for col in columns:
+        arr = np.load(os.path.join(path,dict_columns[col]['file']),mmap_mode=('r' if mmap is True else mmap) if mmap else None)
+        if arr.dtype.kind == 'U':
+            arr = arr.astype(object)
+            if dict_columns[col]['categorical']:
+                arr = pd.Categorical(arr)
+        data[col] = arr
+    df = pd.DataFrame(data,columns=columns,copy=False)
+    logging.debug('Cache loaded from %s (%d columns, %d rows)'%(path,df.shape[1],df.shape[0]))
+    return df
+
+###############################################################################
+# IncrementalCache #
+###############################################################################
+
+def IncrementalCache(path,config,list_files,import_function,config_files=[],checksum=False):
+    """
+    Cache of data imported file by file, each row must have the file name (without .root) in column 'sample'
+    The manifest records the configuration and the fingerprint of each file
+        - if the configuration (or config_files) changed, all the files are imported again
+        - otherwise only the new or modified files are imported with import_function(list_of_files) and merged into the cache
+    The rows are always ordered as in list_files, as if they had been imported in one go
+    (import_function must produce the rows of a file independently of the other files, as LoopOverTrees)
+    """
+    provenance = {'config':config,'config_files':Fingerprints(config_files,checksum)}
+    key = CacheKey(provenance)
+    fingerprints = Fingerprints(list_files,checksum)
+
+    # Find what needs to be imported #
+    manifest = ReadManifest(path)
+    if manifest is None or manifest['key'] != key:
+        if manifest is not None:
+            logging.info('Configuration of cache %s has changed, will import all the files again'%path)
+        cached = None
+        to_import = list_files
+    else:
+        cached_fingerprints = manifest['provenance']['files']
+        to_import = [f for f in list_files if f not in cached_fingerprints.keys() or cached_fingerprints[f] != fingerprints[f]]
+        if len(to_import) == 0 and set(cached_fingerprints.keys()) == set(list_files):
+            logging.info('Cache %s is up to date'%path)
+            return LoadCache(path,mmap=False)
+        cached = LoadCache(path,mmap=False)
+        logging.info('Cache %s : %d files out of %d need to be imported again'%(path,len(to_import),len(list_files)))
+        for f in to_import:
+            logging.debug('... %s'%f)
+
+    # Import and merge #
+    samples = [os.path.basename(f).replace('.root','') for f in list_files]
+    list_df = []
+    if cached is not None and cached.shape[0] != 0: # Keep the rows of files that are still valid
+        reimported = [os.path.basename(f).replace('.root','') for f in to_import]
+        list_df.append(cached[cached['sample'].isin(samples) & ~cached['sample'].isin(reimported)])
+    if len(to_import) != 0:
+        list_df.append(import_function(to_import))
+    list_df = [df for df in list_df if df.shape[0] != 0]
+    if len(list_df) == 0:
+        df = pd.DataFrame()
+    else:
+        df = ConcatFrames(list_df)
+        # Put back the rows in the order of the files (stable sort keeps the order inside each file) #
+        position = df['sample'].astype(object).map({sample:i for i,sample in enumerate(samples)}).to_numpy(dtype=np.int64)
+        df = df.iloc[np.argsort(position,kind='stable')].reset_index(drop=True)
+
+    provenance['files'] = fingerprints
+    SaveCache(df,path,key=key,provenance=provenance)
+    return df
+
+###############################################################################
+# CacheWriter #
+###############################################################################
+
+class CacheWriter:
+    """
+    Writes a cache chunk by chunk, when the full DataFrame does not fit in memory
+    The column files are preallocated for n_rows and memory-mapped, each chunk is written at its position with write(df,start)
+    The manifest is only written by close(), and the directory moved to path, so that an unfinished cache is never used
+        dtypes : list of (column name, numpy dtype, categorical), see ColumnDtypes
+    """
+    def __init__(self,path,n_rows,dtypes):
+        self.path = path
+        self.n_rows = n_rows
+        self.tmp_path = path+'.tmp%d'%os.getpid()
+        if os.path.exists(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        os.makedirs(self.tmp_path)
+        self.columns = []
+        self.arrays = {}
+        for i,(col,dtype,categorical) in enumerate(dtypes):
+            filename = 'col_%d.npy'%i
+            self.arrays[col] = np.lib.format.open_memmap(os.path.join(self.tmp_path,filename),mode='w+',dtype=dtype,shape=(n_rows,))
+            self.columns.append({'name':str(col),'file':filename,'dtype':np.dtype(dtype).str,'categorical':categorical})
+
+    def write(self,df,start):
+        # Write the rows of df at position start #
+        for col,arr in self.arrays.items():
+            arr[start:start+df.shape[0]] = ColumnArray(df[col])
+        logging.debug('Cache %s : rows %d to %d written'%(self.path,start,start+df.shape[0]))
+
+    def close(self,key=None,provenance=None):
+        for arr in self.arrays.values():
+            arr.flush()
+        self.arrays = {}
+        manifest = {'key':key,'provenance':provenance,'n_rows':int(self.n_rows),'columns':self.columns}
+        with open(os.path.join(self.tmp_path,MANIFEST),'w') as handle:
+            json.dump(manifest,handle,indent=4,default=str)
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.rename(self.tmp_path,self.path)
+        logging.debug('Cache saved in %s (%d columns, %d rows)'%(self.path,len(self.columns),self.n_rows))
+
+###############################################################################
+# ColumnDtypes #
+###############################################################################
+
+def ColumnDtypes(df):
+    """
+    Returns the (name, dtype, categorical) of the columns of df as saved in the cache, to be used by CacheWriter
+    For strings, the width is the longest string in df
+    """
+    return [(col,ColumnArray(df[col]).dtype,isinstance(df[col].dtype,pd.CategoricalDtype)) for col in df.columns]
+
+###############################################################################
+# MergeCaches #
+###############################################################################
+
+def MergeCaches(list_paths,path,key=None,provenance=None,remove=True):
+    """
+    Concatenates the caches in list_paths (same columns) into the cache path, one part at a time
+    Only one part is in memory at once, the dtypes are promoted as in pd.concat (eg, longest string)
+    If remove, the parts are deleted afterwards
+    """
+    manifests = [ReadManifest(p) for p in list_paths]
+    n_rows = sum([manifest['n_rows'] for manifest in manifests])
+    dtypes = []
+    for i,column in enumerate(manifests[0]['columns']):
+        dtype = np.result_type(*[np.dtype(manifest['columns'][i]['dtype']) for manifest in manifests])
+        dtypes.append((column['name'],dtype,column['categorical']))
+    writer = CacheWriter(path,n_rows,dtypes)
+    start = 0
+    for p,manifest in zip(list_paths,manifests):
+        writer.write(LoadCache(p),start)
+        start += manifest['n_rows']
+    writer.close(key=key,provenance=provenance)
+    if remove:
+        for p in list_paths:
+            shutil.rmtree(p)
+
+###############################################################################
+# ConcatFrames #
+###############################################################################
+
+def ConcatFrames(list_df):
+    """
+    pd.concat of the frames (index ignored), the categorical columns stay categorical
+    (pandas converts them to objects when the categories differ between the frames)
+    """
+    list_df = [df for df in list_df if df is not None]
+    if len(list_df) == 0:
+        return pd.DataFrame()
+    categorical = [col for col in list_df[0].columns if all([col in df.columns and isinstance(df[col].dtype,pd.CategoricalDtype) for df in list_df])]
+    if len(categorical) != 0:
+        list_df = [df.copy(deep=False) for df in list_df] # Do not modify the frames of the caller
+        for col in categorical:
+            categories = pd.api.types.union_categoricals([df[col] for df in list_df]).categories
+            for df in list_df:
+                df[col] = df[col].cat.set_categories(categories)
+    return pd.concat(list_df,axis=0,ignore_index=True)
@@ -5,50 +5,158 @@ import math
 import logging
 import pickle
 import copy
+import threading
+import collections
+import concurrent.futures
 
 import numpy as np
 import keras
 
 import ROOT
 
-from root_numpy import root2array, rec2array
+from root_numpy import root2array, tree2array, rec2array
 
 class WeightsGenerator():
+    """
+    Produces the event weights from a 1D or 2D histogram "weights" as a function of the outputs
+    The histogram is converted once to numpy arrays, the bins are then found in a vectorized way 
+    with the same arithmetic as TAxis::FindBin so that the weights are the same as with ROOT
+    """
     def __init__(self,path_hist):
         root_file = ROOT.TFile(path_hist,"READ")
         self.hist = copy.deepcopy(root_file.Get("weights"))
         root_file.Close()
-        self.tot_time = 0
-#        self.hist_time = ROOT.TH1F("weight_time","weight_time",1000,0,5)
+        self.fromHistToArrays()
 
-    def fromHistToDict(self):
-        self.weightDict = {}
+    def fromHistToArrays(self):
+        self.dim = self.hist.GetDimension()
+        if self.dim > 2:
+            raise ValueError("Weights histogram must be 1D or 2D")
+        axes = [self.hist.GetXaxis(),self.hist.GetYaxis()][:self.dim]
+        self.axes = []
+        for axis in axes:
+            self.axes.append({'nbins'   : axis.GetNbins(),
+                              'xmin'    : axis.GetXmin(),
+                              'xmax'    : axis.GetXmax(),
+                              'fixed'   : axis.GetXbins().GetSize() == 0,
+                              'edges'   : np.array([axis.GetBinLowEdge(i) for i in range(1,axis.GetNbins()+2)])})
+        # Contents of all the bins (including under and overflow), indexed by global bin number #
+        self.contents = np.array([self.hist.GetBinContent(i) for i in range(self.hist.GetNcells())])
+        self.nbinsX = self.hist.GetNbinsX()
+
+    @staticmethod
+    def findBins(axis,x):
+        # Same as TAxis::FindBin : 0 = underflow, nbins+1 = overflow (also NaN) #
+        x = np.asarray(x,dtype=np.float64)
+        bins = np.empty(x.shape[0],dtype=np.int64)
+        underflow = x < axis['xmin']
+        overflow = ~(x < axis['xmax']) & ~underflow
+        inside = ~(underflow | overflow)
+        bins[underflow] = 0
+        bins[overflow] = axis['nbins']+1
+        if axis['fixed']:
+            bins[inside] = 1 + (axis['nbins']*(x[inside]-axis['xmin'])/(axis['xmax']-axis['xmin'])).astype(np.int64)
+        else:
+            bins[inside] = np.searchsorted(axis['edges'],x[inside],side='right')
+        return bins
 
     def getWeights(self,arr):
-        weights = np.zeros(arr.shape[0])
-        import timeit
-        start_time = timeit.default_timer()
-        for i in range(0,arr.shape[0]):
-            hist_bin = self.hist.FindBin(arr[i])
-            if hist_bin < self.hist.GetNbinsX() and hist_bin >= 0:
-                weights[i] = self.hist.GetBinContent(hist_bin)
-            else: # If we are in the under/overflow bin
-                weights[i] = 1
+        arr = np.asarray(arr)
+        if arr.ndim == 1:
+            arr = arr.reshape(-1,1)
+        # Global bin as in TH1::FindBin #
+        hist_bin = self.findBins(self.axes[0],arr[:,0])
+        if self.dim == 2:
+            hist_bin += (self.axes[0]['nbins']+2)*self.findBins(self.axes[1],arr[:,1])
+        # If we are in the under/overflow bin -> 1 #
+        # Note : the condition on the global bin number is the one used so far (also for 2D) to keep the same weights
+        valid = (hist_bin < self.nbinsX) & (hist_bin >= 0)
+        weights = np.ones(arr.shape[0])
+        weights[valid] = self.contents[hist_bin[valid]]
         # Normalize weights (learning becomes unstable otherwise #
         weights /= np.sum(weights)
-        #elapsed = timeit.default_timer() - start_time
-        #self.tot_time += elapsed
-        #print("Weights evaluated on ",elapsed,"Total time for weight generation ",self.tot_time)
         return weights
         
 
+class TreeHandlePool():
+    """
+    Keeps the ROOT files open so that the trees are not opened again at each read
+    The handles are specific to a process : after a fork (eg, keras workers) they are opened again
+    """
+    def __init__(self,treename='tree'):
+        self.treename = treename
+        self.handles = {}
+        self.pid = os.getpid()
+
+    def get(self,filename):
+        if self.pid != os.getpid(): 
+            self.handles = {}
+            self.pid = os.getpid()
+        if filename not in self.handles.keys():
+            root_file = ROOT.TFile.Open(filename)
+            self.handles[filename] = (root_file,root_file.Get(self.treename))
+        return self.handles[filename][1]
+
+    def entries(self,filename):
+        return self.get(filename).GetEntries()
+
+    def close(self):
+        for root_file,_ in self.handles.values():
+            root_file.Close()
+        self.handles = {}
+
+    def __getstate__(self): # ROOT objects cannot be pickled
+        return {'treename':self.treename}
+
+    def __setstate__(self,state):
+        self.__init__(state['treename'])
+
+
+def GeneratorWorkers(workers):
+    """
+    Number of keras workers for the DataGenerator : the chunks are read in order by a single worker
+    (with several workers, each process would read and prefetch the same chunks again)
+    The reads are overlapped with the training by the prefetch thread and the keras queue instead
+    """
+    if workers > 1:
+        logging.warning("The DataGenerator reads its chunks in order, keras will use 1 worker instead of %d (parameters.workers)"%workers)
+    return min(workers,1)
+
 
 class DataGenerator(keras.utils.Sequence):
-    def __init__(self,path,inputs,outputs,batch_size=32,state_set='',weights_generator=''):
+    """
+    Produces the batches from root files, each batch contains events from all files in the same proportions
+    The files are kept open and chunk_batches batches are read at once (inputs and outputs together)
+    If prefetch, the next chunk is read in a background thread while the current one is used
+    Reading in chunks assumes the batches are requested in order (eg, keras shuffle=False, single worker, see GeneratorWorkers)
+    If shuffle, at each epoch the order of the chunks and the order of the events inside each chunk (per file) are permuted
+    The permutations only depend on (seed, epoch, chunk) : the reads stay contiguous, the batches keep the file proportions
+    and the same seed gives the same batches in any process
+    If remainder, the last batch of each file can be smaller so that every event is used exactly once (eg, for predictions)
+    the batches at the end can then be smaller than batch_size (and from fewer files)
+    """
+    def __init__(self,path,inputs,outputs,batch_size=32,state_set='',weights_generator='',chunk_batches=1,prefetch=False,shuffle=False,seed=None,epoch=0,remainder=False):
         self.path       = path                          # Path to root file 
         self.inputs     = inputs                        # List of strings of the variables as inputs
         self.outputs    = outputs                       # List of strings of the variables as outputs
         self.batch_size = batch_size                    # Batch size
+        self.chunk_batches = chunk_batches              # Number of batches read at once from each file
+        self.prefetch   = prefetch                      # Whether to read the next chunk in a background thread
+        self.shuffle    = shuffle                       # Whether to shuffle the chunks and events at each epoch
+        self.seed       = seed if seed is not None else np.random.randint(2**31-1) # Drawn once so that all processes agree
+        self.epoch      = epoch                         # Starting epoch (for resumed trainings, to get the same permutations)
+        self.remainder  = remainder                     # Whether to produce the partial batches with the last events
+        self.branches   = list(collections.OrderedDict.fromkeys(self.inputs+self.outputs)) # Read once if in inputs and outputs
+        self.idx_inputs = [self.branches.index(b) for b in self.inputs]
+        self.idx_outputs = [self.branches.index(b) for b in self.outputs]
+        self.handles    = TreeHandlePool('tree')
+        self.chunks     = collections.OrderedDict()     # Chunks in memory {chunk index : {file : array}}
+        self.futures    = {}                            # Chunks being read in background {chunk index : future}
+        self.lock       = threading.Lock()
+        self.executor   = None
+        self.executor_pid = None
+        if self.prefetch:
+            ROOT.ROOT.EnableThreadSafety()
         if os.path.isdir(path):
             self.list_files = glob.glob(path+'/*.root') # List of files obtained from path
         elif os.path.isfile(path):
@@ -72,20 +180,18 @@ class DataGenerator(keras.utils.Sequence):
         self.max        = self.__len__() # Must be after get_fractions because that's where self.n_batches is defined
 
     def get_fractions(self):
-        entries = dict() # fraction inside each dataset compared to total
+        self.entries = entries = dict() # fraction inside each dataset compared to total
         self.batch_sample = dict() # number of events in each dataset that will enter the batch
         self.pointer = dict()  # Keep memory of how far we have extracted the chunk
         # Compute entries #
         self.n_tot = 0
         for f in self.list_files:
-            rootFile = ROOT.TFile(f)
-            tree = rootFile.Get('tree')
-            n = tree.GetEntries()
+            n = self.handles.entries(f)
             logging.info("Number of entries of file %s : %d"%(f,n))
             entries[f] = n
             self.n_tot += n
 
-        if self.n_tot<self.batch_size:
+        if self.n_tot<self.batch_size and not self.remainder:
             logging.error("Fewer events than required batch size for generator")
             sys.exit(1)
 
@@ -100,28 +206,101 @@ class DataGenerator(keras.utils.Sequence):
             key, value = max(self.batch_sample.items(), key = lambda p: p[1])
             self.batch_sample[key] -= (total_in_batch - self.batch_size)
         # Get maximum number of batches #
-        self.n_batches = np.inf
-        for filename,n_entries in entries.items():
-            size = self.batch_sample[filename]
-            if n_entries//size < self.n_batches : 
-                self.n_batches = n_entries//size
+        if self.remainder: # Until the last event of the longest file, shorter files contribute empty parts at the end
+            self.n_batches = max([int(math.ceil(n_entries/self.batch_sample[filename])) for filename,n_entries in entries.items() if self.batch_sample[filename]>0])
+        else:
+            self.n_batches = np.inf
+            for filename,n_entries in entries.items():
+                size = self.batch_sample[filename]
+                if n_entries//size < self.n_batches : 
+                    self.n_batches = n_entries//size
+
+        self.n_chunks = int(math.ceil(self.n_batches/self.chunk_batches))
+        self.chunk_sizes = np.minimum(self.chunk_batches,self.n_batches-np.arange(self.n_chunks)*self.chunk_batches) # Batches in each chunk
+        self.set_epoch_order()
 
         logging.info("Total number of events : %d"%(self.n_tot))
         logging.info("Will use %d batches of %d events"%(self.n_batches,self.batch_size))
         logging.info("="*80)
 
+    def set_epoch_order(self):
+        # Order of the chunks for the current epoch #
+        if self.shuffle:
+            self.chunk_order = np.random.RandomState([self.seed,self.epoch]).permutation(self.n_chunks)
+        else:
+            self.chunk_order = np.arange(self.n_chunks)
+        self.chunk_ends = np.cumsum(self.chunk_sizes[self.chunk_order]) # The last chunk can be smaller and be anywhere
+
+    def locate(self,index):
+        # Returns the position in the epoch, the chunk and the batch inside the chunk of the batch index #
+        position = int(np.searchsorted(self.chunk_ends,index,side='right'))
+        chunk = int(self.chunk_order[position])
+        return position, chunk, index-(self.chunk_ends[position]-self.chunk_sizes[chunk])
+
+    def read_chunk(self,chunk,epoch=0):
+        # Reads the events of the batches in the chunk for each file #
+        data = {}
+        for i,(f,size) in enumerate(self.batch_sample.items()):
+            size = int(size) # For python2
+            start = chunk*self.chunk_batches*size
+            stop = min((chunk+1)*self.chunk_batches,self.n_batches)*size
+            if self.remainder:
+                stop = min(stop,self.entries[f])
+            if start >= stop: # File already exhausted
+                data[f] = np.zeros((0,len(self.branches)))
+                continue
+            data[f] = rec2array(tree2array(self.handles.get(f),branches=self.branches,start=start,stop=stop))
+            if self.shuffle: # Events of a file only move inside the chunk, the batches keep the proportions
+                data[f] = data[f][np.random.RandomState([self.seed,epoch,chunk,i]).permutation(data[f].shape[0])]
+            logging.debug("%s    - Read chunk %d (%d entries) from file %s"%(self.state_set,chunk,stop-start,os.path.basename(f)))
+        return data
+
+    def get_chunk(self,position,chunk):
+        # Returns the chunk from memory, from the background thread or reads it #
+        with self.lock:
+            if self.executor_pid != os.getpid(): # Threads do not survive a fork
+                # The reads of the parent are not running in this process (and its tree handles are opened again),
+                # the futures are only dropped : waiting for them would never return
+                for future in self.futures.values():
+                    future.cancel()
+                self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1) if self.prefetch else None
+                self.executor_pid = os.getpid()
+                self.futures = {}
+            if chunk not in self.chunks.keys():
+                if chunk in self.futures.keys():
+                    self.chunks[chunk] = self.futures.pop(chunk).result()
+                else:
+                    self.chunks[chunk] = self.read_chunk(chunk,self.epoch)
+                while len(self.chunks) > 2: # Only keep the current and previous chunks
+                    self.chunks.popitem(last=False)
+            # Prefetch the next chunk of the epoch #
+            if self.prefetch and position+1 < self.n_chunks:
+                next_chunk = int(self.chunk_order[position+1])
+                if next_chunk not in self.chunks.keys() and next_chunk not in self.futures.keys():
+                    self.futures[next_chunk] = self.executor.submit(self.read_chunk,next_chunk,self.epoch)
+            return self.chunks[chunk]
+
     def __getitem__(self,index): # gets the batch for the supplied index
         # return a tuple (numpy array of image, numpy array of labels) or None at epoch end
         logging.debug("-"*80)
         logging.debug("New batch importation")
-        X = np.zeros((self.batch_size,len(self.inputs)))
-        Y = np.zeros((self.batch_size,len(self.outputs)))
+        position, chunk, batch = self.locate(index)
+        data = self.get_chunk(position,chunk)
+        if self.remainder: # Last batches can be partial
+            n_rows = sum([max(0,min(data[f].shape[0]-batch*int(size),int(size))) for f,size in self.batch_sample.items()])
+        else:
+            n_rows = self.batch_size
+        X = np.zeros((n_rows,len(self.inputs)))
+        Y = np.zeros((n_rows,len(self.outputs)))
         pointer = 0
 
         for f,size in self.batch_sample.items():
             size = int(size) # For python2
-            X[pointer:pointer+size,:]= rec2array(root2array(f,treename='tree',branches=self.inputs,start=index*size,stop=(index+1)*size))
-            Y[pointer:pointer+size,:] = rec2array(root2array(f,treename='tree',branches=self.outputs,start=index*size,stop=(index+1)*size))
+            offset = batch*size
+            if self.remainder:
+                size = max(0,min(data[f].shape[0]-offset,size))
+            X[pointer:pointer+size,:] = data[f][offset:offset+size,self.idx_inputs]
+            Y[pointer:pointer+size,:] = data[f][offset:offset+size,self.idx_outputs]
             pointer += size
             logging.debug("%s    - Added %d entries from file %s"%(self.state_set,size,os.path.basename(f)))
 
@@ -136,7 +315,34 @@ class DataGenerator(keras.utils.Sequence):
         return self.n_batches
     def on_epoch_end(self): # performs auto shuffle if enabled
         # Do what we need to do between epochs
-        pass
+        with self.lock:
+            self.epoch += 1
+            if self.shuffle: # Chunks in memory or being read have the permutations of the previous epoch
+                self.chunks = collections.OrderedDict()
+                self.drain_futures()
+                self.set_epoch_order()
+
+    def drain_futures(self):
+        # Cancels the reads not started and waits for the running one, so that it does not read the trees with the next one #
+        for future in self.futures.values():
+            future.cancel()
+        if self.executor_pid == os.getpid(): # After a fork, the read of the parent does not run in this process
+            concurrent.futures.wait(list(self.futures.values())) # Errors of the stale reads are not raised
+        self.futures = {}
+
+    def __getstate__(self): # Threads, locks and chunks are not sent to other processes
+        state = self.__dict__.copy()
+        for key in ['chunks','futures','lock','executor']:
+            del state[key]
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self.chunks = collections.OrderedDict()
+        self.futures = {}
+        self.lock = threading.Lock()
+        self.executor = None
+        self.executor_pid = None
 
     def __next__(self):
         if self.n >= self.max:
@@ -144,3 +350,62 @@ class DataGenerator(keras.utils.Sequence):
         result = self.__getitem__(self.n)
         self.n += 1
         return result
+
+
+class ParametrizedGenerator(keras.utils.Sequence):
+    """
+    Produces the batches from a ParametrizedView (signal_coupling.py) : the decoupled rows are built batch by batch
+    so that the events are never repeated in memory for each mass point
+        inputs, outputs : columns of the view used as inputs and outputs
+        weight          : column of the view used as sample weight (optional)
+    If shuffle, at each epoch the events are permuted and each event gets a random mass point offset (drawn from (seed, epoch)) :
+    the rows are visited as n_weights passes over the permuted events, event e taking mass point (pass+offset[e]) % n_weights
+    Each row is used once per epoch, the batches mix events and mass points and only O(events) is stored (not events x mass points)
+    The last batch can be smaller
+    Not used by the models of Model.py yet : their evaluation, scaler and outputs expect one row per event with the inputs only,
+    a decoupled model (inputs + mH_MEM, mA_MEM -> weight of the mass point) needs them adapted first
+    """
+    def __init__(self,view,inputs,outputs,batch_size=32,weight=None,shuffle=False,seed=None,epoch=0):
+        self.view       = view
+        self.inputs     = inputs
+        self.outputs    = outputs
+        self.weight     = weight
+        self.batch_size = batch_size
+        self.shuffle    = shuffle
+        self.seed       = seed if seed is not None else np.random.randint(2**31-1)
+        self.epoch      = epoch
+        self.n_rows     = len(view)
+        self.n_batches  = int(math.ceil(self.n_rows/self.batch_size))
+        self.set_epoch_order()
+        logging.info("Parametrized generator : %d events x %d mass points, %d batches of %d rows"%(view.n_events,view.n_weights,self.n_batches,self.batch_size))
+
+    def set_epoch_order(self):
+        # Permutation of the events and mass point offsets of the current epoch #
+        if self.shuffle:
+            rng = np.random.RandomState([self.seed,self.epoch])
+            self.event_order = rng.permutation(self.view.n_events)
+            self.mass_offset = rng.randint(0,self.view.n_weights,size=self.view.n_events)
+        else:
+            self.event_order = None
+            self.mass_offset = None
+
+    def __getitem__(self,index):
+        k = np.arange(index*self.batch_size,min((index+1)*self.batch_size,self.n_rows),dtype=np.int64)
+        if self.event_order is None:
+            indices = k
+        else: # Row k is the event k % n_events of the permutation, in the pass k // n_events
+            events = self.event_order[k%self.view.n_events]
+            indices = events*self.view.n_weights+(k//self.view.n_events+self.mass_offset[events])%self.view.n_weights
+        X = self.view.array(self.inputs,indices)
+        Y = self.view.array(self.outputs,indices)
+        if self.weight is None:
+            return X,Y
+        else:
+            return X,Y,self.view.column(self.weight,indices)
+
+    def __len__(self):
+        return self.n_batches
+
+    def on_epoch_end(self):
+        self.epoch += 1
+        self.set_epoch_order()
@@ -0,0 +1,163 @@
+import os
+import shutil
+import logging
+import tempfile
+import traceback
+import multiprocessing
+
+import numpy as np
+
+# Personal files #
+import parameters
+
+# Variables set in each worker process by InitWorker #
+_worker = {}
+
+#################################################################################################
+# EvaluateModels #
+#################################################################################################
+def EvaluateModels(models,x_val=None,y_val=None,generator=False,workers=1,callback=None):
+    """
+    Computes the evaluation error of the models, given as a list of (json,weights) as saved by talos
+        - classic : f1 score of the predictions on x_val,y_val (last column of y_val is the weight, not used), mean and std over 5 folds (as Autom8)
+        - generator : loss on the evaluation DataGenerator (std is 0)
+    The models are spread over workers processes (spawn, each with cpu_count/workers threads).
+    The evaluation data is loaded once per process : the classic arrays are memory-mapped from npy files
+    (the ones of the shared arrays if x_val,y_val come from shared_data.py) and the generator is reused for all the models.
+    callback(i,mean,std) is called as soon as model i has been evaluated
+    Returns the arrays of means and stds
+    """
+    means = np.full(len(models),np.nan)
+    stds = np.full(len(models),np.nan)
+    workers = max(1,min(workers,len(models)))
+    if multiprocessing.current_process().daemon: # Inside a worker of LocalScan, cannot start processes
+        workers = 1
+
+    # Evaluation data #
+    path_tmp = None
+    if generator:
+        paths = None
+    elif workers == 1:
+        paths = (x_val,y_val) # Used directly
+    elif all(IsMappedFile(arr) for arr in (x_val,y_val)):
+        paths = (x_val.filename,y_val.filename)
+    else:
+        path_tmp = tempfile.mkdtemp(prefix='ZAMachineLearning_eval_',dir=parameters.shared_path)
+        paths = (os.path.join(path_tmp,'x_val.npy'),os.path.join(path_tmp,'y_val.npy'))
+        np.save(paths[0],x_val)
+        np.save(paths[1],y_val)
+
+    try:
+        if workers == 1:
+            InitWorker(paths,generator,threads=None)
+            results = map(EvaluateTask,enumerate(models))
+            for i,mean,std,message in results:
+                RecordResult(i,mean,std,message,means,stds,callback)
+        else:
+            from local_scan import ThreadEnvironment
+            threads = max(1,multiprocessing.cpu_count()//workers)
+            logging.info('Evaluation of %d models with %d workers (%d threads each)'%(len(models),workers,threads))
+            context = multiprocessing.get_context('spawn')
+            with ThreadEnvironment(threads), \
+                 context.Pool(processes=workers,initializer=InitWorker,initargs=(paths,generator,threads)) as pool:
+                for i,mean,std,message in pool.imap_unordered(EvaluateTask,enumerate(models)):
+                    RecordResult(i,mean,std,message,means,stds,callback)
+    finally:
+        _worker.clear()
+        if path_tmp is not None:
+            shutil.rmtree(path_tmp)
+    return means,stds
+
+#################################################################################################
+# IsMappedFile #
+#################################################################################################
+def IsMappedFile(arr):
+    """ Whether arr is a whole npy file memory-mapped (and not a slice of it) """
+    if not isinstance(arr,np.memmap) or arr.filename is None or not arr.filename.endswith('.npy'):
+        return False
+    return np.load(arr.filename,mmap_mode='r').shape == arr.shape
+
+#################################################################################################
+# RecordResult #
+#################################################################################################
+def RecordResult(i,mean,std,message,means,stds,callback):
+    """ Saves the result of model i and calls the callback """
+    if message != '':
+        logging.error('Evaluation of model %d failed : %s'%(i,message))
+        return
+    means[i] = mean
+    stds[i] = std
+    logging.info('Model %d : evaluation error %f (+/- %f)'%(i,mean,std))
+    if callback is not None:
+        callback(i,mean,std)
+
+#################################################################################################
+# InitWorker #
+#################################################################################################
+def InitWorker(paths,generator,threads=None):
+    """ Initialization of a worker process : thread limits and evaluation data kept for all the models """
+    if threads is not None: # Spawned process
+        logging.basicConfig(level=logging.INFO,format='%(asctime)s - %(processName)s - %(levelname)s - %(message)s')
+        from local_scan import SetThreads
+        SetThreads(threads)
+    if generator:
+        from data_generator import DataGenerator
+        _worker['generator'] = DataGenerator(path = parameters.path_gen_evaluation,
+                                             inputs = parameters.inputs,
+                                             outputs = parameters.outputs,
+                                             batch_size = parameters.p['batch_size'][0],
+                                             state_set = 'evaluation',
+                                             chunk_batches = parameters.generator_chunk_batches,
+                                             prefetch = parameters.generator_prefetch)
+    else:
+        x_val,y_val = paths
+        if isinstance(x_val,str):
+            x_val = np.load(x_val,mmap_mode='r')
+            y_val = np.load(y_val,mmap_mode='r')
+        _worker['x_val'] = x_val
+        _worker['y_val'] = y_val
+
+#################################################################################################
+# EvaluateTask #
+#################################################################################################
+def EvaluateTask(args):
+    """ Evaluation of one model, returns (i,mean,std,message) """
+    i,(model_json,weights) = args
+    try:
+        from keras.models import model_from_json
+        from keras.optimizers import Adam
+        from preprocessing import PreprocessLayer
+        from data_generator import GeneratorWorkers
+        model = model_from_json(model_json,custom_objects={'PreprocessLayer': PreprocessLayer})
+        model.set_weights(weights)
+        if 'generator' in _worker:
+            model.compile(optimizer=Adam(),loss={'OUT':parameters.p['loss_function'][0]},metrics=['accuracy'])
+            eval_metric = model.evaluate_generator(generator           = _worker['generator'],
+                                                   workers             = GeneratorWorkers(parameters.workers),
+                                                   use_multiprocessing = False) # Also works inside a daemonic process
+            mean,std = eval_metric[0],0.
+        else:
+            scores = FoldScores(model,_worker['x_val'],_worker['y_val'][:,:-1])
+            mean,std = np.mean(scores),np.std(scores)
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        return i,np.nan,np.nan,str(e)
+    return i,mean,std,''
+
+#################################################################################################
+# FoldScores #
+#################################################################################################
+def FoldScores(model,x_val,y_val,folds=5,average='micro'):
+    """
+    F1 scores (in percent) of the model on folds of the shuffled evaluation set, as talos Evaluate
+    The predictions are thresholded at 0.5, the remaining events after the equal folds are not used
+    """
+    from sklearn.metrics import f1_score
+    index = np.random.permutation(x_val.shape[0])
+    step = x_val.shape[0]//folds
+    scores = []
+    for k in range(folds):
+        idx = np.sort(index[k*step:(k+1)*step]) # Sorted for contiguous reads of the memory-mapped arrays
+        y_pred = model.predict(x_val[idx],batch_size=parameters.output_batch_size) >= 0.5
+        scores.append(f1_score(y_val[idx] >= 0.5,y_pred,average=average)*100)
+    return scores
@@ -0,0 +1,155 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+# Event matching #
+# The events of two trees are matched on their integer keys (eg, run, luminosityBlock and event) with a hash index :
+# the keys of the reference events are indexed once (pandas MultiIndex), the events of the other tree are then
+# looked up chunk by chunk, so that only the keys of the reference tree are in memory
+
+DEFAULT_INDEX = ['run','luminosityBlock','event']
+N_EXAMPLES = 5 # Number of example keys kept in the report
+
+###############################################################################
+# EventKeys #
+###############################################################################
+
+def EventKeys(data,index):
+    """
+    Returns the list of the key columns of data (DataFrame or record array) as int64 arrays
+    Float columns are accepted only if all their values are integers (eg, tree saved with float64), otherwise raises
+    """
+    keys = []
+    for col in index:
+        arr = np.asarray(data[col])
+        if arr.dtype.kind in 'iub':
+            keys.append(arr.astype(np.int64))
+        elif arr.dtype.kind == 'f':
+            if not np.all(np.isfinite(arr)) or np.any(arr != np.round(arr)) or np.any(np.abs(arr) >= 2**53):
+                raise ValueError('Key %s has values that are not integers, the events cannot be matched'%col)
+            logging.warning('Key %s is saved as float, converted to integer'%col)
+            keys.append(arr.astype(np.int64))
+        else:
+            raise TypeError('Key %s has type %s, the events can only be matched on integers'%(col,arr.dtype))
+    return keys
+
+###############################################################################
+# MatchReport #
+###############################################################################
+
+class MatchReport:
+    """ Counts of the matched, unmatched and duplicate events between the reference and the other tree, with a few example keys """
+    def __init__(self,index,n_reference):
+        self.index = index
+        self.n_reference = n_reference
+        self.n_other = 0
+        self.matched = 0                # Reference events found in the other tree
+        self.unmatched_reference = 0    # Reference events not in the other tree
+        self.unmatched_other = 0        # Other events not in the reference tree
+        self.duplicates_reference = 0   # Reference events with the same key as a previous one
+        self.duplicates_other = 0       # Other events with the same key as a previous one (not used)
+        self.examples = {}
+
+    def AddExamples(self,category,keys,selection):
+        """ Keeps up to N_EXAMPLES keys of the selected events for the category """
+        examples = self.examples.setdefault(category,[])
+        for i in np.nonzero(selection)[0][:N_EXAMPLES-len(examples)]:
+            examples.append(tuple(int(k[i]) for k in keys))
+
+    def __str__(self):
+        lines = ['Event matching on (%s)'%', '.join(self.index),
+                 ('Reference events ').ljust(40,'.')+' %d'%self.n_reference,
+                 ('Other events ').ljust(40,'.')+' %d'%self.n_other,
+                 ('Matched reference events ').ljust(40,'.')+' %d'%self.matched]
+        for name,attr in [('Unmatched reference events','unmatched_reference'),
+                          ('Unmatched other events','unmatched_other'),
+                          ('Duplicate reference events','duplicates_reference'),
+                          ('Duplicate other events','duplicates_other')]:
+            lines.append(('%s '%name).ljust(40,'.')+' %d'%getattr(self,attr))
+            if getattr(self,attr) != 0 and attr in self.examples:
+                lines.append('\teg : '+', '.join(str(key) for key in self.examples[attr]))
+        return '\n'.join(lines)
+
+###############################################################################
+# EventMatcher #
+###############################################################################
+
+class EventMatcher:
+    """
+    Hash index of the reference events, to match the events of another tree chunk by chunk
+        - keys : key columns of the reference events (see EventKeys)
+        - index : names of the keys
+    The reference events with the same key share the same position (inverse gives the position of each reference event)
+    match is called on each chunk of the other tree, it returns the position of each of its events (-1 if not matched
+    or if the key has already been matched, only the first event of the other tree with a given key is used)
+    report returns the MatchReport once all the chunks have been matched
+    """
+    def __init__(self,keys,index=DEFAULT_INDEX):
+        self.index = list(index)
+        self.inverse,self.unique = pd.MultiIndex.from_arrays(keys,names=self.index).factorize()
+        self.inverse = np.asarray(self.inverse)
+        self.seen = np.zeros(len(self.unique),dtype=bool)
+        self._report = MatchReport(self.index,self.inverse.shape[0])
+        self._report.duplicates_reference = self.inverse.shape[0]-len(self.unique)
+        if self._report.duplicates_reference != 0:
+            dup = np.ones(self.inverse.shape[0],dtype=bool)
+            dup[np.unique(self.inverse,return_index=True)[1]] = False # First event of each key
+            self._report.AddExamples('duplicates_reference',keys,dup)
+
+    def match(self,keys):
+        """ Positions of the events of the chunk (key columns) in the reference, -1 if not matched or already matched """
+        pos = np.asarray(self.unique.get_indexer(pd.MultiIndex.from_arrays(keys,names=self.index)))
+        found = pos >= 0
+        first = np.zeros(pos.shape[0],dtype=bool)
+        first[np.unique(pos,return_index=True)[1]] = True # First event of each key in the chunk
+        new = found & first
+        new[found] &= ~self.seen[pos[found]]
+        self.seen[pos[new]] = True
+
+        self._report.n_other += pos.shape[0]
+        self._report.unmatched_other += np.count_nonzero(~found)
+        self._report.duplicates_other += np.count_nonzero(found & ~new)
+        self._report.AddExamples('unmatched_other',keys,~found)
+        self._report.AddExamples('duplicates_other',keys,found & ~new)
+        pos[~new] = -1
+        return pos
+
+    def report(self):
+        """ Completes the report with the reference events that have not been matched """
+        matched = self.seen[self.inverse]
+        self._report.matched = int(np.count_nonzero(matched))
+        self._report.unmatched_reference = self._report.n_reference-self._report.matched
+        if self._report.unmatched_reference != 0 and 'unmatched_reference' not in self._report.examples:
+            pos = self.inverse[np.nonzero(~matched)[0][:N_EXAMPLES]]
+            keys = [np.asarray(self.unique.get_level_values(i))[pos] for i in range(len(self.index))]
+            self._report.AddExamples('unmatched_reference',keys,np.ones(pos.shape[0],dtype=bool))
+        return self._report
+
+###############################################################################
+# MatchEvents #
+###############################################################################
+
+def MatchEvents(keys_a,keys_b,index=DEFAULT_INDEX):
+    """
+    Matches the events of a in b (both in memory, key columns as for EventKeys)
+    Returns (idx_a,idx_b,report) : the indices of the events of a found in b and of their first match in b
+    (all the events of a with the same key are matched, they are counted as duplicates in the report)
+    """
+    matcher = EventMatcher(keys_b,index)
+    pos = np.asarray(matcher.unique.get_indexer(pd.MultiIndex.from_arrays(keys_a,names=matcher.index)))
+    first_b = np.full(len(matcher.unique),-1,dtype=np.int64)
+    first_b[matcher.inverse[::-1]] = np.arange(matcher.inverse.shape[0])[::-1] # First event of b for each key
+    idx_a = np.nonzero(pos >= 0)[0]
+    idx_b = first_b[pos[idx_a]]
+
+    # Report, with b as reference #
+    matcher.seen[pos[idx_a]] = True
+    report = matcher.report()
+    report.n_other = pos.shape[0]
+    report.unmatched_other = pos.shape[0]-idx_a.shape[0]
+    report.AddExamples('unmatched_other',keys_a,pos < 0)
+    dup_a = np.asarray(pd.MultiIndex.from_arrays(keys_a).duplicated())
+    report.duplicates_other = int(np.count_nonzero(dup_a))
+    report.AddExamples('duplicates_other',keys_a,dup_a)
+    return idx_a,idx_b,report
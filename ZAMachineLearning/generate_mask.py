@@ -3,10 +3,27 @@ import os
 import logging
 
 import parameters
+from data_cache import WriteProvenance, CheckProvenance
 
-def GenerateMask(N,name):
+def GenerateMask(N,name,provenance=None):
+    """
+    Generates the training/test mask (or imports it if it exists)
+    provenance is a dict describing the data (samples, ...), if the mask exists 
+    but was produced for another provenance or size it is generated again
+    """
     path_mask = os.path.join(parameters.main_path,'mask_'+name)
-    if not os.path.exists(path_mask+'.npy'):                     
+    if provenance is None:
+        provenance = {}
+    provenance = dict(provenance,N=N,ratio=parameters.training_ratio+parameters.evaluation_ratio)
+    stale = False
+    if os.path.exists(path_mask+'.npy'):
+        if os.path.exists(path_mask+'.json'):
+            stale = not CheckProvenance(path_mask+'.json',provenance)
+        else: # Mask produced before the provenance was recorded, only the size can be checked
+            stale = np.load(path_mask+'.npy',mmap_mode='r').shape[0] != N
+    if stale:
+        logging.warning('Mask %s.npy was produced for different data, will generate it again'%path_mask)
+    if not os.path.exists(path_mask+'.npy') or stale:                     
         mask = np.full((N,), False, dtype=bool)     
         size = parameters.training_ratio+parameters.evaluation_ratio
         mask[:int(size*N)] = True                         
@@ -14,10 +31,13 @@ def GenerateMask(N,name):
         np.random.shuffle(mask)                                     
         # Save #
         np.save(path_mask,mask)                                 
+        WriteProvenance(path_mask+'.json',provenance)
         logging.info('Mask not found at '+path_mask+' -> Has been generated')
     else:                                                        
         mask = np.load(path_mask+'.npy')     
         logging.info('Mask found at '+path_mask+'.npy')
+        if not os.path.exists(path_mask+'.json'):
+            WriteProvenance(path_mask+'.json',provenance)
 
     return mask
 
@@ -6,12 +6,17 @@ import json
 import re
 import collections
 import copy
+import functools
+import itertools
+import contextlib
 
 import array
+from multiprocessing import Pool
 import numpy as np
 import pandas as pd
 
 import parameters
+from data_cache import SaveCache, LoadCache, MergeCaches, ConcatFrames
 from root_numpy import tree2array, rec2array
 from ROOT import TChain, TFile, TTree
 
@@ -20,29 +25,64 @@ from ROOT import TChain, TFile, TTree
 # Tree2Pandas#
 ###############################################################################
 
-def Tree2Pandas(input_file, variables, weight=None, cut=None, xsec=None, event_weight_sum=None, luminosity=None, n=None, tree_name='Events',start=None):
+@functools.lru_cache(maxsize=None)
+def ParseBranches(variables, weight=None):
     """
-    Convert a ROOT TTree to a numpy array.
+    Returns the tuple of branches (or formulas) to read from the tuple of variables, and the weight if any
+    The '$' variables are not in the tree and are removed
+    Cached because the same variables are parsed for each file (and each chunk)
     """
-    variables = [var for var in variables if not var.startswith("$")]
-    variables = copy.copy(variables) # Otherwise will add the weight and have a duplicate branch
+    branches = [var for var in variables if not var.startswith("$")]
 
     # Check for repetitions in variables -> makes root_numpy crash #
-    repeated_var = [item for item, count in collections.Counter(variables).items() if count > 1]
+    repeated_var = [item for item, count in collections.Counter(branches).items() if count > 1]
     if len(repeated_var) != 0:
         logging.critical('There are repeated variables')
         for var in repeated_var:
             logging.critical('... %s'%var)
         raise RuntimeError("Repeated arguments for importing data")
 
+    if weight is not None and weight not in branches:
+        branches += [weight]
+    return tuple(branches)
+
+def Tree2Pandas(input_file, variables, weight=None, cut=None, xsec=None, event_weight_sum=None, luminosity=None, n=None, tree_name='Events',start=None):
+    """
+    Convert a ROOT TTree to a pandas DataFrame.
+    Only the entries from start to n are read (None or -1 : until the end)
+    """
+    list_df = list(Tree2PandasChunks(input_file        = input_file,
+                                     variables         = variables,
+                                     weight            = weight,
+                                     cut               = cut,
+                                     xsec              = xsec,
+                                     event_weight_sum  = event_weight_sum,
+                                     luminosity        = luminosity,
+                                     tree_name         = tree_name,
+                                     start             = start,
+                                     stop              = n,
+                                     chunksize         = None))
+    if len(list_df) == 0: # File or tree missing
+        return None
+    return list_df[0]
+
+def Tree2PandasChunks(input_file, variables, weight=None, cut=None, xsec=None, event_weight_sum=None, luminosity=None, tree_name='Events', start=None, stop=None, chunksize=100000):
+    """
+    Generator of pandas DataFrames, one for each window of chunksize entries of the tree between start and stop
+    (None or -1 : until the end, chunksize None : one window)
+    The cut is applied on each window, the chunks can therefore have less than chunksize events
+    Yields nothing if the file or tree does not exist
+    """
+    branches = list(ParseBranches(tuple(variables),weight))
+
     # Get root tree, check if exists first #
     if not os.path.exists(input_file):
         logging.warning("File %s does not exist"%input_file)
-        return None
+        return
     file_handle = TFile.Open(input_file)
     if not file_handle.GetListOfKeys().Contains(tree_name):
         logging.warning("Could not find tree %s in %s"%(tree_name,input_file))
-        return None
+        return
     tree = file_handle.Get(tree_name)
     N = tree.GetEntries()
     logging.debug('... Number of events : '+str(N))
@@ -58,53 +98,163 @@ def Tree2Pandas(input_file, variables, weight=None, cut=None, xsec=None, event_w
         logging.debug('\t\t\tLuminosity : %0.2f'%luminosity)
         logging.debug('\t\tRelative weight %0.3e'%relative_weight)
 
-    # Read the tree and convert it to a numpy structured array
-    if weight is not None:
-        variables += [weight]
-    data = tree2array(tree, branches=variables, selection=cut, start=start, stop=n)
-    
-    # Convert to pandas dataframe #
-    df = pd.DataFrame(data)
-    if weight is not None:
-        df['event_weight'] = df[weight]*relative_weight
+    # Only part of tree #
+    start = 0 if start is None else start
+    stop = N if stop is None or stop == -1 else min(stop,N)
+    if start > 0 or stop < N:
+        if stop < start:
+            logging.critical('Importing tree with start higher than end, will output empty tree')
+        logging.info("Reading from {} to {} in input tree".format(start,stop))
+    if chunksize is None:
+        chunksize = max(stop-start,1)
 
+    # Read the tree by windows and convert them to pandas dataframes #
+    for chunk_start in range(start,max(stop,start+1),chunksize): # At least one (maybe empty) chunk
+        chunk_stop = min(chunk_start+chunksize,stop)
+        data = tree2array(tree, branches=branches, selection=cut, start=chunk_start, stop=max(chunk_stop,chunk_start))
+        df = pd.DataFrame(data)
+        if weight is not None:
+            df['event_weight'] = df[weight]*relative_weight
+        logging.debug('\t\tEntries %d to %d : %d events'%(chunk_start,chunk_stop,df.shape[0]))
+        yield df
+    file_handle.Close()
 
-    # Only part of tree #
-    if n:
-        if n == -1:
-            n = N # Get all entries
-        if start:
-            if n < start:
-                logging.critical('Importing tree with start higher than end, will output empty tree')
-            logging.info("Reading from {} to {} in input tree".format(start,n))
-        else:
-            logging.info("Reading only {} from input tree".format(n))
-        
+###############################################################################
+# Downcast #
+###############################################################################
 
+def Downcast(df, keep=[], categorical=['tag','era','sample']):
+    """
+    Reduces the memory of the DataFrame (in place) :
+        - float64 -> float32 (if the values fit), except the columns in keep (eg, weights that are summed)
+        - integers -> smallest integer type that holds the values
+        - columns in categorical -> pd.Categorical (one code per row instead of one string)
+    """
+    for col in df.columns:
+        series = df[col]
+        if col in categorical:
+            if not isinstance(series.dtype,pd.CategoricalDtype):
+                df[col] = series.astype('category')
+        elif col in keep or pd.api.types.is_bool_dtype(series.dtype):
+            continue
+        elif pd.api.types.is_float_dtype(series.dtype) and series.dtype.itemsize > 4:
+            values = series.to_numpy()
+            finite = values[np.isfinite(values)]
+            if finite.shape[0] == 0 or np.abs(finite).max() < np.finfo(np.float32).max:
+                df[col] = values.astype(np.float32)
+        elif pd.api.types.is_integer_dtype(series.dtype):
+            df[col] = pd.to_numeric(series,downcast='integer') # Signed, so that differences do not wrap around
     return df
 
+###############################################################################
+# MemoryReport #
+###############################################################################
+
+def MemoryReport(df, name='DataFrame'):
+    """
+    Logs the memory used by each column of the DataFrame (debug) and the total (info)
+    Returns the memory in bytes per column
+    """
+    memory = df.memory_usage(deep=True,index=False)
+    for col,mem in memory.items():
+        logging.debug('\t%s [%s] : %0.3f MB'%(col,df[col].dtype,mem/1024**2))
+    logging.info('%s : %d rows, %d columns, memory = %0.3f MB'%(name,df.shape[0],df.shape[1],memory.sum()/1024**2))
+    return memory
+
+###############################################################################
+# ImportSample #
+###############################################################################
+
+def ImportSample(sample, variables, weight=None, additional_columns={}, cut=None, xsec=None, event_weight_sum=None, luminosity=None, start=None, n=None, downcast=False, chunksize=None):
+    """
+    Import a single sample with Tree2Pandas and add the mH, mA, sample and additional columns.
+    Defined at module level so that it can be sent to the workers of a process pool.
+    If downcast, the columns are downcast (see Downcast), the weights stay float64
+    If chunksize, the tree is read by chunks (downcast one at a time, so that the memory peak is smaller)
+    Returns None if the file or tree does not exist
+    """
+    list_df = list(ImportSampleChunks(sample, variables, weight, additional_columns, cut, xsec, event_weight_sum, luminosity, start, n, downcast, chunksize))
+    if len(list_df) == 0:
+        return None
+    return ConcatFrames(list_df)
+
+def ImportSampleChunks(sample, variables, weight=None, additional_columns={}, cut=None, xsec=None, event_weight_sum=None, luminosity=None, start=None, n=None, downcast=False, chunksize=None):
+    """
+    Generator version of ImportSample, yields the DataFrame of each chunk of chunksize entries (None : whole tree)
+    """
+    sample_name = os.path.basename(sample)
+    logging.debug("\tAccessing file : %s"%sample_name)
+
+    # Find mH, mA #
+    if sample_name.find('HToZA')!=-1: # Signal -> Search for mH and mA
+        mH = int(re.findall(r'\d+', sample_name)[2])
+        mA = int(re.findall(r'\d+', sample_name)[3])
+    else: # Background, set them at 0
+        mH = 0
+        mA = 0
+
+    # Get the data as pandas df #
+    for df in Tree2PandasChunks(input_file              = sample,
+                                variables               = variables,
+                                weight                  = weight,
+                                cut                     = cut,
+                                xsec                    = xsec,
+                                event_weight_sum        = event_weight_sum,
+                                luminosity              = luminosity,
+                                tree_name               = 'Events',
+                                start                   = start,
+                                stop                    = n,
+                                chunksize               = chunksize):
+        # Register in DF #
+        df['mH'] = np.full(df.shape[0],mH)
+        df['mA'] = np.full(df.shape[0],mA)
+
+        # Register sample name #
+        df['sample'] = sample_name.replace('.root','')
+        
+        # Register additional columns #
+        if len(additional_columns.keys()) != 0:
+            for key,val in additional_columns.items():
+                df[key] = val
+
+        if downcast:
+            Downcast(df, keep=[weight,'event_weight'], categorical=['sample']+list(additional_columns.keys()))
+
+        yield df
+
 ###############################################################################
 # LoopOverTrees #
 ###############################################################################
 
-def LoopOverTrees(input_dir, variables, weight=None, additional_columns={}, cut=None, xsec_json=None, event_weight_sum_json=None, luminosity=None, list_sample=None, start=None, n=None):
+def LoopOverTrees(input_dir, variables, weight=None, additional_columns={}, cut=None, xsec_json=None, event_weight_sum_json=None, luminosity=None, list_sample=None, start=None, n=None, workers=1, downcast=False, memory_budget=None, spill_path=None, chunksize=None):
     """
     Loop over ROOT trees inside input_dir and process them using Tree2Pandas.
+    If workers > 1, the files are read concurrently in a process pool
+    The frames are always concatenated once at the end, in the order of list_sample
+    If downcast, the columns use smaller dtypes (see Downcast)
+    If memory_budget (in MB) is exceeded by the imported frames, they are streamed to a columnar cache in spill_path
+    and the returned DataFrame is memory-mapped from it (copy-on-write, it can be modified as the one built in memory)
+    If chunksize, the trees are read by chunks of chunksize entries : serially, the budget is then checked after each chunk
+    so that files larger than the memory can be imported (with workers, each worker returns complete files)
+    With workers, at most workers files are read ahead of the ones collected (see ImapBounded)
     """
     # Check if directory #
     if not os.path.isdir(input_dir):
-        logging.critical("%s not a directory"%sinput_dir)
+        logging.critical("%s not a directory"%input_dir)
+        raise RuntimeError
+    if memory_budget is not None and spill_path is None:
+        logging.critical("A memory budget requires a spill path")
         raise RuntimeError
 
     logging.debug("Accessing directory : "+input_dir)
 
     # Xsec #
-    xsec = None
+    dict_xsec = None
     if xsec_json is not None:
         with open(xsec_json,'r') as handle:
             dict_xsec = json.load(handle)
     # Event weight sum #
-    event_weight_sum = None
+    dict_event_weight_sum = None
     if event_weight_sum_json is not None:
         with open(event_weight_sum_json,'r') as handle:
             dict_event_weight_sum = json.load(handle)
@@ -115,62 +265,91 @@ def LoopOverTrees(input_dir, variables, weight=None, additional_columns={}, cut=
     else:
         list_sample = [os.path.join(input_dir,s) for s in list_sample]
 
-    # Loop over the files #
-    first_file = True
-    all_df = pd.DataFrame() 
+    # Get the arguments of each file #
+    # The xsec and event weight sum only depend on the file, so that importing a part of the files gives the same rows #
+    list_args = []
     for sample in list_sample:
         sample_name = os.path.basename(sample)
-        logging.debug("\tAccessing file : %s"%sample_name)
-
-        if xsec_json is not None:
-            for name,xs in dict_xsec.items():
-                if name in sample_name:
-                    xsec = xs
-        if event_weight_sum_json is not None:
-            for name,ews in dict_event_weight_sum.items():
-                if name in sample_name:
-                    event_weight_sum = ews
-       
-        # Get the data as pandas df #
-        df = Tree2Pandas(input_file                 = sample,
-                         variables                  = variables,
-                         weight                     = weight,
-                         cut                        = cut,
-                         xsec                       = xsec,
-                         event_weight_sum           = event_weight_sum,
-                         luminosity                 = luminosity,
-                         n                          = n,
-                         tree_name                  = 'Events',
-                         start                      = start) 
-
-        if df is None:
-            continue
+        xsec = FindSampleValue(dict_xsec,sample_name,'cross section',xsec_json)
+        event_weight_sum = FindSampleValue(dict_event_weight_sum,sample_name,'event weight sum',event_weight_sum_json)
+        list_args.append((sample,variables,weight,additional_columns,cut,xsec,event_weight_sum,luminosity,start,n,downcast,chunksize))
 
-        # Find mH, mA #
-        if sample_name.find('HToZA')!=-1: # Signal -> Search for mH and mA
-            mH = [int(re.findall(r'\d+', sample_name)[2])]*df.shape[0]    
-            mA = [int(re.findall(r'\d+', sample_name)[3])]*df.shape[0]    
-        else: # Background, set them at 0
-            mH = [0]*df.shape[0]
-            mA = [0]*df.shape[0]
-
-        # Register in DF #
-        df['mH'] = pd.Series(mH)
-        df['mA'] = pd.Series(mA)
-
-        # Register sample name #
-        df['sample'] = pd.Series([sample_name.replace('.root','')]*df.shape[0])
-        
-        # Register additional columns #
-        if len(additional_columns.keys()) != 0:
-            for key,val in additional_columns.items():
-                df[key] = pd.Series([val]*df.shape[0])
+    # Loop over the files #
+    parallel = workers > 1 and len(list_args) > 1
+    if parallel:
+        workers = min(workers,len(list_args))
+        logging.debug("Reading %d files with %d workers"%(len(list_args),workers))
 
-        # Concatenate into full df #
-        if first_file:
-            all_df = df
-            first_file = False
+    # Collect the frames, stream them to disk above the memory budget #
+    list_df = []
+    list_parts = []
+    memory = 0
+    with (Pool(processes=workers) if parallel else contextlib.ExitStack()) as pool: # The pool is terminated in case of error
+        if parallel:
+            results = ImapBounded(pool,ImportSampleFromArgs,list_args,workers)
         else:
-            all_df = pd.concat([all_df,df])
-        all_df = all_df.reset_index(drop=True) # Otherwise there will be an index repetition for each file
+            results = itertools.chain.from_iterable(ImportSampleChunks(*args) for args in list_args)
+        for df in results:
+            if df is None:
+                continue
+            list_df.append(df)
+            memory += df.memory_usage(deep=True).sum()
+            if memory_budget is not None and memory > memory_budget*1024**2:
+                part = os.path.join(spill_path+'_parts','part_%d'%len(list_parts))
+                logging.info("Memory budget of %d MB exceeded, %d frames written to %s"%(memory_budget,len(list_df),part))
+                SaveCache(ConcatFrames(list_df),part)
+                list_parts.append(part)
+                list_df = []
+                memory = 0
+        if parallel:
+            pool.close()
+            pool.join()
+
+    # Concatenate into full df #
+    if len(list_parts) != 0:
+        if len(list_df) != 0:
+            part = os.path.join(spill_path+'_parts','part_%d'%len(list_parts))
+            SaveCache(ConcatFrames(list_df),part)
+            list_parts.append(part)
+            del list_df
+        MergeCaches(list_parts,spill_path)
+        os.rmdir(spill_path+'_parts')
+        all_df = LoadCache(spill_path,mmap='c') # Writable as the frame built in memory
+    else:
+        all_df = ConcatFrames(list_df) # index ignored, otherwise there will be an index repetition for each file
+    if downcast:
+        MemoryReport(all_df,'Imported data from %s'%input_dir)
     return all_df
+
+def FindSampleValue(dict_values,sample_name,what,path_json):
+    """
+    Returns the value of the sample in the dict (from a json file), the last key contained in the sample name
+    None if there is no dict, or no key matches (with a warning, eg data : the events are then not normalized)
+    """
+    if dict_values is None:
+        return None
+    value = None
+    for name,val in dict_values.items():
+        if name in sample_name:
+            value = val
+    if value is None:
+        logging.warning("No %s for %s in %s, the events will not be normalized"%(what,sample_name,path_json))
+    return value
+
+def ImportSampleFromArgs(args):
+    """ ImportSample with the arguments as a tuple (for ImapBounded) """
+    return ImportSample(*args)
+
+def ImapBounded(pool,func,list_args,in_flight):
+    """
+    Yields func(args) for each args of list_args, in order, computed in the pool
+    At most in_flight files are submitted and not yet yielded (Pool.imap reads ahead and keeps all the finished frames),
+    so that the memory budget also holds with workers
+    """
+    pending = collections.deque()
+    for args in list_args:
+        if len(pending) >= in_flight:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func,(args,)))
+    while len(pending) != 0:
+        yield pending.popleft().get()
@@ -0,0 +1,148 @@
+import os
+import glob
+import datetime
+import contextlib
+import logging
+import traceback
+import multiprocessing
+
+# Personal files #
+import parameters
+
+# Variables set in each worker process by InitWorker #
+_worker = {}
+
+# Environment variables limiting the number of threads of TensorFlow and the numerical libraries #
+THREAD_VARIABLES = ['OMP_NUM_THREADS','MKL_NUM_THREADS','OPENBLAS_NUM_THREADS','TF_NUM_INTRAOP_THREADS','TF_NUM_INTEROP_THREADS']
+
+#################################################################################################
+# LocalScan #
+#################################################################################################
+def LocalScan(name,data,list_inputs,list_outputs,workers,threads=1,params_per_job=1,model_idx=None,generator=False):
+    """
+    Runs the hyperparameter scan of parameters.p in a local process pool instead of slurm jobs
+        - the grid is split in dicts of params_per_job parameter sets (as with --split, in split/name)
+        - each worker runs HyperScan and HyperDeploy on one dict at a time, with threads threads for TensorFlow
+        - the csv and zip files are saved as for slurm in slurm/name_timestamp/output
+        - the csv files are then concatenated with ConcatenateCSV (model/name.csv, or model/name_crossvalN.csv)
+    The workers are started with spawn (TensorFlow is not fork-safe). The training and evaluation arrays are published once
+    in parameters.shared_path (see shared_data.py) and memory-mapped by the workers, so the memory does not grow with the workers
+    Returns the path of the output directory
+    """
+    from split_training import SplitTraining
+    from concatenate_csv import ConcatenateCSV
+    from shared_data import PublishArrays, ReleaseArrays
+
+    # Split the grid #
+    SplitTraining(parameters.p,params_per_job=params_per_job,dir_name=name)
+    tasks = sorted([os.path.basename(f) for f in glob.glob(os.path.join(parameters.main_path,'split',name,'*.pkl'))],
+                   key=lambda task: int(task.replace('dict_','').replace('.pkl','')))
+    workers = max(1,min(workers,len(tasks)))
+
+    # Output directory, same layout as slurm so that ConcatenateCSV finds the name #
+    timestamp = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+    dir_name = name if model_idx is None else name+'_crossval%d'%model_idx # One csv per model in cross validation
+    path_output = os.path.join(parameters.main_path,'slurm',dir_name+'_'+timestamp,'output')
+    os.makedirs(path_output)
+    logging.info('Local scan of %d tasks with %d workers (%d threads each)'%(len(tasks),workers,threads))
+    logging.info('Outputs will be saved in %s'%path_output)
+
+    # Training data shared by the workers (the generator does not use it) #
+    shared = None
+    if not generator:
+        shared = PublishArrays(data,list_inputs,list_outputs,path=parameters.shared_path,model_idx=model_idx)
+
+    # The children inherit the environment at spawn, set it before #
+    try:
+        context = multiprocessing.get_context('spawn')
+        with ThreadEnvironment(threads), \
+             context.Pool(processes=workers,
+                          initializer=InitWorker,
+                          initargs=(shared,list_inputs,list_outputs,model_idx,generator,threads,path_output),
+                          maxtasksperchild=None) as pool:
+            results = pool.imap_unordered(RunTask,[(name,task) for task in tasks])
+            failed = []
+            for i,(task,success,message) in enumerate(results):
+                if success:
+                    logging.info('Task %s done (%d/%d)'%(task,i+1,len(tasks)))
+                else:
+                    logging.error('Task %s failed (%d/%d) : %s'%(task,i+1,len(tasks),message))
+                    failed.append(task)
+    finally:
+        if shared is not None:
+            ReleaseArrays(shared)
+
+    if len(failed) != 0:
+        logging.warning('%d tasks failed, use --resubmit %s to run them again'%(len(failed),path_output))
+        for task in failed:
+            logging.warning('... %s'%task)
+
+    # Merge the results as for slurm #
+    if len(glob.glob(os.path.join(path_output,'*.csv'))) != 0:
+        ConcatenateCSV(path_output+'/')
+    return path_output
+
+#################################################################################################
+# ThreadEnvironment #
+#################################################################################################
+@contextlib.contextmanager
+def ThreadEnvironment(threads):
+    """ Sets the thread variables (inherited by the processes started inside the context) and restores them after """
+    environ = {var:os.environ.get(var) for var in THREAD_VARIABLES}
+    for var in THREAD_VARIABLES:
+        os.environ[var] = '1' if var == 'TF_NUM_INTEROP_THREADS' else str(threads)
+    try:
+        yield
+    finally:
+        for var,val in environ.items():
+            if val is None:
+                del os.environ[var]
+            else:
+                os.environ[var] = val
+
+#################################################################################################
+# SetThreads #
+#################################################################################################
+def SetThreads(threads):
+    """ Limits the number of threads of TensorFlow in the current process """
+    import tensorflow as tf
+    if tf.__version__.startswith('1.'):
+        import keras.backend as K
+        config = tf.ConfigProto(intra_op_parallelism_threads=threads,inter_op_parallelism_threads=1)
+        K.set_session(tf.Session(config=config))
+    else:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+
+#################################################################################################
+# InitWorker #
+#################################################################################################
+def InitWorker(shared,list_inputs,list_outputs,model_idx,generator,threads,path_output):
+    """ Initialization of a worker process : thread limits of TensorFlow and path of the shared arrays for all the tasks """
+    logging.basicConfig(level=logging.INFO,format='%(asctime)s - %(processName)s - %(levelname)s - %(message)s')
+    SetThreads(threads)
+    _worker.update({'shared':shared,'list_inputs':list_inputs,'list_outputs':list_outputs,
+                    'model_idx':model_idx,'generator':generator})
+    os.chdir(path_output) # HyperScan and HyperDeploy save the csv and zip files in the current directory (as on the cluster)
+
+#################################################################################################
+# RunTask #
+#################################################################################################
+def RunTask(args):
+    """ Scan and deploy of one dict of parameters, returns (task,success,message) """
+    name,task = args
+    try:
+        from NeuralNet import HyperModel
+        instance = HyperModel(name)
+        instance.HyperScan(data         = None,
+                           list_inputs  = _worker['list_inputs'],
+                           list_outputs = _worker['list_outputs'],
+                           task         = task,
+                           model_idx    = _worker['model_idx'],
+                           generator    = _worker['generator'],
+                           shared       = _worker['shared'])
+        instance.HyperDeploy(best='eval_error')
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        return task,False,str(e)
+    return task,True,''
@@ -2,6 +2,7 @@ import os
 import logging
 import pickle
 import glob
+from multiprocessing import Pool
 #import enlighten
 import numpy as np
 import pandas as pd
@@ -10,71 +11,141 @@ from ROOT import TFile, TTree
 from root_numpy import tree2array, rec2array
 
 import parameters
+from data_cache import Fingerprints, WriteProvenance, CheckProvenance
 
-def MakeScaler(data=None,list_inputs=[],generator=False,batch=100000):
+class StreamingMoments:
+    """
+    One-pass accumulator of the (weighted) mean and variance of each column
+    Each batch is reduced to (sum of weights, mean, sum of squared deviations) and combined with the current ones
+    with the pairwise formulas of Chan et al (Welford for batches), which are stable and allow to merge partial results
+    The std is the population one (normalized by the sum of weights), as in StandardScaler
+    """
+    def __init__(self,n_columns):
+        self.n = 0.                         # Sum of weights (number of events if unweighted)
+        self.mean = np.zeros(n_columns)
+        self.M2 = np.zeros(n_columns)       # Sum of weighted squared deviations from the mean
+
+    def combine(self,n,mean,M2):
+        # Merge the moments of another set of events #
+        if n == 0:
+            return
+        total = self.n+n
+        delta = mean-self.mean
+        self.mean = self.mean+delta*(n/total)
+        self.M2 = self.M2+M2+np.square(delta)*(self.n*n/total)
+        self.n = total
+
+    def update(self,array,weights=None):
+        # Add a batch of events (array of shape (N,n_columns)) #
+        if array.shape[0] == 0:
+            return
+        if weights is None:
+            n = float(array.shape[0])
+            mean = np.mean(array,axis=0)
+            M2 = np.sum(np.square(array-mean),axis=0)
+        else:
+            n = float(np.sum(weights))
+            mean = np.sum(array*weights[:,np.newaxis],axis=0)/n
+            M2 = np.sum(np.square(array-mean)*weights[:,np.newaxis],axis=0)
+        self.combine(n,mean,M2)
+
+    def merge(self,other):
+        # Merge the moments from another accumulator (eg, from another process) #
+        self.combine(other.n,other.mean,other.M2)
+        return self
+
+    @property
+    def std(self):
+        return np.sqrt(self.M2/self.n)
+
+def FileMoments(path,list_inputs,batch=100000,weight=None):
+    """ Returns the StreamingMoments of the inputs in the tree of the root file, read by batches """
+    moments = StreamingMoments(len(list_inputs))
+    branches = list_inputs if weight is None else list_inputs+[weight]
+    file_handle = TFile.Open(path)
+    tree = file_handle.Get('tree')
+    N = tree.GetEntries()
+    logging.info("Opening file %s (%d entries)"%(path,N))
+    for i in range(0, N, batch):
+        array = rec2array(tree2array(tree,branches=branches,start=i,stop=i+batch))
+        if weight is None:
+            moments.update(array)
+        else:
+            moments.update(array[:,:-1],array[:,-1])
+    file_handle.Close()
+    return moments
+
+def MakeScaler(data=None,list_inputs=[],generator=False,batch=100000,provenance=None,weight=None,workers=1):
+    """
+    Creates the scaler (or imports it if it exists) and saves it as pickle file
+    provenance is a dict describing the data used (configuration, cache key, ...),
+    if the scaler exists but was produced with another provenance it is produced again
+    weight : name of the column (or branch for generator) of the event weights, if None the statistics are unweighted
+    workers : number of processes reading the generator files
+    """
     # Generate scaler #
     scaler_name = 'scaler_'+parameters.suffix+'.pkl'
     scaler_path = os.path.join(parameters.main_path,scaler_name)
+    manifest_path = scaler_path.replace('.pkl','.json')
     scaler = preprocessing.StandardScaler()
-    if not os.path.exists(scaler_path):
+    if provenance is None:
+        provenance = {}
+    provenance = dict(provenance,inputs=list_inputs)
+    if weight is not None:
+        provenance['weight'] = weight
+    if generator:
+        provenance['files'] = Fingerprints(sorted(glob.glob(parameters.path_gen_training+'/*root')),parameters.cache_checksum)
+    stale = os.path.exists(scaler_path) and os.path.exists(manifest_path) and not CheckProvenance(manifest_path,provenance)
+    if stale:
+        logging.warning('Scaler %s was produced from different data or inputs, will produce it again'%scaler_name)
+    if not os.path.exists(scaler_path) or stale:
         # Not generator #
         if data is not None:
-            scaler.fit(data[list_inputs])
+            if weight is None:
+                scaler.fit(data[list_inputs])
+            else:
+                moments = StreamingMoments(len(list_inputs))
+                moments.update(data[list_inputs].values,data[weight].values)
+                # Set manually #
+                scaler.mean_ = moments.mean
+                scaler.scale_ = moments.std
         # For generator #
         if generator:
+            # Single pass over the files, one accumulator per file merged at the end #
             logging.info("-"*80)
-            logging.info("Computing mean")
-            # Mean Loop #
-            mean = np.zeros(len(list_inputs))
-            Ntot = 0
-            for f in glob.glob(parameters.path_gen_training+'/*root'):
-                file_handle = TFile.Open(f)
-                tree = file_handle.Get('tree')
-                N = tree.GetEntries()
-                Ntot += N
-                logging.info("Opening file %s (%d entries)"%(f,N))
-                # Loop over batches #
-                #pbar = enlighten.Counter(total=N//batch+1, desc='Mean', unit='Batch')
-                for i in range(0, N, batch):
-                    array = rec2array(tree2array(tree,branches=list_inputs,start=i,stop=i+batch))
-                    mean += np.sum(array,axis=0)
-                    #pbar.update()
-            mean /= Ntot
-            
-            # Var Loop #
-            logging.info("-"*80)
-            logging.info("Computing std")
-            std = np.zeros(len(list_inputs))
-            for f in glob.glob(parameters.path_gen_training+'/*root'):
-                file_handle = TFile.Open(f)
-                tree = file_handle.Get('tree')
-                N = tree.GetEntries()
-                logging.info("Opening file %s (%d entries)"%(f,N))
-                # Loop over batches #
-                #pbar = enlighten.Counter(total=N//batch+1, desc='Std', unit='Batch')
-                for i in range(0, N, batch):
-                    array = rec2array(tree2array(tree,branches=list_inputs,start=i,stop=i+batch))
-                    std += np.sum(np.square(array-mean),axis=0)
-                    #pbar.update()
-            std = np.sqrt(std/Ntot)
+            logging.info("Computing mean and std")
+            list_files = glob.glob(parameters.path_gen_training+'/*root')
+            list_args = [(f,list_inputs,batch,weight) for f in list_files]
+            if workers > 1:
+                with Pool(processes=min(workers,len(list_args))) as pool:
+                    list_moments = pool.starmap(FileMoments,list_args,chunksize=1)
+            else:
+                list_moments = [FileMoments(*args) for args in list_args]
+            moments = StreamingMoments(len(list_inputs))
+            for file_moments in list_moments:
+                moments.merge(file_moments)
             # Set manually #
-            scaler.mean_ = mean
-            scaler.scale_ = std
+            scaler.mean_ = moments.mean
+            scaler.scale_ = moments.std
 
         # Save #
         with open(scaler_path, 'wb') as handle:
             pickle.dump(scaler, handle)
+        WriteProvenance(manifest_path,provenance)
         logging.info('Scaler %s has been created'%scaler_name)
     # If exists, will import it #
     else:
         with open(scaler_path, 'rb') as handle:
             scaler = pickle.load(handle)
         logging.info('Scaler %s has been imported'%scaler_name)
+        if not os.path.exists(manifest_path): # Scaler produced before the provenance was recorded (checked below on the data)
+            WriteProvenance(manifest_path,provenance)
      # Test the scaler #
     if data is not None:
         try:
-            mean_scale = np.mean(scaler.transform(data[list_inputs]))
-            var_scale = np.var(scaler.transform(data[list_inputs]))
+            weights = None if weight is None else data[weight].values
+            mean_scale = np.mean(np.average(scaler.transform(data[list_inputs]),weights=weights,axis=0))
+            var_scale = np.mean(np.average(np.square(scaler.transform(data[list_inputs])),weights=weights,axis=0))-mean_scale**2
         except ValueError:
             logging.critical("Problem with the scaler '%s' you imported, has the data changed since it was generated ?"%scaler_name)
             raise ValueError
@@ -0,0 +1,60 @@
+import numpy as np
+
+###############################################################################
+# AssignMassPoints #
+###############################################################################
+
+def AssignMassPoints(signal_masses,background_weights,equalize=True,norm=1e5):
+    """
+    Assigns the signal mass points (mH,mA) to the background events and computes the learning weights
+        signal_masses       : array (N_signal,2) of the (mH,mA) of the signal events
+        background_weights  : dict {name : array of event weights} of each background
+        equalize            : if True, the learning weights are equalized
+                                - signal : each mass point has the same importance
+                                - background : proportional to the event weights
+                              and each class sums to norm (very small weights produce very low loss function)
+                              if False, all learning weights are 1
+    Each background gets the mass points in the same proportions as in the signal (rounded up, then truncated), in random order
+    Returns :
+        background_masses   : dict {name : array (N_background,2)}
+        learning_weights    : dict {name : array}, with the signal under key 'signal'
+        mass_points         : dict {'masses' : array (N_points,2), 'signal' : counts, name : counts}
+    """
+    signal_masses = np.asarray(signal_masses)
+    N_signal = signal_masses.shape[0]
+
+    # Mass points and signal proportions #
+    # Each (mH,mA) is encoded as a single integer key (same ordering), much faster than np.unique over rows
+    mH, mH_inverse = np.unique(signal_masses[:,0],return_inverse=True)
+    mA, mA_inverse = np.unique(signal_masses[:,1],return_inverse=True)
+    keys = mH_inverse.ravel().astype(np.int64)*mA.shape[0]+mA_inverse.ravel()
+    unique_keys, inverse, counts = np.unique(keys,return_inverse=True,return_counts=True)
+    inverse = inverse.ravel() # Shape of inverse depends on numpy version
+    masses = np.c_[mH[unique_keys//mA.shape[0]],mA[unique_keys%mA.shape[0]]]
+    mass_points = {'masses':masses,'signal':counts}
+
+    background_masses = {}
+    learning_weights = {}
+    for name,weights in background_weights.items():
+        N_back = weights.shape[0]
+        # Same proportion as in signal, rounded up #
+        n_per_mass = np.ceil(counts/N_signal*N_back).astype(np.int64)
+        idx_masses = np.repeat(np.arange(masses.shape[0]),n_per_mass)
+        np.random.shuffle(idx_masses) # Shuffle so that each background event has random masses
+        idx_masses = idx_masses[:N_back] # Might have slightly more entries due to numerical instabilities in props
+        background_masses[name] = masses[idx_masses]
+        mass_points[name] = np.bincount(idx_masses,minlength=masses.shape[0])
+        # Learning weights #
+        if equalize:
+            learning_weights[name] = weights/np.sum(weights)*norm
+        else:
+            learning_weights[name] = np.ones(N_back)
+
+    # Use mass prop weights so that each mass point has same importance #
+    if equalize:
+        weight_signal = 1./counts[inverse]
+        learning_weights['signal'] = weight_signal/np.sum(weight_signal)*norm
+    else:
+        learning_weights['signal'] = np.ones(N_signal)
+
+    return background_masses, learning_weights, mass_points
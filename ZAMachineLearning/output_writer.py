@@ -0,0 +1,105 @@
+import os
+import logging
+
+import numpy as np
+import pandas as pd
+from root_numpy import array2root
+
+# Personal files #
+import parameters
+
+###############################################################################
+# BranchArray #
+###############################################################################
+
+def BranchArray(series):
+    """
+    Returns the values of the column with a dtype that can be written in a ROOT tree (its own dtype when possible)
+    Categorical and object columns are converted to numbers, None if they are not numeric (eg, sample names)
+    """
+    if isinstance(series.dtype,pd.CategoricalDtype) or not pd.api.types.is_numeric_dtype(series.dtype):
+        try:
+            return pd.to_numeric(np.asarray(series))
+        except (ValueError,TypeError):
+            return None
+    if series.dtype == np.float16: # Not a ROOT type
+        return series.to_numpy(dtype=np.float32)
+    return series.to_numpy()
+
+###############################################################################
+# RootWriter #
+###############################################################################
+
+class RootWriter:
+    """
+    Writes the events and the outputs of the model in ROOT trees, chunk by chunk, without building the full array
+        - output_name : all the events in path_output/output_name
+        - split_column : one file per value of the column (path_output/value.root), without the tag and sample columns
+    The branches keep the dtype of the columns (the outputs are float32), the columns that are not numbers are not written
+    The first chunk of each file is written with mode ('recreate' or 'update'), the next ones are appended to the tree
+    Each call to write is cut in pieces of chunksize events at most
+    If columns is specified, only these columns of the data are written (eg, event index for friend trees)
+    """
+    def __init__(self,path_output,output_name=None,split_column=None,mode='recreate',chunksize=100000,columns=None):
+        self.path_output = path_output
+        self.output_name = output_name
+        self.split_column = split_column
+        self.mode = mode
+        self.chunksize = chunksize
+        self.columns = columns
+        self.drop = ['tag','sample'] if output_name is None else []
+        self.modes = {}     # Mode of the next write for each file
+        self.entries = {}   # Number of events written in each file
+        self.skipped = set()
+
+    def write(self,data,output,output_columns):
+        """ Writes the rows of data (DataFrame, or None to write only the outputs) with their outputs (array with as many rows) """
+        if data is not None:
+            assert data.shape[0] == output.shape[0]
+        for start in range(0,output.shape[0],self.chunksize):
+            stop = min(start+self.chunksize,output.shape[0])
+            self.WriteChunk(data.iloc[start:stop] if data is not None else None,output[start:stop],output_columns)
+
+    def WriteChunk(self,data,output,output_columns):
+        # Branches #
+        branches = []
+        if data is not None:
+            for col in (data.columns if self.columns is None else self.columns):
+                if col in self.drop:
+                    continue
+                arr = BranchArray(data[col])
+                if arr is None:
+                    if col not in self.skipped:
+                        logging.warning('Column %s is not numeric and will not be saved in the tree'%col)
+                        self.skipped.add(col)
+                    continue
+                branches.append((col,arr))
+        for j,col in enumerate(output_columns):
+            branches.append((col,output[:,j]))
+        names = parameters.make_dtype([name for name,_ in branches]) # because ( ) and . are an issue for root_numpy
+
+        # Files #
+        if self.output_name is not None:
+            self.WriteRecords(os.path.join(self.path_output,self.output_name),names,branches,None)
+        else:
+            values = BranchArray(data[self.split_column])
+            if values is None:
+                values = np.asarray(data[self.split_column].astype(str))
+            for value in pd.unique(values):
+                self.WriteRecords(os.path.join(self.path_output,str(value)+'.root'),names,branches,values==value)
+
+    def WriteRecords(self,path,names,branches,selection):
+        """ Fills a record array with the selected events of the branches and writes it in path """
+        n = branches[-1][1].shape[0] if selection is None else np.count_nonzero(selection)
+        if n == 0:
+            return
+        records = np.empty(n,dtype=[(name,arr.dtype) for name,(_,arr) in zip(names,branches)])
+        for name,(_,arr) in zip(names,branches):
+            records[name] = arr if selection is None else arr[selection]
+        array2root(records,path,mode=self.modes.get(path,self.mode))
+        self.modes[path] = 'update'
+        self.entries[path] = self.entries.get(path,0) + n
+
+    def close(self):
+        for path,n in self.entries.items():
+            logging.info('Output saved as : %s (%d events)'%(path,n))
@@ -0,0 +1,151 @@
+import os
+import json
+import time
+import logging
+import traceback
+import multiprocessing
+
+# Personal files #
+import parameters
+from data_cache import CacheKey
+
+# Variables set in each worker process by InitWorker #
+_worker = {}
+
+# Manifest of the files done in each output directory #
+OUTPUT_MANIFEST = 'output_manifest.json'
+
+#################################################################################################
+# ParallelOutput #
+#################################################################################################
+def ParallelOutput(model,list_jobs,workers=1,threads=1,generator=False,chunksize=None,friend=False):
+    """
+    Produces the outputs of the model(s) on new files, one file per task in a pool of workers processes
+        - model : list of model paths (without .zip), as for ProduceOutput
+        - list_jobs : list of (input_dir,list_sample,path_output), eg one per key of sampleList.py
+    Each worker (spawned, threads threads for TensorFlow) restores the model once and uses it for all its files
+    A manifest in each output directory records the files done, with a key from the input file, models and variables :
+    the files done with the same key are skipped when running again (eg, after the job was stopped)
+    At the end, the throughput of each worker is reported
+    If friend, only the outputs and event index are written (see OutputNewData)
+    """
+    # Tasks #
+    tasks = []
+    manifests = {}
+    config = {'variables':parameters.inputs+parameters.outputs+parameters.other_variables,'cut':parameters.cut,'generator':generator,
+              'friend':parameters.friend_index if friend else False}
+    for input_dir,list_sample,path_output in list_jobs:
+        manifests[path_output] = ReadOutputManifest(path_output)
+        for f in list_sample:
+            key = CacheKey(config,[os.path.join(input_dir,f)]+[m+'.zip' for m in model])
+            done = manifests[path_output].get(f)
+            if done is not None and done['key'] == key and \
+                (done['events'] == 0 or os.path.exists(os.path.join(path_output,os.path.basename(f)))):
+                logging.info('File %s already done in %s, will be skipped'%(f,path_output))
+                continue
+            tasks.append((input_dir,f,path_output,key))
+    if len(tasks) == 0:
+        logging.info('All the files are already done')
+        return
+    workers = max(1,min(workers,len(tasks)))
+    logging.info('Producing the outputs of %d files with %d workers (%d threads each)'%(len(tasks),workers,threads))
+
+    # Run #
+    report = {}
+    failed = []
+    start_time = time.time()
+    initargs = (model,generator,chunksize,friend,threads)
+    if workers == 1:
+        from local_scan import SetThreads
+        SetThreads(threads) # Same thread limit as the workers
+        InitWorker(*initargs[:-1])
+        results = map(OutputTask,tasks)
+        ProcessResults(results,len(tasks),manifests,report,failed)
+    else:
+        from local_scan import ThreadEnvironment
+        context = multiprocessing.get_context('spawn')
+        with ThreadEnvironment(threads), \
+             context.Pool(processes=workers,initializer=InitWorker,initargs=initargs) as pool:
+            ProcessResults(pool.imap_unordered(OutputTask,tasks),len(tasks),manifests,report,failed)
+    elapsed = time.time()-start_time
+
+    # Report #
+    logging.info(' Output throughput '.center(80,'-'))
+    for worker,(n_files,n_events,worker_time) in sorted(report.items()):
+        logging.info(('Worker %s '%worker).ljust(25,'.')+' %4d files | %10d events | %8.1f s | %10.0f events/s'%(n_files,n_events,worker_time,n_events/max(worker_time,1e-9)))
+    n_events = sum(n for _,n,_ in report.values())
+    logging.info(('Total ').ljust(25,'.')+' %4d files | %10d events | %8.1f s | %10.0f events/s'%(len(tasks)-len(failed),n_events,elapsed,n_events/max(elapsed,1e-9)))
+    if len(failed) != 0:
+        logging.warning('%d files failed, running again will only process them'%len(failed))
+        for f in failed:
+            logging.warning('... %s'%f)
+
+#################################################################################################
+# ProcessResults #
+#################################################################################################
+def ProcessResults(results,n_tasks,manifests,report,failed):
+    """ Records the files done in the manifests (after each file) and the throughput of each worker """
+    for i,(f,path_output,key,n_events,elapsed,worker,message) in enumerate(results):
+        if message != '':
+            logging.error('File %s failed (%d/%d) : %s'%(f,i+1,n_tasks,message))
+            failed.append(f)
+            continue
+        logging.info('File %s done (%d/%d) : %d events in %0.1f s (%0.0f events/s)'%(f,i+1,n_tasks,n_events,elapsed,n_events/max(elapsed,1e-9)))
+        manifests[path_output][f] = {'key':key,'events':n_events,'time':elapsed}
+        WriteOutputManifest(path_output,manifests[path_output])
+        n_files_worker,n_events_worker,time_worker = report.get(worker,(0,0,0.))
+        report[worker] = (n_files_worker+1,n_events_worker+n_events,time_worker+elapsed)
+
+#################################################################################################
+# ReadOutputManifest #
+#################################################################################################
+def ReadOutputManifest(path_output):
+    """ Returns the dict of the files done in path_output """
+    path_manifest = os.path.join(path_output,OUTPUT_MANIFEST)
+    if not os.path.exists(path_manifest):
+        return {}
+    with open(path_manifest,'r') as handle:
+        return json.load(handle)
+
+#################################################################################################
+# WriteOutputManifest #
+#################################################################################################
+def WriteOutputManifest(path_output,manifest):
+    """ Writes the dict of the files done in path_output (in a temporary file first, never left incomplete) """
+    path_manifest = os.path.join(path_output,OUTPUT_MANIFEST)
+    with open(path_manifest+'.tmp','w') as handle:
+        json.dump(manifest,handle,indent=4)
+    os.replace(path_manifest+'.tmp',path_manifest)
+
+#################################################################################################
+# InitWorker #
+#################################################################################################
+def InitWorker(model,generator,chunksize,friend,threads=None):
+    """ Initialization of a worker process : thread limits and output instance kept for all the files """
+    if threads is not None: # Spawned process
+        logging.basicConfig(level=logging.INFO,format='%(asctime)s - %(processName)s - %(levelname)s - %(message)s')
+        from local_scan import SetThreads
+        SetThreads(threads)
+    from produce_output import ProduceOutput
+    _worker['instance'] = ProduceOutput(model=model,generator=generator)
+    _worker['chunksize'] = chunksize
+    _worker['friend'] = friend
+
+#################################################################################################
+# OutputTask #
+#################################################################################################
+def OutputTask(args):
+    """ Outputs of one file, returns (file,path_output,key,events,time,worker,message) """
+    input_dir,f,path_output,key = args
+    worker = multiprocessing.current_process().name
+    start_time = time.time()
+    try:
+        n_events = _worker['instance'].OutputNewData(input_dir   = input_dir,
+                                                     list_sample = [f],
+                                                     path_output = path_output,
+                                                     chunksize   = _worker['chunksize'],
+                                                     friend      = _worker['friend'])
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        return f,path_output,key,0,time.time()-start_time,worker,str(e)
+    return f,path_output,key,n_events,time.time()-start_time,worker,''
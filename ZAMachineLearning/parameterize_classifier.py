@@ -3,57 +3,100 @@ import sys
 import re
 import logging
 import random
-import copy
 
 import pandas as pd
 import numpy as np
 
 import parameters
+from data_cache import ColumnArray, ColumnDtypes, CacheWriter, LoadCache
 
-def ParametrizeClassifier(data,name):
+def ParametrizeClassifier(data,name,path_cache=None,chunksize=1000000):
+    """
+    Parameterizes the classifier on the signal mass points
+        signal     : each event keeps its mass point (mH_gen,mA_gen) and gets the weight of this mass point in column name
+        background : each event is repeated for each mass point of the inputs, with the weight of that mass point in column name
+                     (learning_weights divided by the number of mass points to not unbalance the training)
+    The rows are ordered as : signal by mass point, then background by mass point (events keep their order)
+    If path_cache is given, the rows are written to a columnar cache by chunks of chunksize rows
+    and the memory-mapped DataFrame from the cache is returned instead of building it in memory
+    (copy-on-write : it can be modified as the one built in memory, only the modified pages are copied)
+    """
     logging.info('Starting the parameterization of the classifier')
-    # Add new column : parametric weight HToZA #
-    new_col = pd.DataFrame(np.zeros(data.shape[0]),index=data.index,columns=[name])
-    data = pd.concat([data,new_col],axis=1)
+    weight_name = name.replace('HToZA','HToZA_mH_%d_mA_%d') # Weight of a specific mass point
+    columns = list(data.columns)+([name] if name not in data.columns else [])
 
     # Split in signal and background samples #
-    idx_sig = data['tag']=='HToZA'
-    idx_back = np.invert(idx_sig)
-    data_sig = data[idx_sig]
-    data_back = data[idx_back]
+    is_sig = (data['tag']=='HToZA').values
+    idx_sig = np.nonzero(is_sig)[0]
+    idx_back = np.nonzero(~is_sig)[0]
    
     # Get the masses #
     list_signal = [s for s in parameters.inputs if s.find('HToZA')!=-1] # Only take the HtoZA weights (not background)
-    masses = np.asarray([(float(re.findall(r'\d+',s)[1]),float(re.findall(r'\d+',s)[2])) for s in list_signal]) # mAmH
+    masses = np.asarray([(float(re.findall(r'\d+',s)[1]),float(re.findall(r'\d+',s)[2])) for s in list_signal]).reshape(-1,2) # mAmH
 
     # Signal case #
+    # Ordered by mass point (stable sort, same as groupby) and weight taken from the column of its mass point
     logging.info('\tParameterizing the signal')
-    dict_of_regions = {k: v for k, v in data_sig.groupby(['mH_gen','mA_gen'])} # One region = one specific couple mH_gen,mA_gen
-    new_sig_data = []
-    for key,val in dict_of_regions.items(): # key = (mH_gen,mA_gen), val = DF
-        mH_gen = key[0]
-        mA_gen = key[1]
-        w = val[(name.replace('HToZA','HToZA_mH_%d_mA_%d'))%(mH_gen,mA_gen)]
-        val[name] = w
-        new_sig_data.append(val)
-    new_sig_data = pd.concat(new_sig_data, axis=0) 
+    mH_sig = data['mH_gen'].values[idx_sig]
+    mA_sig = data['mA_gen'].values[idx_sig]
+    order = np.lexsort((mA_sig,mH_sig))
+    idx_sig = idx_sig[order]
+    mH_sig = mH_sig[order]
+    mA_sig = mA_sig[order]
+    weight_sig = np.zeros(idx_sig.shape[0])
+    change = np.r_[0,np.nonzero((np.diff(mH_sig)!=0) | (np.diff(mA_sig)!=0))[0]+1,idx_sig.shape[0]] # Limits of the mass points
+    for start,stop in zip(change[:-1],change[1:]):
+        if start == stop:
+            continue
+        weight_sig[start:stop] = data[weight_name%(mH_sig[start],mA_sig[start])].values[idx_sig[start:stop]]
 
     # Background case #
-    new_back_data = []
+    # repetition at each mass point : row r is event r%N_back with mass point r//N_back
     logging.info('\tParameterizing the background')
-        # repetition at each mass point
-    for i in range(masses.shape[0]):
-        df = copy.deepcopy(data_back)
-        df['mH_gen'] = masses[i,0]
-        df['mA_gen'] = masses[i,1]
-        df[name] = df[(name.replace('HToZA','HToZA_mH_%d_mA_%d'))%(masses[i,0],masses[i,1])]
-        new_back_data.append(df)
-    new_back_data = pd.concat(new_back_data, axis=0)
-    new_back_data['learning_weights'] /= masses.shape[0] # Not unbalance training in favour of background
-
-    # Concatenate #
-    data = pd.concat((new_sig_data,new_back_data),axis=0).reset_index(drop=True)
+    weight_back = data[[weight_name%(mH,mA) for mH,mA in masses]].values
+    N_sig = idx_sig.shape[0]
+    N_back = idx_back.shape[0]
+    N = N_sig+N_back*masses.shape[0]
+
+    # Produce the rows #
+    if path_cache is None:
+        data = ParametrizedRows(data,name,columns,0,N,idx_sig,mH_sig,mA_sig,weight_sig,idx_back,masses,weight_back)
+    else:
+        template = data.iloc[:1].copy() # To get the column dtypes in the cache
+        template[name] = 0.
+        for col in ['mH_gen','mA_gen','learning_weights']:
+            template[col] = template[col].astype(np.float64)
+        dtypes = {col:(dtype,categorical) for col,dtype,categorical in ColumnDtypes(template)}
+        for col in columns: # Strings must be as long as the longest one
+            if dtypes[col][0].kind == 'U':
+                dtypes[col] = (ColumnArray(data[col]).dtype,dtypes[col][1])
+        writer = CacheWriter(path_cache,N,[(col,)+dtypes[col] for col in columns])
+        for start in range(0,N,chunksize):
+            stop = min(start+chunksize,N)
+            writer.write(ParametrizedRows(data,name,columns,start,stop,idx_sig,mH_sig,mA_sig,weight_sig,idx_back,masses,weight_back),start)
+            logging.info('\tRows %d to %d written in %s'%(start,stop,path_cache))
+        writer.close(provenance={'parametrized':name,'masses':masses.tolist()})
+        data = LoadCache(path_cache,mmap='c') # Writable as the frame built in memory, the cache is not modified
 
     return data
 
+def ParametrizedRows(data,name,columns,start,stop,idx_sig,mH_sig,mA_sig,weight_sig,idx_back,masses,weight_back):
+    """ Returns the parametrized rows between start and stop (see ParametrizeClassifier) """
+    N_sig = idx_sig.shape[0]
+    N_back = idx_back.shape[0]
+    # Signal part #
+    sig = np.arange(min(start,N_sig),min(stop,N_sig))
+    # Background part #
+    back = np.arange(max(start,N_sig),max(stop,N_sig))-N_sig
+    idx_mass = back//N_back if N_back > 0 else back
+    idx_event = idx_back[back%N_back] if N_back > 0 else back
 
+    df = data.iloc[np.r_[idx_sig[sig],idx_event]].reset_index(drop=True)
+    df['mH_gen'] = np.r_[mH_sig[sig],masses[idx_mass,0]].astype(np.float64)
+    df['mA_gen'] = np.r_[mA_sig[sig],masses[idx_mass,1]].astype(np.float64)
+    df[name] = np.r_[weight_sig[sig],weight_back[idx_event,idx_mass]]
+    learning_weights = df['learning_weights'].values.astype(np.float64)
+    learning_weights[sig.shape[0]:] /= masses.shape[0] # Not unbalance training in favour of background
+    df['learning_weights'] = learning_weights
+    df.index = pd.RangeIndex(start=start,stop=stop)
+    return df[columns]
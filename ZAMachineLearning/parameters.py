@@ -5,6 +5,7 @@
 #           - parameters.py (mort important one)
 #           - sampleList.py (on what samples to run)
 #           (optionnaly NeuralNet.py for early_stopping etc)
+import tempfile
 import multiprocessing
 from keras.losses import binary_crossentropy, mean_squared_error, logcosh, categorical_crossentropy
 from keras.optimizers import RMSprop, Adam, Nadam, SGD            
@@ -60,6 +61,22 @@ time = '0-08:00:00' # days-hh:mm:ss
 mem = '5000' # ram in MB
 tasks = '1' # Number of threads(as a string) (not parallel training for classic mode)
 
+############################### Multiprocessing ######################################
+workers = 1 # Number of workers for keras generators (0 : all in same thread, the DataGenerator uses at most 1, see GeneratorWorkers)
+import_workers = int(tasks) # Number of processes reading the ROOT files in LoopOverTrees (1 : serial)
+eval_workers = int(tasks) # Number of processes evaluating the models after the scan (1 : serial)
+output_workers = int(tasks) # Number of processes producing the outputs of new files (one file per process at a time)
+scaler_workers = int(tasks) # Number of processes reading the generator files to compute the scaler (1 : serial)
+output_threads = 1 # Number of threads of each output process (TensorFlow and cross validation models run on their slices)
+generator_chunk_batches = 10 # Number of batches read at once from each file by the DataGenerator
+generator_prefetch = True # Whether the DataGenerator reads the next chunk in a background thread
+generator_shuffle = True # Whether the training DataGenerator shuffles the chunks and events at each epoch
+generator_seed = 42 # Seed of the shuffling (None : random), the same seed gives the same batches
+    # Chunks are kept per process : with several keras worker processes, each one reads its own chunks
+shared_path = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir() # Where the training arrays shared by the scan processes are written (memory filesystem)
+shared_arrays = False # Whether the slurm jobs of a scan share their training arrays in shared_path (one copy per node)
+    # The arrays are named after the data cache key, used by all the jobs running on the node and removed by the last one
+
 ######################################  Names  ########################################
 # Model name (only for scans)
 model = 'NeuralNetModel'       # Classic mode
@@ -67,11 +84,20 @@ model = 'NeuralNetModel'       # Classic mode
 # scaler and mask names #
 suffix = 'resolved_and_boosted' 
     # scaler_name -> 'scaler_{suffix}.pkl'  If does not exist will be created 
+scaler_weight = None # Column (branch of the generator files) of the event weights used in the mean and std of the scaler (eg 'learning_weights', None : unweighted)
     # mask_name -> 'mask_{suffix}_{sample}.npy'  If does not exist will be created 
 
 # Data cache #                                                                                       
-train_cache = os.path.join(path_out,'train_cache.pkl' )
-test_cache = os.path.join(path_out,'test_cache.pkl' )
+train_cache = os.path.join(path_out,'train_cache') # Directories containing one npy file per column
+test_cache = os.path.join(path_out,'test_cache')
+import_cache = os.path.join(path_out,'import_cache') # Imported data per class and era, only modified files are imported again
+cache_checksum = False # Also use the md5 checksum of the files to check the caches (slower, otherwise size and modification time)
+# Memory of the imported data #
+import_downcast = False # Use float32, smallest integers and categorical tag/era/sample for the imported data (weights stay float64)
+import_memory_budget = None # Memory (in MB) of the imported data above which it is streamed to disk (None : no limit)
+import_spill = os.path.join(path_out,'import_spill') # Where the data above the memory budget is streamed
+import_chunksize = None # Number of entries read at once from each tree during the importation (None : whole tree)
+output_chunksize = None # Number of entries read and written at once when producing the outputs of new data (None : whole tree)
 
 # Meta config info #
 xsec_json = os.path.join(main_path,'background_{era}_xsec.json')
@@ -82,7 +108,12 @@ resume_model = ''
 
 # Output #
 output_batch_size = 512
+output_write_chunksize = 100000 # Number of events whose outputs are computed and written at once in the output trees
+restore_cache_size = 8 # Number of restored models kept in memory (eg, all the models of the cross validation)
+restore_retries = 10 # Number of times the restoration of a model is tried again if it fails (eg, zip being copied)
+restore_wait = 3 # Time (in s) between two attempts
 split_name = 'tag' # 'sample' or 'tag' : criterion for output file splitting
+friend_index = ['run','event'] # Branches saved in the friend trees (--friend) to match the events of the input trees (major and minor index of Utils.AttachFriend, event numbers are unique in a run)
 
 ##############################  Evaluation criterion   ################################
 
@@ -137,6 +168,12 @@ p = {
 
 repetition = 1 # How many times each hyperparameter has to be used 
 
+# Successive halving : all the sets are trained for a few epochs and only the best ones continue #
+halving = False # Use successive halving in the scan instead of training all the sets for all the epochs
+halving_min_epochs = 10 # Number of epochs of the first round
+halving_eta = 3 # At each round, 1/halving_eta of the sets are kept (lowest val_loss) and trained halving_eta times longer
+    # The kept sets are resumed from their checkpoint, up to the epochs in the dict (eg 10 -> 30 -> 90 -> 200)
+
 ###################################  Variables   ######################################
 cut = None
 
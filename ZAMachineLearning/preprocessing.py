@@ -13,12 +13,12 @@ class PreprocessLayer(Layer):
     Defines a layer that applies the preprocessing from a scaler
     Needed because lambda layers are too fragile to be saved in a model
     Also because they are defined as weights, they are saved in the h5 file
-    Careful ! When using the model (ie with predict()), the batch size used should be lower than the one set here (at least 32)
+    The mean and std are stored as (n_inputs,) vectors and broadcast over the batch, any batch size can be used
+    Models saved with older versions have (batch_size,n_inputs) weights and batch_size in their config :
+    the weights are then built with that shape (so that the h5 file can be loaded) and only the first row is used
     """
-    def __init__(self, mean, std, batch_size=32, **kwargs):
-        self.b = max(32,batch_size)
-        # Since we slice will the tensors later, we need the size of the tensors to be big enough
-        # The 32 is the default value when using predict(), if we set it lower we will not be able to slice the tensor
+    def __init__(self, mean, std, batch_size=None, **kwargs):
+        self.b = batch_size # Only set for legacy models
         if isinstance(mean,list):
             self.m = np.asarray(mean)
         elif isinstance(mean,np.ndarray):
@@ -34,37 +34,43 @@ class PreprocessLayer(Layer):
 
         super(PreprocessLayer, self).__init__(**kwargs)
     def build(self, input_shape):
+        if self.b is None:
+            shape = (input_shape[1],)
+            mean = self.m
+            std = self.s
+        else: # Legacy tiled weights
+            shape = (self.b,input_shape[1])
+            mean = np.tile(self.m,(self.b,1))
+            std = np.tile(self.s,(self.b,1))
         if tf.__version__.startswith('1.5'):
             self.mean = self.add_weight(name='mean', 
-                                        shape=(self.b,input_shape[1]),
-                                        initializer=tf.constant_initializer(np.tile(self.m,(self.b,1)),verify_shape=True),
+                                        shape=shape,
+                                        initializer=tf.constant_initializer(mean,verify_shape=True),
                                         trainable=False)
             self.std = self.add_weight(name='std', 
-                                        shape=(self.b,input_shape[1]),
-                                        initializer=tf.constant_initializer(np.tile(self.s,(self.b,1))),
+                                        shape=shape,
+                                        initializer=tf.constant_initializer(std),
                                         trainable=False)
 
         elif tf.__version__.startswith('2.'):
             with tf.init_scope():
                 self.mean = self.add_weight(name='mean', 
-                                          shape=(self.b,input_shape[1]),
-                                          #initializer=tf.constant_initializer(np.tile(self.m,(self.b,1)),verify_shape=True),
-                                          initializer=tf.constant_initializer(np.tile(self.m,(self.b,1))),
+                                          shape=shape,
+                                          initializer=tf.constant_initializer(mean),
                                           trainable=False)
                 self.std = self.add_weight(name='std', 
-                                          shape=(self.b,input_shape[1]),
-                                          #initializer=tf.constant_initializer(np.tile(self.s,(self.b,1)),verify_shape=True),
-                                          initializer=tf.constant_initializer(np.tile(self.s,(self.b,1))),
+                                          shape=shape,
+                                          initializer=tf.constant_initializer(std),
                                           trainable=False)
         else:
             sys.exit("Tensforflow version "+tf.__version__+" unknown for preprocessing layer")
         super(PreprocessLayer, self).build(input_shape)  # Be sure to call this at the end
     def call(self, x):
-        # Due to remainder at the end of epoch, input_shape[0]<=batch_size
-        # Need to slice the mean and std tensor so that they have the same shape as x
-        mean = self.mean[:K.shape(x)[0],:]
-        std = self.std[:K.shape(x)[0],:]
-        return (x-mean)/(std+K.epsilon())
+        # (n_inputs,) vectors are broadcast over the batch dimension
+        if self.b is None:
+            return (x-self.mean)/(self.std+K.epsilon())
+        else: # All the rows of legacy weights are identical
+            return (x-self.mean[0,:])/(self.std[0,:]+K.epsilon())
     def compute_output_shape(self, input_shape):
         # Since add and sub keep the same shape, return input_shape
         return (input_shape[0],input_shape[1])
@@ -78,9 +84,9 @@ class PreprocessLayer(Layer):
         if isinstance(self.s,np.ndarray): # Cannot use numpy arrays in the json file
             config['std'] = self.s.tolist() 
         else:
-            config['std'] = self.std 
-        config['batch_size'] = self.b 
-        # This batch size value is the maximum one can use when using the model later
+            config['std'] = self.s 
+        if self.b is not None: # Legacy model, must be saved again with the same weights shape
+            config['batch_size'] = self.b 
         return config
 
 #################################################################################################
@@ -88,8 +94,8 @@ class PreprocessLayer(Layer):
 #################################################################################################
 def MakeArrayMultiple(list_array,batch_size,repeat=False,crop=False):
     """
-    Given that PreprocessLayer requires that the input array size is a multiple of the batch_size
-    This function extends or crops the array to make it fit
+    Extends or crops the arrays so that their size is a multiple of the batch_size
+    (Not needed anymore for the PreprocessLayer, which accepts any batch size)
     crop = true -> removes the last elements of the array, otherwise will repeat some entries
     repeat = true -> elements are taken randomly to fill the remained, if not only zeros
     """
@@ -2,12 +2,13 @@ import os
 import copy
 import sys
 import logging
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
-from root_numpy import array2root
 
 from NeuralNet import HyperModel
-from import_tree import Tree2Pandas
+from import_tree import Tree2PandasChunks
+from output_writer import RootWriter
 from generate_mask import GenerateSliceIndices, GenerateSliceMask
 import parameters
 
@@ -21,80 +22,91 @@ class ProduceOutput:
         if self.list_inputs is None:
             self.list_inputs = copy.deepcopy(parameters.inputs) 
 
-    def OutputFromTraining(self,data,path_output,output_name=None):
+    def OutputFromTraining(self,data,path_output,output_name=None,mode='recreate',columns=None):
         """
             Get the output of the model from the test set
             This is data separated from the training
             If output_name is specified, the whole data will be written in 'output_name'.root
                 if not, the samples in the dataframe are used to split into different files with names 'sample'.root
+            mode is passed to array2root ('update' to append the events to an existing file)
+            The outputs are computed and written by chunks of output_write_chunksize events (see RootWriter)
+            If columns is specified, only these columns of data are written with the outputs
+            Returns the number of events written
         """
+        output_columns = [('output_%s'%o).replace('$','') for o in parameters.outputs]
+        writer = RootWriter(path_output   = path_output,
+                            output_name   = output_name,
+                            split_column  = parameters.split_name if output_name is None else None,
+                            mode          = mode,
+                            chunksize     = parameters.output_write_chunksize,
+                            columns       = columns)
+        if data is None: # Generator : the outputs are produced from the file
+            writer.write(None,self.ModelOutput(None),output_columns)
+        else:
+            for start in range(0,data.shape[0],parameters.output_write_chunksize):
+                chunk = data.iloc[start:start+parameters.output_write_chunksize]
+                output = self.ModelOutput(chunk)
+                assert output.shape[0] == chunk.shape[0] # One output per row
+                writer.write(chunk,output,output_columns)
+        writer.close()
+        return sum(writer.entries.values())
+
+    def ModelOutput(self,data):
+        """ Output of the model (or cross validation models) for the rows of data, in the same order """
         inputs = data[self.list_inputs].values if data is not None else None
-        output = None
-
-        # Get Model Output #
         if len(self.model) == 1: # classic training
-            instance = HyperModel(self.model)
-            output = instance.HyperRestore(inputs,generator=self.generator,generator_filepath=self.generator_filepath)
+            instance = HyperModel(self.model[0])
+            return instance.HyperRestore(inputs,generator=self.generator,generator_filepath=self.generator_filepath)
         else: # cross validation
-            for model_idx,model in enumerate(self.model):
-                instance = HyperModel(model)
-                apply_idx, _, _ = GenerateSliceIndices(model_idx)
-                apply_mask = GenerateSliceMask(apply_idx,data['mask']) 
-                model_out = instance.HyperRestore(inputs[apply_mask],generator=self.generator,generator_filepath=self.generator_filepath)
-                if output is None:
-                    output = model_out
-                else:
-                    output = np.concatenate((output,model_out),axis=0)
-            assert output.shape[0] == data.shape[0]
-
-
-        # From numpy output array to df #
-        output_df = pd.DataFrame(output,columns=[('output_%s'%o).replace('$','') for o in parameters.outputs],index=pd.RangeIndex(start=0,stop=output.shape[0]))
-
-        # Make full df #
-        full_df = pd.concat([data,output_df],axis=1)
-        # Unresolved issue in DataGenerator :
-        # Cannot use smaller batches than batch_size to truncate the last elements of array
-        # that do not fit in a last batch
-        # TODO : fix that
-        # In the meantime, also truncate the output array, otherwise will fill nan
-        full_df = full_df[:output.shape[0]]
-
-        # Get the unique samples as a list #
-        if output_name is None:
-            sample_list = list(full_df[parameters.split_name].unique())
-
-            # Loop over samples #
-            for sample in sample_list:
-                sample_df = full_df.loc[full_df[parameters.split_name]==sample] # We select the rows corresponding to this sample
-
-                # Remove tag and sample name (info in target as bool) #
-                sample_df = sample_df.drop('tag',axis=1)
-                sample_df = sample_df.drop('sample',axis=1)
-
-                # From df to numpy array with dtype #
-                sample_output = sample_df.to_records(index=False,column_dtypes='float64')
-                sample_output.dtype.names = parameters.make_dtype(sample_output.dtype.names)# because ( ) and . are an issue for root_numpy
-                sample_output_name = os.path.join(path_output,sample+'.root')
+            if data is None:
+                raise RuntimeError('Cross validation outputs need the mask of the events, not available with the generator')
+            return self.CrossValidationOutput(inputs,data['mask'].values)
 
-                # Save as root file #
-                array2root(sample_output,sample_output_name,mode='recreate')
-                logging.info('Output saved as : '+sample_output_name)
-        else:
-            # From df to numpy array with dtype #
-            full_output = full_df.to_records(index=False,column_dtypes='float64')
-            full_output.dtype.names = parameters.make_dtype(full_output.dtype.names)# because ( ) and . are an issue for root_numpy
-            full_output_name = os.path.join(path_output,output_name)
-            array2root(full_output,full_output_name,mode='recreate')
-            logging.info('Output saved as : '+full_output_name)
-         
-    def OutputNewData(self,input_dir,list_sample,path_output,variables=None):
+    def CrossValidationOutput(self,inputs,mask):
+        """
+            Outputs of the cross validation models, in the same order as inputs
+            Each event goes to the model applied on its slice (mask value, see GenerateSliceIndices)
+            The models are all restored first, then run concurrently on output_threads threads 
+            Each one writes its outputs at the original indices of its events in a preallocated array
+        """
+        # Model applied on each slice #
+        slice_model = np.full(parameters.N_slices,-1)
+        for model_idx in range(len(self.model)):
+            apply_idx, _, _ = GenerateSliceIndices(model_idx)
+            slice_model[apply_idx] = model_idx
+        event_model = slice_model[mask.astype(np.int64)]
+        if np.any(event_model < 0):
+            raise RuntimeError('%d events are in a slice without model'%np.sum(event_model < 0))
+
+        instances = [HyperModel(model) for model in self.model]
+        for instance in instances:
+            instance.HyperLoad() # Restored once, used from the cache in the threads
+
+        output = np.empty((inputs.shape[0],len(parameters.outputs)),dtype=np.float32)
+        def FoldOutput(model_idx):
+            idx = np.nonzero(event_model == model_idx)[0]
+            if idx.shape[0] != 0:
+                output[idx] = instances[model_idx].HyperRestore(inputs[idx])
+            return idx.shape[0]
+        with ThreadPoolExecutor(max_workers=parameters.output_threads) as executor:
+            for model_idx,n in enumerate(executor.map(FoldOutput,range(len(instances)))):
+                logging.info('Model %s applied on %d events'%(self.model[model_idx],n))
+        return output
+
+    def OutputNewData(self,input_dir,list_sample,path_output,variables=None,chunksize=None,friend=False):
         """
             Given a model, produce the output 
             The Network has never seen this data !
+            If chunksize, the trees are read and the outputs written by chunks of chunksize entries (files larger than the memory)
+            If friend, only the outputs and the event index (parameters.friend_index) are written : the output files
+                are friend trees of the input files, see Utils.AttachFriend
+            Returns the number of events processed
         """
+        if friend and self.generator:
+            raise RuntimeError('The friend trees need the event index, not available with the generator')
         # Loop over datasets #
         logging.info('Input directory : %s'%input_dir)
+        n_events = 0
         for f in list_sample: 
             name = os.path.basename(f)
             full_path = os.path.join(input_dir,f)
@@ -105,21 +117,25 @@ class ProduceOutput:
                 var = parameters.inputs+parameters.outputs+parameters.other_variables
             else:
                 var = copy.deepcopy(variables) # Avoid bug where variables is changed at each new file
+            if friend: # Only the inputs are needed, plus the index
+                var = [v for v in parameters.inputs if not v.startswith('$')]+[v for v in parameters.friend_index if v not in parameters.inputs]
 
             if self.generator:
-                data = None
-            else:
-                data = Tree2Pandas(input_file=full_path,
-                                   variables=var,
-                                   weight=parameters.weights,
-                                   cut = parameters.cut,
-                                   reweight_to_cross_section=False)
-                    
+                self.generator_filepath = full_path
+                n_events += self.OutputFromTraining(data=None,path_output=path_output,output_name=name)
+                continue
+
+            mode = 'recreate'
+            for data in Tree2PandasChunks(input_file = full_path,
+                                          variables  = var,
+                                          weight     = parameters.weights,
+                                          cut        = parameters.cut,
+                                          chunksize  = chunksize):
                 if data.shape[0]==0:
-                    logging.info('\tEmpty tree')
                     continue # Avoids empty trees
-            
-            if self.generator:
-                self.generator_filepath = full_path
-
-            self.OutputFromTraining(data=data,path_output=path_output,output_name=name)
+                n_events += self.OutputFromTraining(data=data,path_output=path_output,output_name=name,mode=mode,
+                                                    columns=parameters.friend_index if friend else None)
+                mode = 'update' # Next chunks are appended to the tree
+            if mode == 'recreate':
+                logging.info('\tEmpty tree')
+        return n_events
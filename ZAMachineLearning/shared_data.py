@@ -0,0 +1,167 @@
+import os
+import json
+import fcntl
+import contextlib
+import shutil
+import logging
+import tempfile
+
+import numpy as np
+
+# Personal files #
+import parameters
+
+# Shared training arrays #
+# The training and evaluation arrays of the scan (x_train, y_train, x_val, y_val) are written once as npy files
+# in a directory of a memory filesystem (/dev/shm by default, see parameters.py)
+# The scan processes then memory-map them read-only : the pages are shared by all the processes of the node
+
+SHARED_ARRAYS = ['x_train','y_train','x_val','y_val']
+SHARED_INFO = 'info.json'
+SHARED_USERS = 'users' # Directory with one file per process using arrays published with a key (see DetachArrays)
+
+###############################################################################
+# SplitIndices #
+###############################################################################
+
+def SplitIndices(data,model_idx=None):
+    """
+    Returns the indices (train_idx,val_idx) of the training and evaluation events of data
+        - model_idx is None : random split according to training_ratio and evaluation_ratio
+        - model_idx : cross validation, slices from the mask (see GenerateSliceIndices)
+    """
+    if model_idx is None:
+        from sklearn.model_selection import train_test_split
+        size = parameters.training_ratio/(parameters.training_ratio+parameters.evaluation_ratio)
+        train_idx, val_idx = train_test_split(np.arange(data.shape[0]),train_size=size)
+    else: # Cross validation : take the training and evaluation set based on the mask
+        # model_idx == index of mask on which model will be applied (aka, not trained nor evaluated)
+        from generate_mask import GenerateSliceIndices, GenerateSliceMask
+        _, eval_idx, train_idx = GenerateSliceIndices(model_idx)
+        val_idx = np.nonzero(GenerateSliceMask(eval_idx,data['mask']))[0]
+        train_idx = np.nonzero(GenerateSliceMask(train_idx,data['mask']))[0]
+    return train_idx, val_idx
+
+###############################################################################
+# PublishArrays #
+###############################################################################
+
+def PublishArrays(data,list_inputs,list_outputs,path,model_idx=None,key=None):
+    """
+    Writes the training and evaluation arrays of data in a new directory inside path, returns its path
+        - x : list_inputs columns
+        - y : list_outputs columns + learning_weights (as expected by the models)
+    The arrays are filled column by column, so that the full x and y are never in memory
+    If key is given, the directory is named after it and an existing one is used again (several jobs on the same node) :
+    each process is recorded as user of the arrays and must call DetachArrays, the last one removes them
+    Otherwise it has a unique name and must be removed with ReleaseArrays
+    """
+    if key is not None:
+        path_arrays = os.path.join(path,'ZAMachineLearning_%s'%key[:16]+('' if model_idx is None else '_crossval%d'%model_idx))
+        with ArraysLock(path_arrays): # The other jobs wait for the arrays, and they are not removed meanwhile
+            if os.path.exists(os.path.join(path_arrays,SHARED_INFO)):
+                logging.info('Shared arrays already published in %s'%path_arrays)
+            else:
+                WriteArrays(data,list_inputs,list_outputs,path_arrays,model_idx)
+            users = os.path.join(path_arrays,SHARED_USERS)
+            if not os.path.isdir(users):
+                os.makedirs(users)
+            open(os.path.join(users,str(os.getpid())),'w').close()
+        return path_arrays
+    path_arrays = tempfile.mkdtemp(prefix='ZAMachineLearning_',dir=path)
+    WriteArrays(data,list_inputs,list_outputs,path_arrays,model_idx)
+    return path_arrays
+
+def WriteArrays(data,list_inputs,list_outputs,path_arrays,model_idx=None):
+    """ Writes the arrays of PublishArrays in path_arrays (the directory only appears when complete) """
+    tmp_path = path_arrays+'.tmp%d'%os.getpid()
+    os.makedirs(tmp_path)
+
+    train_idx, val_idx = SplitIndices(data,model_idx)
+    y_columns = list_outputs+['learning_weights']
+    info = {'inputs':list_inputs,'outputs':list_outputs}
+    for name,columns,idx in [('x_train',list_inputs,train_idx),
+                             ('y_train',y_columns,train_idx),
+                             ('x_val',list_inputs,val_idx),
+                             ('y_val',y_columns,val_idx)]:
+        dtype = np.result_type(*[data[col].dtype for col in columns])
+        arr = np.lib.format.open_memmap(os.path.join(tmp_path,name+'.npy'),mode='w+',dtype=dtype,shape=(idx.shape[0],len(columns)))
+        for j,col in enumerate(columns):
+            arr[:,j] = data[col].values[idx]
+        arr.flush()
+        del arr
+        info[name] = [int(idx.shape[0]),len(columns)]
+    with open(os.path.join(tmp_path,SHARED_INFO),'w') as handle:
+        json.dump(info,handle,indent=4)
+
+    # The directory only appears when complete #
+    try:
+        if os.path.exists(path_arrays):
+            os.rmdir(path_arrays) # Empty directory from mkdtemp
+        os.rename(tmp_path,path_arrays)
+    except OSError: # Published in the meantime by another job
+        shutil.rmtree(tmp_path)
+    logging.info('Shared arrays published in %s (training set : %d, evaluation set : %d)'%(path_arrays,train_idx.shape[0],val_idx.shape[0]))
+
+###############################################################################
+# AttachArrays #
+###############################################################################
+
+def AttachArrays(path_arrays):
+    """ Returns the dict of the arrays published in path_arrays, memory-mapped read-only (no copy) """
+    if not os.path.exists(os.path.join(path_arrays,SHARED_INFO)):
+        raise RuntimeError('No shared arrays in %s'%path_arrays)
+    return {name:np.load(os.path.join(path_arrays,name+'.npy'),mmap_mode='r') for name in SHARED_ARRAYS}
+
+###############################################################################
+# ReleaseArrays #
+###############################################################################
+
+def ReleaseArrays(path_arrays):
+    """ Removes the arrays published in path_arrays (the processes still attached keep their mapping) """
+    if os.path.isdir(path_arrays):
+        shutil.rmtree(path_arrays)
+        logging.info('Shared arrays in %s removed'%path_arrays)
+
+###############################################################################
+# DetachArrays #
+###############################################################################
+
+def DetachArrays(path_arrays):
+    """
+    The current process stops using the arrays published with a key in path_arrays,
+    they are removed if no other process uses them (the users that do not run anymore, eg killed jobs, are ignored)
+    """
+    with ArraysLock(path_arrays):
+        users = os.path.join(path_arrays,SHARED_USERS)
+        if not os.path.isdir(users):
+            return
+        for pid in os.listdir(users):
+            if int(pid) == os.getpid() or not ProcessExists(int(pid)):
+                os.remove(os.path.join(users,pid))
+        if len(os.listdir(users)) == 0:
+            ReleaseArrays(path_arrays)
+
+###############################################################################
+# ArraysLock #
+###############################################################################
+
+@contextlib.contextmanager
+def ArraysLock(path_arrays):
+    """ Lock between the processes of the node on the arrays of path_arrays (lock file next to the directory) """
+    with open(path_arrays+'.lock','w') as handle:
+        fcntl.flock(handle,fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(handle,fcntl.LOCK_UN)
+
+def ProcessExists(pid):
+    """ Whether the process pid runs on this node """
+    try:
+        os.kill(pid,0)
+    except ProcessLookupError:
+        return False
+    except PermissionError: # Process of another user
+        return True
+    return True
@@ -19,32 +19,65 @@ def Decoupler(data,decoupled_name,list_to_decouple=None,decimals=False):
     So that each event is presented 23 times with different parameters mH, mA and according weight
     inputs = [Pt,eta,phi]x4
     outputs = 23 set of weights
+    The rows are materialized, use ParametrizedView to produce them on demand
     """
-    list_dec = parameters.outputs if list_to_decouple is None else copy.copy(list_to_decouple)
-    # Get the arrays of mH, mA ordered as in the outputs
-    list_rest = [i for i in data.columns if i not in list_dec] # All but outputs
-    n_weights = len(list_dec)
-    mHmA = np.empty((0,2))
-    for ol in list_dec:
-        if decimals:
-            arr = np.array([[float(re.findall(r"\d*\.\d+|\d+", ol)[0]),float(re.findall(r"\d*\.\d+|\d+", ol)[1])]])
-        else:
-            arr = np.array([[int(re.findall(r'_\d+', ol)[0].replace('_','')),int(re.findall(r'_\d+', ol)[1].replace('_',''))]])
-        mHmA = np.append(mHmA,arr,axis=0)
-    # Get the numpy arrays #
-    decouple = data[list_dec].values
-    repeat = data[list_rest].values
+    view = ParametrizedView(data,decoupled_name,list_to_decouple,decimals)
+    return view.take(np.arange(len(view)))
 
-    # Repeat and decouple #
-    repeat = Repeater(repeat,n_weights)
-    masses = np.tile(mHmA,(data.shape[0],1))
-    decouple = decouple.flatten()
+class ParametrizedView:
+    """
+    Virtual version of the Decoupler output : the events and their weights are kept once,
+    row k of the decoupled frame is (event k//n_weights, mass point k%n_weights) and is only produced when requested
+    The memory scales with the number of events instead of events x mass points
+        data            : pandas DataFrame with one column per weight (eg, weight_mH_500_mA_100)
+        decoupled_name  : name of the column with the weight of the mass point of the row
+        list_to_decouple: columns of the weights, their names contain the masses (default : parameters.outputs)
+    Columns of the view : columns of data not decoupled + ['mH_MEM','mA_MEM',decoupled_name]
+    """
+    def __init__(self,data,decoupled_name,list_to_decouple=None,decimals=False):
+        list_dec = parameters.outputs if list_to_decouple is None else copy.copy(list_to_decouple)
+        self.decoupled_name = decoupled_name
+        self.list_rest = [i for i in data.columns if i not in list_dec] # All but outputs
+        self.columns = self.list_rest+['mH_MEM','mA_MEM',decoupled_name]
+        # Get the arrays of mH, mA ordered as in the outputs #
+        mHmA = []
+        for ol in list_dec:
+            if decimals:
+                mHmA.append([float(re.findall(r"\d*\.\d+|\d+", ol)[0]),float(re.findall(r"\d*\.\d+|\d+", ol)[1])])
+            else:
+                mHmA.append([int(re.findall(r'_\d+', ol)[0].replace('_','')),int(re.findall(r'_\d+', ol)[1].replace('_',''))])
+        self.masses = np.asarray(mHmA,dtype=np.float64).reshape(-1,2)
+        # Base arrays, kept only once #
+        self.base = {col:data[col].values for col in self.list_rest}
+        self.weights = data[list_dec].values
+        self.n_events = data.shape[0]
+        self.n_weights = len(list_dec)
+
+    def __len__(self):
+        return self.n_events*self.n_weights
+
+    def column(self,name,indices):
+        # Values of the column for the rows of the decoupled frame in indices #
+        indices = np.asarray(indices)
+        if name in self.base.keys():
+            return self.base[name][indices//self.n_weights]
+        elif name == 'mH_MEM':
+            return self.masses[indices%self.n_weights,0]
+        elif name == 'mA_MEM':
+            return self.masses[indices%self.n_weights,1]
+        elif name == self.decoupled_name:
+            return self.weights[indices//self.n_weights,indices%self.n_weights]
+        else:
+            raise KeyError('Column %s not in the parametrized view'%name)
 
-    # Concatenate and make DF #
-    new_arr = np.c_[repeat,masses,decouple]
-    df = pd.DataFrame(new_arr,columns=list_rest+['mH_MEM','mA_MEM',decoupled_name])
+    def array(self,columns,indices):
+        # 2D array of the columns for the rows in indices (eg, inputs of a batch) #
+        return np.stack([self.column(col,indices) for col in columns],axis=1)
 
-    return df
+    def take(self,indices,columns=None):
+        # DataFrame of the rows in indices (same layout as the Decoupler) #
+        columns = self.columns if columns is None else columns
+        return pd.DataFrame({col:self.column(col,indices) for col in columns},columns=columns)
 
 def Repeater(arr,n):
     """
@@ -59,12 +92,9 @@ def Repeater(arr,n):
                          [g,h,i],
                          [g,h,i],
                          ...]
+    Also works on 1D arrays, the dtype is kept
     """
-    new_arr = np.zeros((arr.shape[0]*n,arr.shape[1]),dtype=object)
-    for i in range(0,arr.shape[0]):
-        new_row = np.tile(arr[i,:],(n,1))
-        new_arr[i*n:(i+1)*n,:] = new_row
-    return new_arr
+    return np.repeat(arr,n,axis=0)
 
 def Recoupler(data,col_to_recouple,N,decimals=False):
     """ 
@@ -81,7 +111,7 @@ def Recoupler(data,col_to_recouple,N,decimals=False):
     
     # Get the basic repeated values #
     idx_base = np.arange(0,data.shape[0],N)
-    entry_base = data.iloc[idx_base][col_repeated].values # select one entry among the repeated
+    entry_base = data.iloc[idx_base][col_repeated].reset_index(drop=True) # select one entry among the repeated
 
     # generate the new columns #
     mH = data.iloc[0:N]['mH_MEM'].values.tolist()
@@ -97,8 +127,7 @@ def Recoupler(data,col_to_recouple,N,decimals=False):
     data_recoupled = Transposer(data_to_recouple,N)
 
     # Concatenate and make into DF #
-    full_arr = np.c_[entry_base,data_recoupled]
-    new_df = pd.DataFrame(full_arr,columns=col_repeated+new_col)
+    new_df = pd.concat([entry_base,pd.DataFrame(data_recoupled,columns=new_col)],axis=1)
 
     return new_df
 
@@ -121,25 +150,11 @@ def Transposer(arr,n):
         logging.critical('Cannot apply the recoupling on the array, the requested repetition is not a divisor of the array size')
         sys.exit()
 
-    # Define new array #
+    # Each slice of n rows is transposed and flattened into one row #
     x = arr.shape[0]
     y = arr.shape[1]
     new_x = x//n
-    new_y = y*n
-    new_arr = np.zeros((new_x,new_y))
-
-    # Loop #
-    idx_row = 0 # row index of new array
-    for i in range(arr.shape[0]//n):
-        arr_slice = arr[i*n:(i+1)*n,:] # Slice that we need to "transpose"
-        idx_col = 0 # col index of new array
-        for col in range(arr_slice.shape[1]): # loop over slice to fill the row of new array
-            for row in range(arr_slice.shape[0]):
-                new_arr[idx_row,idx_col] = arr_slice[row,col]
-                idx_col += 1
-        idx_row += 1
-
-    return new_arr
+    return np.asarray(arr).reshape(new_x,n,y).transpose(0,2,1).reshape(new_x,y*n)
     
 
 
@@ -36,7 +36,7 @@ logging.basicConfig(level=logging.INFO,format='%(asctime)s - %(levelname)s - %(m
 with open('/home/ucl/cp3/fbury/MoMEMtaNeuralNet/scaler_gen_ME.pkl', 'rb') as handle: # Import scaler that was created before
     scaler = pickle.load(handle)
 IN = Input(shape=(len(parameters.inputs),),name='IN')
-L0 = PreprocessLayer(batch_size=100000,mean=scaler.mean_,std=scaler.scale_,name='Preprocess')(IN)
+L0 = PreprocessLayer(mean=scaler.mean_,std=scaler.scale_,name='Preprocess')(IN)
 L1 = Dense(500,activation=relu)(L0)
 B1 = BatchNormalization()(L1)
 L2 = Dense(500,activation=relu)(B1)